@@ -254,12 +254,20 @@ class Installer():
         if self.enabled("bundle_supervisord"):
             self.make_template("supervisord.conf", out)
 
-        self.make_template("supervisor.conf", out, engines_clean=self.config["engines"].replace('/', '_'))
+        # either one engine per contract, or engine hosts running many each
+        if int(self.config["engine_hosts"]):
+            engines_clean = "engine_host"
+        else:
+            engines_clean = self.config["engines"].replace('/', '_')
+        self.make_template("supervisor.conf", out, engines_clean=engines_clean)
         if not self.enabled("disable_bitcoin"):
             self.make_template("bitcoind.conf", out)
-        for ticker in [x.strip() for x in self.config["engines"].split(',')]:
-            self.make_template("engine.conf", out, raw_ticker=ticker,
-                               clean_ticker=ticker.replace('/', '_'))
+        if int(self.config["engine_hosts"]):
+            self.make_template("engine_host.conf", out)
+        else:
+            for ticker in [x.strip() for x in self.config["engines"].split(',')]:
+                self.make_template("engine.conf", out, raw_ticker=ticker,
+                                   clean_ticker=ticker.replace('/', '_'))
 
         out.close()
         
@@ -36,12 +36,14 @@ if options.filename:
 import database
 import models
 import margin
+import sharding
 import util
 import ledger
 from alerts import AlertsProxy
 from sendmail import Sendmail
 
 from ledger import create_posting
+from engine_host import engine_proxies
 
 from zmq_util import export, dealer_proxy_async, router_share_async, pull_share_async, \
     push_proxy_async, RemoteCallTimedOut, RemoteCallException, ComponentExport
@@ -50,12 +52,14 @@ from twisted.internet import reactor, defer, task
 from twisted.python import log
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import func
+from sqlalchemy import func, or_
 from watchdog import watchdog
 from jinja2 import Environment, FileSystemLoader
 
+import os
 import time
 from datetime import datetime
+from collections import defaultdict, Counter
 from util import session_aware
 from exception import *
 
@@ -83,13 +87,18 @@ class Accountant:
     """
     def __init__(self, session, engines, cashier, ledger, webserver, accountant_proxy,
                  alerts_proxy, accountant_number=0, debug=False, trial_period=False,
-                 mimetic_share=0.5, sendmail=None, template_dir='admin_templates'):
+                 mimetic_share=0.5, sendmail=None, template_dir='admin_templates',
+                 persist_interval=0):
         """Initialize the Accountant
 
         :param session: The SQL Alchemy session
         :type session:
         :param debug: Whether or not weird things can happen like position adjustment
         :type debug: bool
+        :param persist_interval: how long to let position changes, order fills
+            and trades build up before writing them to the database, 0 to
+            write them as they happen
+        :type persist_interval: float
 
         """
 
@@ -119,6 +128,31 @@ class Accountant:
             d.addCallback(get_cb(contract.ticker))
 
         self.webserver = webserver
+        # The users, contracts, positions and open orders we have looked up,
+        # so we only query for each one once. Our session does not expire
+        # them on commit, so a fill, which only commits, reads none of them
+        # again, but they are read again after a rollback.
+        self.users = {}
+        self.contracts = {}
+        self.positions = {}
+        self.orders = {}
+        # Postings sent to the ledger which have not come back yet, by
+        # (username, ticker)
+        self.pending_postings = defaultdict(int)
+        # What we have not written to the database yet: position changes by
+        # (username, ticker), fills by order id, new trades, and trades which
+        # have been posted. The ledger has the postings, so if we crash before
+        # writing them they are rebuilt from it when we start again.
+        self.position_deltas = defaultdict(int)
+        self.fill_deltas = defaultdict(int)
+        self.new_trades = []
+        self.trades = []
+        self.persist_interval = persist_interval
+        self.persist_call = None
+        # The margin.MarginState of each user whose margin we have checked,
+        # kept up to date as their orders and positions change
+        self.margins = {}
+        self.callLater = reactor.callLater
         self.disabled_users = {}
         self.clearing_contracts = {}
         self.accountant_number = accountant_number
@@ -142,44 +176,34 @@ class Accountant:
         # Note: It is *important* that all invocations of post_or_fail attach
         #       an errback (even if it is just log.err) to catch the
         #       propogating error.
-        # We initialize positions here if they don't already exist
+        # The counters are only kept in memory, and the position changes are
+        # written to the database by persist() along with everything else.
 
         def update_counters(increment=False):
             change = 1 if increment else -1
 
-            try:
-                for posting in postings:
-                    position = self.get_position(
-                            posting['username'], posting['contract'])
-                    position.pending_postings += change
-                    # we might be initializing the position here, so make sure it is in db
-                    self.session.add(position)
-                self.session.commit()
-            except SQLAlchemyError, e:
-                log.err("Could not update counters: %s" % e)
-                self.alerts_proxy.send_alert("Exception in ledger. See logs.")
-                self.session.rollback()
-            finally:
-                self.session.rollback()
+            for posting in postings:
+                key = (posting['username'], posting['contract'])
+                self.pending_postings[key] += change
+                if not self.pending_postings[key]:
+                    del self.pending_postings[key]
 
         def on_success(result):
             log.msg("Post success: %s" % result)
-            try:
-                for posting in postings:
-                    position = self.get_position(posting['username'], posting['contract'])
-                    user = self.get_user(posting['username'])
-                    if posting['direction'] == 'debit':
-                        sign = 1 if user.type == 'Asset' else -1
-                    else:
-                        sign = -1 if user.type == 'Asset' else 1
+            for posting in postings:
+                user = self.get_user(posting['username'])
+                if posting['direction'] == 'debit':
+                    sign = 1 if user.type == 'Asset' else -1
+                else:
+                    sign = -1 if user.type == 'Asset' else 1
 
-                    log.msg("Adjusting position %s by %d %s" % (position, posting['quantity'], posting['direction']))
-                    position.position += sign * posting['quantity']
-                    log.msg("New position: %s" % position)
-                    #self.session.merge(position)
-                self.session.commit()
-            finally:
-                self.session.rollback()
+                log.msg("Adjusting position %s/%s by %d %s" % (posting['username'], posting['contract'],
+                                                             posting['quantity'], posting['direction']))
+                self.position_deltas[(posting['username'], posting['contract'])] += sign * posting['quantity']
+                if posting['username'] in self.margins:
+                    self.margins[posting['username']].adjust_position(self.get_contract(posting['contract']),
+                                                                      sign * posting['quantity'])
+            self.schedule_persist()
 
         def on_fail_ledger(failure):
             e = failure.trap(ledger.LedgerException)
@@ -235,6 +259,133 @@ class Accountant:
 
         return d
 
+    def schedule_persist(self):
+        if not self.persist_interval:
+            self.persist()
+        elif self.persist_call is None:
+            self.persist_call = self.callLater(self.persist_interval, self.persist)
+
+    def persist(self):
+        """Write the position changes, fills and trades which have built up
+        to the database, in one transaction. If that fails they are kept to
+        try again.
+        """
+        if self.persist_call is not None:
+            if self.persist_call.active():
+                self.persist_call.cancel()
+            self.persist_call = None
+
+        if not self.position_deltas and not self.fill_deltas and not self.new_trades and not self.trades:
+            return
+
+        position_deltas, self.position_deltas = self.position_deltas, defaultdict(int)
+        fill_deltas, self.fill_deltas = self.fill_deltas, defaultdict(int)
+        new_trades, self.new_trades = self.new_trades, []
+        trades, self.trades = self.trades, []
+
+        try:
+            for (username, ticker), delta in position_deltas.iteritems():
+                position = self.get_position(username, ticker)
+                position.position += delta
+
+            for id, quantity in fill_deltas.iteritems():
+                order = self.session.query(models.Order).get(id)
+                order.quantity_left -= quantity
+
+            # Trades posted before we got to write them go in as posted
+            posted = set(trades)
+            for trade in new_trades:
+                trade.posted = trade in posted
+                self.session.add(trade)
+
+            new = set(new_trades)
+            saved_ids = [trade.id for trade in trades if trade not in new]
+            if saved_ids:
+                trades_table = models.Trade.__table__
+                self.session.execute(trades_table.update().where(
+                    trades_table.c.id.in_(saved_ids)).values(posted=True))
+
+            self.session.commit()
+            log.msg("Persisted %d position changes, %d fills, %d trades and %d posted trades." %
+                    (len(position_deltas), len(fill_deltas), len(new_trades), len(trades)))
+        except Exception as e:
+            self.session.rollback()
+            log.err("Unable to persist position changes, fills and trades: %s" % e)
+            self.alerts_proxy.send_alert("Accountant unable to write to the database. See logs.")
+            for key, delta in position_deltas.iteritems():
+                self.position_deltas[key] += delta
+            for id, quantity in fill_deltas.iteritems():
+                self.fill_deltas[id] += quantity
+            for trade in new_trades:
+                # Let the database number it again
+                trade.id = None
+            self.new_trades[:0] = new_trades
+            self.trades[:0] = trades
+            if self.persist_call is None:
+                self.persist_call = self.callLater(max(self.persist_interval, 1), self.persist)
+            return
+
+        for trade in trades:
+            self.webserver.trade(trade.contract.ticker, trade.to_webserver())
+            log.msg("to ws: " + str({"trade": [trade.contract.ticker, trade.to_webserver()]}))
+
+    def record_fill(self, order, other_order, price, quantity, aggressive):
+        """Take a fill off the order, and for the aggressive side make the
+        trade. Like position changes, they are written by persist(), and
+        rebuilt from the ledger by repair_fills() if we crash before that.
+
+        :returns: tuple -- the order and the trade, the trade being None for
+            the passive side, or (None, None) if the orders are not there
+        """
+        trade = None
+        try:
+            db_order = self.get_order(order)
+            if aggressive:
+                # The passive order may belong to another accountant, but we
+                # only need its id and timestamp, which do not change
+                passive_order = self.orders.get(other_order) or \
+                        self.session.query(models.Order).get(other_order)
+                trade = models.Trade(db_order, passive_order, price, quantity)
+        except Exception as e:
+            self.session.rollback()
+            log.err("Unable to record fill of %d on order %d: %s" % (quantity, order, e))
+            self.alerts_proxy.send_alert("Accountant unable to record a fill. See logs.")
+            return None, None
+
+        self.fill_deltas[order] += quantity
+        if trade is not None:
+            self.new_trades.append(trade)
+        self.schedule_persist()
+        log.msg("Fill of %d on order %d recorded" % (quantity, order))
+
+        if self.get_quantity_left(db_order) <= 0:
+            self.orders.pop(order, None)
+        return db_order, trade
+
+    def get_quantity_left(self, order):
+        """
+        :param order: the order
+        :type order: models.Order
+        :returns: int -- what is left of the order, with the fills we have
+            not written yet taken off
+        """
+        return order.quantity_left - self.fill_deltas.get(order.id, 0)
+
+    def order_to_webserver(self, order):
+        """order.to_webserver(), with the fills we have not written yet taken
+        off what is left of it
+        """
+        order_webserver = order.to_webserver()
+        order_webserver["quantity_left"] = self.get_quantity_left(order)
+        return order_webserver
+
+    def get_pending_postings(self, username, tickers):
+        """
+        :returns: int -- how many postings we are waiting on the ledger for
+            for the user in these contracts
+        """
+        return sum(self.pending_postings.get((username, ticker), 0) for ticker in tickers)
+
     def get_user(self, username):
         """Return the User object corresponding to the username.
 
@@ -247,12 +398,35 @@ class Accountant:
         if isinstance(username, models.User):
             return username
 
+        user = self.users.get(username)
+        if user is not None and user in self.session:
+            return user
+
         try:
-            return self.session.query(models.User).filter_by(
+            user = self.session.query(models.User).filter_by(
                 username=username).one()
         except NoResultFound:
             raise NO_SUCH_USER
 
+        self.users[username] = user
+        return user
+
+    def get_order(self, id):
+        """Return one of our open orders.
+
+        :param id: the order id
+        :type id: int
+        :returns: models.Order -- the order
+        :raises: NoResultFound
+        """
+        order = self.orders.get(id)
+        if order is not None and order in self.session:
+            return order
+
+        order = self.session.query(models.Order).filter_by(id=id).one()
+        self.orders[id] = order
+        return order
+
     def get_contract(self, ticker):
         """
         Return the Contract object corresponding to the ticker.
@@ -261,11 +435,22 @@ class Accountant:
         :returns: models.Contract -- the Contract object matching the ticker
         :raises: AccountantException
         """
+        if isinstance(ticker, models.Contract):
+            return ticker
+
+        contract = self.contracts.get(ticker)
+        if contract is not None and contract in self.session:
+            return contract
+
         try:
-            return util.get_contract(self.session, ticker)
+            contract = util.get_contract(self.session, ticker)
         except:
             raise AccountantException("No such contract: '%s'." % ticker)
 
+        if contract is not None:
+            self.contracts[ticker] = contract
+        return contract
+
     def adjust_position(self, username, ticker, quantity, admin_username):
         """Adjust a user's position, offsetting with the 'adjustment' account
 
@@ -308,15 +493,48 @@ class Accountant:
         """
         user = self.get_user(username)
         contract = self.get_contract(ticker)
+        delta = self.position_deltas.get((user.username, contract.ticker), 0)
+        position = self.positions.get((user.username, contract.id))
+        if position is not None and position in self.session:
+            return position.position + delta
+
         try:
-            return self.session.query(models.Position).filter_by(
-                user=user, contract=contract).one().position
+            position = self.session.query(models.Position).filter_by(
+                user=user, contract=contract).one()
         except NoResultFound:
-            return 0
+            return delta
 
-    def get_margin(self, username):
+        self.positions[(user.username, contract.id)] = position
+        return position.position + delta
+
+    def get_margin_state(self, username):
+        """Return the margin state of a user. The first time, it is loaded
+        from the database along with the changes we have not persisted yet.
+
+        :param username: the username
+        :type username: str, models.User
+        :returns: margin.MarginState
+        """
         user = self.get_user(username)
-        low_margin, high_margin, cash_spent = margin.calculate_margin(user, self.session, safe_prices=self.safe_prices)
+        state = self.margins.get(user.username)
+        if state is not None:
+            return state
+
+        state = margin.MarginState(user, trial_period=self.trial_period)
+        for position in self.session.query(models.Position).filter_by(user=user):
+            state.set_position(position.contract, position.position, position.reference_price)
+        for (delta_username, ticker), delta in self.position_deltas.iteritems():
+            if delta_username == user.username:
+                state.adjust_position(self.get_contract(ticker), delta)
+        for order in self.session.query(models.Order).filter_by(user=user).filter(
+                models.Order.quantity_left > 0).filter_by(is_cancelled=False, accepted=True):
+            state.add_order(order, self.get_quantity_left(order))
+
+        self.margins[user.username] = state
+        return state
+
+    def get_margin(self, username):
+        low_margin, high_margin, cash_spent = self.get_margin_state(username).margin(self.safe_prices)
         cash_position = self.get_position_value(username, 'BTC')
         return {
             'username': username,
@@ -339,21 +557,28 @@ class Accountant:
 
         user = self.get_user(username)
         contract = self.get_contract(ticker)
+        key = (user.username, contract.id)
 
-        try:
-            position = self.session.query(models.Position).filter_by(
-                user=user, contract=contract).one()
-            if position.reference_price is None and reference_price is not None:
-                position.reference_price = reference_price
+        # a position we created is dropped from the session if it is rolled
+        # back before it was committed, so make sure it is still there
+        position = self.positions.get(key)
+        if position is None or position not in self.session:
+            try:
+                position = self.session.query(models.Position).filter_by(
+                    user=user, contract=contract).one()
+            except NoResultFound:
+                log.msg("Creating new position for %s on %s." %
+                              (username, contract))
+                position = models.Position(user, contract)
                 self.session.add(position)
-            return position
-        except NoResultFound:
-            log.msg("Creating new position for %s on %s." %
-                          (username, contract))
-            position = models.Position(user, contract)
+            self.positions[key] = position
+
+        if position.reference_price is None and reference_price is not None:
             position.reference_price = reference_price
             self.session.add(position)
-            return position
+            if user.username in self.margins:
+                self.margins[user.username].set_reference_price(contract, reference_price)
+        return position
 
     def check_margin(self, user, low_margin, high_margin):
         cash = self.get_position_value(user, "BTC")
@@ -398,10 +623,10 @@ class Accountant:
         cash_position = self.get_position_value(position.username, position.contract.denominated_contract)
         cash_override = {position.contract.denominated_contract_ticker: cash_position - cash_spent}
 
-        margin_current = margin.calculate_margin(position.user, self.session, self.safe_prices)
-        margin_if = margin.calculate_margin(position.user, self.session, self.safe_prices,
-                                                                      position_overrides=position_override,
-                                                                      cash_overrides=cash_override)
+        state = self.get_margin_state(position.username)
+        margin_current = state.margin(self.safe_prices)
+        margin_if = state.margin(self.safe_prices, position_overrides=position_override,
+                                 cash_overrides=cash_override)
         margin_change = margin_current[0] - margin_if[0]
         cost = (best_ask - best_bid)/2.0
 
@@ -418,14 +643,15 @@ class Accountant:
         def after_cancellations(results):
             log.msg("Cancels done for %s" % username)
             # Wait for pending postings
-            total_pending = self.session.query(func.sum(models.Position.pending_postings).label("total_pending")).join(
-                models.Contract).filter(
-                models.Position.username==username).filter(
-                models.Contract.contract_type.in_(["futures", "prediction"])).one().total_pending
+            tickers = [ticker for (pending_username, ticker) in self.pending_postings
+                       if pending_username == user.username and
+                       self.get_contract(ticker).contract_type in ["futures", "prediction"]]
+            total_pending = self.get_pending_postings(user.username, tickers)
             if total_pending > 0:
                 d = task.deferLater(reactor, 300, after_cancellations, results)
                 return d
             else:
+                self.persist()
                 # Now figure out what order to place
                 quantity = 1
                 positions = self.session.query(models.Position).join(models.Contract).filter(models.Position.username==username).filter(
@@ -434,7 +660,8 @@ class Accountant:
                 deferreds = []
                 for position in positions:
                     if position.contract.ticker not in order_books:
-                        d = self.engines[position.contract.ticker].get_order_book()
+                        # Only the best bid and ask are needed for the liquidation value
+                        d = self.engines[position.contract.ticker].get_order_book(depth=1)
                         def got_book(book, ticker):
                             order_books[ticker] = book
                             return (ticker, book)
@@ -533,17 +760,18 @@ class Accountant:
         def after_cancellations(results):
             log.msg("Cancels for %s / %s done" % (username, ticker))
             # Wait until all pending postings have gone through
+            if self.get_pending_postings(user.username, [contract.ticker]) > 0:
+                return task.deferLater(reactor, 300, after_cancellations, results)
+
+            self.persist()
             try:
                 position = self.session.query(models.Position).filter_by(user=user, contract=contract).one()
             except NoResultFound:
                 # There is no position, return None
                 return None
 
-            if position.pending_postings > 0:
-                d = task.deferLater(reactor, 300, after_cancellations, results)
-            else:
-                # Now place a closing out order
-                return self.place_liquidation_order(position)
+            # Now place a closing out order
+            return self.place_liquidation_order(position)
 
 
         d.addCallback(after_cancellations)
@@ -584,9 +812,8 @@ class Accountant:
                     self.session.rollback()
                 raise TRADE_NOT_PERMITTED
 
-            low_margin, high_margin, max_cash_spent = margin.calculate_margin(
-                order.user, self.session, self.safe_prices, order.id,
-                trial_period=self.trial_period)
+            low_margin, high_margin, max_cash_spent = self.get_margin_state(user).margin(
+                self.safe_prices, orders=[order])
 
             if not self.check_margin(order.user, low_margin, high_margin):
                 log.msg("Order rejected due to margin.")
@@ -603,6 +830,8 @@ class Accountant:
 
         log.msg("Order accepted.")
         order.accepted = True
+        if user.username in self.margins:
+            self.margins[user.username].add_order(order)
         try:
             # self.session.merge(order)
             self.session.commit()
@@ -611,6 +840,40 @@ class Accountant:
         finally:
             self.session.rollback()
 
+    def accept_orders(self, user, orders, force=False):
+        """Accept a batch of orders from one user with a single margin check.
+        The caller is responsible for committing or rolling back.
+
+        :param user: the user who placed the orders
+        :type user: models.User
+        :param orders: the orders we wish to accept, already flushed to the session
+        :type orders: list
+        :raises: DISABLED_USER, INSUFFICIENT_MARGIN, TRADE_NOT_PERMITTED
+        """
+        if not force:
+            if not self.is_user_enabled(user):
+                log.msg("%s user is disabled" % user.username)
+                raise DISABLED_USER
+
+            if not user.permissions.trade:
+                log.msg("orders not accepted because user %s not permitted to trade" % user.username)
+                raise TRADE_NOT_PERMITTED
+
+            low_margin, high_margin, max_cash_spent = self.get_margin_state(user).margin(
+                self.safe_prices, orders=orders)
+
+            if not self.check_margin(user, low_margin, high_margin):
+                log.msg("Orders rejected due to margin.")
+                raise INSUFFICIENT_MARGIN
+        else:
+            log.msg("Forcing orders")
+
+        log.msg("%d orders accepted." % len(orders))
+        for order in orders:
+            order.accepted = True
+            if user.username in self.margins:
+                self.margins[user.username].add_order(order)
+
     def charge_fees(self, fees, user, type="Trade"):
         """Credit fees to the people operating the exchange
         :param fees: The fees to charge ticker-index dict of fees to charge
@@ -736,9 +999,9 @@ class Accountant:
                 position = self.get_position(user, contract, price)
                 cash_spent = util.get_cash_spent(contract, price - position.reference_price, quantity)
 
-                # Make sure the position goes into the db with this reference price
-                self.session.add(position)
-                self.session.commit()
+                # Make sure a new position goes into the db with this reference price
+                if position.id is None:
+                    self.session.commit()
             except Exception as e:
                 self.session.rollback()
                 log.err("Unable to add position %s to db" % position)
@@ -787,34 +1050,24 @@ class Accountant:
         for posting in remote_postings:
             self.accountant_proxy.remote_post(posting["username"], posting)
 
-        if aggressive:
-            try:
-                aggressive_order = self.session.query(models.Order).filter_by(id=order).one()
-                passive_order = self.session.query(models.Order).filter_by(id=other_order).one()
-
-                trade = models.Trade(aggressive_order, passive_order, price, quantity)
-                self.session.add(trade)
-                self.session.commit()
-                log.msg("Trade saved to db with posted=false: %s" % trade)
-            except Exception as e:
-                self.session.rollback()
-                log.err("Exception while creating trade: %s" % e)
+        db_order, trade = self.record_fill(order, other_order, price, quantity, aggressive)
 
         d = self.post_or_fail(*postings)
 
+        # The trade is marked as posted, and published, by persist()
+        def trade_posted(result):
+            if trade is not None:
+                self.trades.append(trade)
+                self.schedule_persist()
+            return result
+
         def update_order(result):
-            try:
-                db_order = self.session.query(models.Order).filter_by(id=order).one()
-                db_order.quantity_left -= quantity
-                # self.session.add(db_order)
-                self.session.commit()
-                log.msg("Updated order: %s" % db_order)
-            except Exception as e:
-                self.session.rollback()
-                log.err("Unable to update order: %s" % e)
+            if username in self.margins:
+                self.margins[username].fill_order(order, quantity)
+            if db_order is not None:
+                self.webserver.order(username, self.order_to_webserver(db_order))
+                log.msg("to ws: " + str({"order": [username, self.order_to_webserver(db_order)]}))
 
-            self.webserver.order(username, db_order.to_webserver())
-            log.msg("to ws: " + str({"order": [username, db_order.to_webserver()]}))
             return result
 
         def notify_fill(result):
@@ -849,26 +1102,11 @@ class Accountant:
                                                                                  user.nickname),
                                       subject='Order fill notification')
 
-        def publish_trade(result):
-            try:
-                trade.posted = True
-                # self.session.add(trade)
-                self.session.commit()
-                log.msg("Trade marked as posted: %s" % trade)
-            except Exception as e:
-                self.session.rollback()
-                log.err("Exception when marking trade as posted %s" % e)
-
-            self.webserver.trade(ticker, trade.to_webserver())
-            log.msg("to ws: " + str({"trade": [ticker, trade.to_webserver()]}))
-            return result
-
-
         # TODO: add errbacks for these
+        if aggressive:
+            d.addCallback(trade_posted)
         d.addBoth(update_order)
         d.addCallback(notify_fill)
-        if aggressive:
-            d.addCallback(publish_trade)
 
         # The engine doesn't care to receive errors
         return d.addErrback(log.err)
@@ -899,6 +1137,9 @@ class Accountant:
         d = self.engines[order.contract.ticker].cancel_order(order_id)
 
         def update_order(result):
+            # Write its fills first, so a cancelled order has them all
+            self.persist()
+            self.forget_order(order.username, order_id)
             try:
                 order.is_cancelled = True
                 # self.session.add(order)
@@ -919,6 +1160,77 @@ class Accountant:
         d.addErrback(self.raiseException)
         return d
 
+    def cancel_orders(self, username, ids):
+        """Cancel several orders by id, with one engine call per contract.
+        The orders of each contract are marked cancelled as soon as its
+        engine replies, so one engine failing does not hold up the others.
+
+        :param ids: The order ids to cancel
+        :type ids: list
+        :returns: Deferred -- list of engine results, in the same order as
+            ids, or fails with the ids that could not be cancelled
+        """
+        log.msg("Received request to cancel order ids %s." % ids)
+
+        orders = {order.id: order for order in
+                  self.session.query(models.Order).filter(models.Order.id.in_(ids))}
+
+        ids_by_ticker = {}
+        for order_id in ids:
+            if order_id not in orders:
+                raise NO_ORDER_FOUND
+
+            order = orders[order_id]
+            if username is not None and order.username != username:
+                raise USER_ORDER_MISMATCH
+
+            if order.is_cancelled:
+                raise ORDER_CANCELLED
+
+            ids_by_ticker.setdefault(order.contract.ticker, []).append(order_id)
+
+        results = {}
+        failed = []
+
+        def update_orders(engine_results, contract_ids):
+            # Write their fills first, so a cancelled order has them all
+            self.persist()
+            for order_id in contract_ids:
+                self.forget_order(orders[order_id].username, order_id)
+            try:
+                for order_id in contract_ids:
+                    orders[order_id].is_cancelled = True
+                self.session.commit()
+            except Exception as e:
+                self.session.rollback()
+                log.err("Unable to commit order cancellations")
+                raise e
+
+            for order_id in contract_ids:
+                self.webserver.order(orders[order_id].username, orders[order_id].to_webserver())
+            results.update(zip(contract_ids, engine_results))
+
+        def cancel_failure(failure, ticker, contract_ids):
+            log.err(failure, "Unable to cancel orders %s for %s" % (contract_ids, ticker))
+            failed.extend(contract_ids)
+
+        deferreds = []
+        for ticker, contract_ids in ids_by_ticker.iteritems():
+            d = self.engines[ticker].cancel_orders(contract_ids)
+            d.addCallback(update_orders, contract_ids)
+            d.addErrback(cancel_failure, ticker, contract_ids)
+            deferreds.append(d)
+
+        def report(ignored):
+            if failed:
+                raise AccountantException("exceptions/accountant/cancel_failed",
+                                          [order_id for order_id in ids if order_id in failed])
+            return [results[order_id] for order_id in ids]
+
+        d = defer.DeferredList(deferreds)
+        d.addCallback(report)
+        return d
+
     def cancel_order_engine(self, username, id):
         log.msg("Received msg from engine to cancel order id %d" % id)
 
@@ -940,6 +1252,9 @@ class Accountant:
         if not order.dispatched:
             self.engines[order.contract.ticker].cancel_order(order.id)
 
+        # Write its fills first, so a cancelled order has them all
+        self.persist()
+        self.forget_order(order.username, id)
         try:
             order.is_cancelled = True
             # self.session.add(order)
@@ -952,19 +1267,25 @@ class Accountant:
         self.webserver.order(username, order.to_webserver())
 
 
-    def place_order(self, username, order, force=False):
-        """Place an order
+    def forget_order(self, username, id):
+        """Take an order which is no longer on the book out of the user's margin.
+        """
+        self.orders.pop(id, None)
+        if username in self.margins:
+            self.margins[username].remove_order(id)
+
+    def validate_order(self, order, contract, force=False):
+        """Check that an order may be placed on a contract
 
         :param order: dictionary representing the order to be placed
         :type order: dict
-        :returns: tuple -- (True/False, Result/Error)
+        :param contract: the contract of the order
+        :type contract: models.Contract
+        :raises: CONTRACT_CLEARING, CONTRACT_NOT_ACTIVE, CONTRACT_EXPIRED, INVALID_CONTRACT_TYPE, INVALID_PRICE_QUANTITY
         """
         if order["contract"] in self.clearing_contracts:
             raise CONTRACT_CLEARING
 
-        user = self.get_user(order["username"])
-        contract = self.get_contract(order["contract"])
-
         if not force:
             if not contract.active:
                 raise CONTRACT_NOT_ACTIVE
@@ -992,6 +1313,17 @@ class Accountant:
         else:
             log.msg("Forcing order")
 
+    def place_order(self, username, order, force=False):
+        """Place an order
+
+        :param order: dictionary representing the order to be placed
+        :type order: dict
+        :returns: tuple -- (True/False, Result/Error)
+        """
+        user = self.get_user(order["username"])
+        contract = self.get_contract(order["contract"])
+        self.validate_order(order, contract, force=force)
+
         o = models.Order(user, contract, order["quantity"], order["price"], order["side"].upper(),
                          timestamp=util.timestamp_to_dt(order['timestamp']))
         try:
@@ -1003,6 +1335,7 @@ class Accountant:
             raise e
 
         self.accept_order(o, force=force)
+        self.orders[o.id] = o
         d = self.engines[o.contract.ticker].place_order(o.to_matching_engine_order())
 
         def mark_order_dispatched(result):
@@ -1026,6 +1359,78 @@ class Accountant:
 
         return o.id
 
+    def place_orders(self, username, orders, force=False):
+        """Place several orders for one user at once
+
+        The orders are checked against the margin together and committed in a
+        single transaction, then sent to each engine in a single call. If any
+        order is rejected, none of them are placed.
+
+        :param orders: list of dictionaries representing the orders to be placed
+        :type orders: list
+        :returns: list -- the ids of the new orders, in the same order
+        """
+        user = self.get_user(username)
+
+        # Check every order before creating any, so a bad order leaves nothing behind
+        contracts = []
+        for order in orders:
+            if order["username"] != user.username:
+                raise USER_ORDER_MISMATCH
+
+            contract = self.get_contract(order["contract"])
+            self.validate_order(order, contract, force=force)
+            contracts.append(contract)
+
+        if not orders:
+            return []
+
+        new_orders = [models.Order(user, contract, order["quantity"], order["price"], order["side"].upper(),
+                                   timestamp=util.timestamp_to_dt(order['timestamp']))
+                      for order, contract in zip(orders, contracts)]
+
+        try:
+            self.session.add_all(new_orders)
+            # Assign the order ids so the margin calculation can find them
+            self.session.flush()
+            self.accept_orders(user, new_orders, force=force)
+            self.session.commit()
+        except Exception as e:
+            log.err("Unable to place orders: %s" % e)
+            self.session.rollback()
+            # The orders may have been counted in the margin before the commit failed
+            self.margins.pop(user.username, None)
+            raise e
+
+        orders_by_ticker = {}
+        for o in new_orders:
+            self.orders[o.id] = o
+            orders_by_ticker.setdefault(o.contract.ticker, []).append(o)
+
+        def mark_orders_dispatched(result, contract_orders):
+            try:
+                for o in contract_orders:
+                    o.dispatched = True
+                self.session.commit()
+            except:
+                self.alerts_proxy.send_alert("Could not mark orders as dispatched: %s" % contract_orders)
+            finally:
+                self.session.rollback()
+            return result
+
+        def publish_orders(result, contract_orders):
+            for o in contract_orders:
+                self.webserver.order(username, o.to_webserver())
+            return result
+
+        for ticker, contract_orders in orders_by_ticker.iteritems():
+            d = self.engines[ticker].place_orders([o.to_matching_engine_order() for o in contract_orders])
+            d.addErrback(self.raiseException)
+            d.addCallback(mark_orders_dispatched, contract_orders)
+            d.addCallback(publish_orders, contract_orders)
+
+        return [o.id for o in new_orders]
+
     def transfer_position(self, username, ticker, direction, quantity, note, uid):
         """Transfer a position from one user to another
 
@@ -1043,6 +1448,11 @@ class Accountant:
         posting['count'] = 2
         posting['uid'] = uid
 
+        if not self.owns_user(username):
+            # The user has been moved and the caller does not know yet
+            self.accountant_proxy.remote_post(username, posting)
+            return defer.succeed(None)
+
         def transferFailure(failure):
             log.err(failure)
             return failure
@@ -1083,10 +1493,8 @@ class Accountant:
                 raise DISABLED_USER
 
             # Check margin now
-            low_margin, high_margin, max_cash_spent = margin.calculate_margin(user,
-                    self.session, self.safe_prices,
-                    withdrawals={ticker:amount},
-                    trial_period=self.trial_period)
+            low_margin, high_margin, max_cash_spent = self.get_margin_state(user).margin(
+                    self.safe_prices, withdrawals={ticker:amount})
             if not self.check_margin(username, low_margin, high_margin):
                 log.msg("Insufficient margin for withdrawal %d / %d" % (low_margin, high_margin))
                 raise INSUFFICIENT_MARGIN
@@ -1163,6 +1571,7 @@ class Accountant:
         :param total: if True, then received is the total received on that address. If false, then received is just the most recent receipt
         :type total: bool
         """
+        self.check_owner(username)
         try:
             log.msg('received %d at %s - total=%s' % (received, address, total))
 
@@ -1300,8 +1709,9 @@ class Accountant:
     def disable_user(self, user):
         user = self.get_user(user)
         log.msg("Disabling user: %s" % user.username)
-        self.cancel_user_orders(user)
+        d = self.cancel_user_orders(user)
         self.disabled_users[user.username] = True
+        return d
 
     def enable_user(self, user):
         user = self.get_user(user)
@@ -1326,24 +1736,161 @@ class Accountant:
         return self.cancel_many_orders(orders)
 
     def cancel_many_orders(self, orders):
-        deferreds = []
+        """Cancel many orders with a single engine call per contract. Failed
+        calls are retried, which is safe because the engine skips orders
+        that are no longer on the book.
+
+        :param orders: the orders to cancel
+        :type orders: iterable of models.Order
+        :returns: Deferred
+        """
+        orders_by_ticker = {}
         for order in orders:
-            log.msg("Cancelling user %s order %d" % (order.username, order.id))
-            d = self.cancel_order(order.username, order.id)
+            orders_by_ticker.setdefault(order.contract.ticker, []).append(order)
+
+        def update_orders(result, contract_orders):
+            # Write their fills first, so a cancelled order has them all
+            self.persist()
+            try:
+                for order in contract_orders:
+                    self.forget_order(order.username, order.id)
+                    order.is_cancelled = True
+                self.session.commit()
+            except Exception as e:
+                self.session.rollback()
+                log.err("Unable to commit order cancellations")
+                raise e
+
+            for order in contract_orders:
+                self.webserver.order(order.username, order.to_webserver())
+            return result
+
+        def cancel_contract_orders(ticker, contract_orders):
+            log.msg("Cancelling %d orders for %s" % (len(contract_orders), ticker))
+            d = self.engines[ticker].mass_cancel(ids=[order.id for order in contract_orders])
+            d.addCallback(update_orders, contract_orders)
 
             def cancel_failure(failure):
                 log.err(failure)
                 # Try again?
-                log.msg("Trying again-- Cancelling user %s order %d" % (order.username, order.id))
-                d = self.cancel_order(order.username, order.id)
-                d.addErrback(cancel_failure)
-                return d
+                log.msg("Trying again-- Cancelling %d orders for %s" % (len(contract_orders), ticker))
+                return cancel_contract_orders(ticker, contract_orders)
 
             d.addErrback(cancel_failure)
-            deferreds.append(d)
+            return d
 
+        deferreds = [cancel_contract_orders(ticker, contract_orders)
+                     for ticker, contract_orders in orders_by_ticker.iteritems()]
         return defer.DeferredList(deferreds)
 
+    def owns_user(self, username):
+        return self.accountant_proxy.get_accountant_for_user(username) == self.accountant_number
+
+    def check_owner(self, username):
+        """Turn away a user who has been moved to another accountant, for
+        the components which have not noticed yet.
+
+        :raises: DISABLED_USER
+        """
+        if not self.owns_user(username):
+            log.err("User %s is not ours" % username)
+            raise DISABLED_USER
+
+    def forget_user(self, username):
+        """Drop everything we have cached about a user, so that it is read
+        from the database again if we need it.
+        """
+        self.users.pop(username, None)
+        for key in [key for key in self.positions if key[0] == username]:
+            del self.positions[key]
+        for id in [id for id, order in self.orders.iteritems() if order.username == username]:
+            del self.orders[id]
+        self.margins.pop(username, None)
+        self.disabled_users.pop(username, None)
+
+    def reload_shards(self):
+        """Pick up the users moved between accountants. The ones which have
+        come to us may have been ours before, so we forget what we knew.
+        """
+        for username in self.accountant_proxy.load_shards(self.session):
+            if self.owns_user(username):
+                log.msg("User %s has moved to us" % username)
+                self.forget_user(username)
+
+    def migrate_user(self, username, accountant):
+        """Hand a user over to another accountant without stopping anything.
+
+        The user is disabled and their orders cancelled, then once the
+        ledger has come back on all of their postings and their positions
+        are in the database, they are pinned to the new accountant and
+        every accountant is told to reload the shard map. The other
+        components pick it up within [accountant] shard_refresh_interval,
+        and until then the user stays disabled here and postings for them
+        are passed on.
+
+        :param username: the user
+        :type username: str, models.User
+        :param accountant: the accountant to move them to
+        :type accountant: int
+        :returns: Deferred -- fires with the new accountant
+        """
+        user = self.get_user(username)
+        if not self.owns_user(user.username):
+            raise AccountantException("User %s is not ours to move" % user.username)
+        if accountant == self.accountant_number:
+            return defer.succeed(accountant)
+        if not 0 <= accountant < self.accountant_proxy.num_procs:
+            raise AccountantException("No such accountant: %d" % accountant)
+
+        log.msg("Moving %s to accountant %d" % (user.username, accountant))
+
+        def drained(result=None):
+            if any(key[0] == user.username for key in self.pending_postings):
+                log.msg("Waiting on the ledger for %s" % user.username)
+                d = defer.Deferred()
+                self.callLater(1, d.callback, None)
+                return d.addCallback(drained)
+
+            self.persist()
+            if any(key[0] == user.username for key in self.position_deltas):
+                raise AccountantException("Unable to persist %s" % user.username)
+            return hand_over()
+
+        def hand_over():
+            try:
+                shard = self.session.query(models.AccountantShard).filter_by(username=user.username).first()
+                if accountant == self.accountant_proxy.shards.ring_accountant_for(user.username):
+                    if shard is not None:
+                        self.session.delete(shard)
+                elif shard is None:
+                    self.session.add(models.AccountantShard(user.username, accountant))
+                else:
+                    shard.accountant = accountant
+                self.session.commit()
+            except Exception as e:
+                self.session.rollback()
+                log.err("Unable to move %s: %s" % (user.username, e))
+                raise e
+
+            self.reload_shards()
+            self.accountant_proxy.reload_shards(None)
+            self.forget_user(user.username)
+            self.disabled_users[user.username] = True
+            log.msg("Moved %s to accountant %d" % (user.username, accountant))
+            return accountant
+
+        def failed(failure):
+            log.err(failure)
+            if was_enabled:
+                self.enable_user(user.username)
+            return failure
+
+        was_enabled = self.is_user_enabled(user)
+        d = self.disable_user(user)
+        d.addCallback(drained)
+        d.addErrback(failed)
+        return d
+
     def get_my_users(self):
         users = self.session.query(models.User)
         my_users = []
@@ -1353,17 +1900,150 @@ class Accountant:
 
         return my_users
 
-    def repair_user_positions(self):
+    def repair_user_positions(self, check_ledger=False):
+        """Recalculate positions from the ledger for users who might have
+        postings which did not make it into their positions.
+
+        :param check_ledger: also repair the users whose positions differ
+            from the ledger, write the fills and trades the ledger has and
+            mark them as posted, for when we did not shut down cleanly and
+            so may not have persisted everything
+        :type check_ledger: bool
+        """
+        mismatched_users = self.get_mismatched_users() if check_ledger else set()
         my_users = self.get_my_users()
         for user in my_users:
             log.msg("Checking user %s" % user.username)
+            if user.username in mismatched_users:
+                self.repair_user_position(user)
+                continue
             for position in user.positions:
                 if position.pending_postings > 0:
                     self.repair_user_position(user)
-                    return
+                    break
 
+        if check_ledger:
+            self.repair_fills()
+            self.repair_trades()
         log.msg("All users checked")
 
+    def get_mismatched_users(self):
+        """
+        :returns: set -- the users with a position which is not what the
+            ledger says it should be
+        """
+        calculated = self.session.query(func.coalesce(func.sum(models.Posting.quantity), 0)).filter(
+            models.Posting.journal_id == models.Journal.id).filter(
+            models.Posting.username == models.Position.username).filter(
+            models.Posting.contract_id == models.Position.contract_id).filter(
+            or_(models.Position.position_cp_timestamp == None,
+                models.Journal.timestamp > models.Position.position_cp_timestamp)).correlate(
+            models.Position).as_scalar()
+        try:
+            rows = self.session.query(models.Position.username).filter(
+                models.Position.position != func.coalesce(models.Position.position_checkpoint, 0) + calculated)
+            return set(row.username for row in rows)
+        finally:
+            self.session.rollback()
+
+    def repair_fills(self):
+        """Write the fills and trades which made it into the ledger before we
+        crashed, but which persist() had not written yet. Each fill is posted
+        in one journal entry for both sides, with the payout postings noted
+        with the ids of the orders, and trades are at the passive order's
+        price. Orders are only cancelled once their fills are written, so it
+        is just the open ones which can be behind. Fills which did not make it
+        into the ledger either have still been taken off the book, which the
+        engine keeps in its own journal.
+        """
+        orders = [order for order in self.session.query(models.Order).filter(
+            models.Order.quantity_left > 0).filter_by(is_cancelled=False, accepted=True)
+                  if self.owns_user(order.username)]
+        notes = {}
+        for order in orders:
+            notes["Aggressive order: %d" % order.id] = order
+            notes["Passive order: %d" % order.id] = order
+        if not notes:
+            return
+
+        try:
+            filled = defaultdict(int)
+            # (journal id, quantity) for each fill of the orders as aggressive orders
+            fills = defaultdict(list)
+            for journal_id, username, contract_id, note, quantity in self.session.query(
+                    models.Posting.journal_id, models.Posting.username, models.Posting.contract_id,
+                    models.Posting.note, models.Posting.quantity).filter(models.Posting.note.in_(notes.keys())):
+                order = notes[note]
+                contract = order.contract
+                payout_contract = contract if contract.contract_type == "futures" else contract.payout_contract
+                if username != order.username or contract_id != payout_contract.id:
+                    continue
+                filled[order.id] += abs(quantity)
+                if note.startswith("Aggressive"):
+                    fills[order.id].append((journal_id, abs(quantity)))
+
+            passive_ids = {}
+            journal_ids = [journal_id for order_fills in fills.itervalues() for journal_id, quantity in order_fills]
+            if journal_ids:
+                for journal_id, note in self.session.query(models.Posting.journal_id, models.Posting.note).filter(
+                        models.Posting.journal_id.in_(journal_ids)).filter(
+                        models.Posting.note.like("Passive order: %")):
+                    passive_ids[journal_id] = int(note.split(": ")[1])
+
+            for order in orders:
+                quantity_left = order.quantity - filled[order.id]
+                if quantity_left < order.quantity_left:
+                    log.msg("Order %d has %d left, not %d" % (order.id, quantity_left, order.quantity_left))
+                    order.quantity_left = quantity_left
+
+                if not fills[order.id]:
+                    continue
+                in_ledger = Counter((passive_ids.get(journal_id), quantity) for journal_id, quantity in fills[order.id])
+                saved = Counter((trade.passive_order_id, trade.quantity) for trade in
+                                self.session.query(models.Trade).filter_by(aggressive_order_id=order.id))
+                for (passive_id, quantity), count in (in_ledger - saved).iteritems():
+                    passive_order = self.session.query(models.Order).get(passive_id) if passive_id else None
+                    if passive_order is None:
+                        log.err("No passive order for %d fills of %d on order %d" % (count, quantity, order.id))
+                        continue
+                    for i in range(count):
+                        trade = models.Trade(order, passive_order, passive_order.price, quantity)
+                        trade.posted = True
+                        self.session.add(trade)
+                        log.msg("Adding trade of %d on orders %d and %d" % (quantity, order.id, passive_order.id))
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            log.err("Unable to repair fills: %s" % e)
+
+    def repair_trades(self):
+        """Mark as posted the trades whose postings made it into the ledger
+        before we crashed, but which we had not marked yet. The ledger has
+        one posting per fill for the aggressive order, noted with its id.
+        """
+        unposted = defaultdict(list)
+        for trade in self.session.query(models.Trade).filter_by(posted=False).order_by(models.Trade.id):
+            unposted[trade.aggressive_order].append(trade)
+
+        try:
+            for order, trades in unposted.iteritems():
+                if not self.owns_user(order.username):
+                    continue
+                contract = order.contract
+                payout_contract = contract if contract.contract_type == "futures" else contract.payout_contract
+                in_ledger = self.session.query(models.Posting).filter_by(
+                    username=order.username, contract_id=payout_contract.id,
+                    note="Aggressive order: %d" % order.id).count()
+                marked = self.session.query(models.Trade).filter_by(
+                    aggressive_order_id=order.id, posted=True).count()
+                for trade in trades[:max(in_ledger - marked, 0)]:
+                    log.msg("Marking %s as posted" % trade)
+                    trade.posted = True
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            log.err("Unable to repair trades: %s" % e)
+
     def repair_user_position(self, user):
         user = self.get_user(user)
         log.msg("Repairing position for %s" % user.username)
@@ -1384,11 +2064,12 @@ class Accountant:
     def check_user(self, user):
         user = self.get_user(user)
         clean = True
+        self.persist()
         try:
             for position in user.positions:
-                if position.pending_postings == 0:
+                if self.get_pending_postings(user.username, [position.contract.ticker]) == 0:
                     # position has settled, sync with ledger
-                    position.position, position.cp_timestamp = util.position_calculated(position, self.session)
+                    position.position, position.position_cp_timestamp = util.position_calculated(position, self.session)
                     position.position_checkpoint = position.position
                     # self.session.add(position)
                 else:
@@ -1396,6 +2077,7 @@ class Accountant:
             if clean:
                 log.msg("Correcting positions for user %s: %s" % (user.username, user.positions))
                 self.session.commit()
+                self.margins.pop(user.username, None)
                 self.enable_user(user)
             else:
                 # don't both committing, we are not ready yet anyway
@@ -1452,11 +2134,11 @@ class Accountant:
         def after_cancellations(results):
             log.msg("Cancels done for %s" % ticker)
             # Wait until all pending postings have gone through
-            total_pending = self.session.query(func.sum(models.Position.pending_postings).label('total_pending')).filter_by(contract=contract).filter(
-                models.Position.username.in_(my_users)).one().total_pending
+            total_pending = sum(self.get_pending_postings(username, [ticker]) for username in my_users)
             if total_pending > 0:
                 d = task.deferLater(reactor, 300, after_cancellations, results)
             else:
+                self.persist()
                 all_positions = self.session.query(models.Position).filter_by(contract=contract)
                 position_count = all_positions.count()
                 my_positions = all_positions.filter(models.Position.username.in_(my_users))
@@ -1477,16 +2159,22 @@ class Accountant:
     def reload_fee_group(self, id):
         group = self.session.query(models.FeeGroup).filter_by(id=id).one()
         self.session.expire(group)
+        # The fees of open orders are worked out when they are accepted
+        self.margins.clear()
 
     def reload_contract(self, ticker):
         contract = self.session.query(models.Contract).filter_by(ticker=ticker).one()
         self.session.expire(contract)
+        for key in [key for key, cached in self.contracts.iteritems() if cached is contract]:
+            del self.contracts[key]
+        self.margins.clear()
 
     def change_fee_group(self, username, id):
         try:
             user = self.get_user(username)
             user.fee_group_id = id
             self.session.commit()
+            self.margins.pop(user.username, None)
             return None
         except Exception as e:
             self.session.rollback()
@@ -1555,6 +2243,9 @@ class Accountant:
                     self.session.rollback()
                     raise e
 
+                if position.username in self.margins:
+                    self.margins[position.username].set_reference_price(position.contract, price)
+
                 # Zero out positions
                 if zero_out:
                     log.msg("Zeroing out position %s" % position)
@@ -1590,12 +2281,24 @@ class WebserverExport(ComponentExport):
     def place_order(self, username, order):
         return self.accountant.place_order(username, order)
 
+    @export
+    @session_aware
+    @schema("rpc/accountant.webserver.json#place_orders")
+    def place_orders(self, username, orders):
+        return self.accountant.place_orders(username, orders)
+
     @export
     @session_aware
     @schema("rpc/accountant.webserver.json#cancel_order")
     def cancel_order(self, username, id):
         return self.accountant.cancel_order(username, id)
 
+    @export
+    @session_aware
+    @schema("rpc/accountant.webserver.json#cancel_orders")
+    def cancel_orders(self, username, ids):
+        return self.accountant.cancel_orders(username, ids)
+
     @export
     @session_aware
     @schema("rpc/accountant.webserver.json#request_withdrawal")
@@ -1672,10 +2375,20 @@ class AccountantExport(ComponentExport):
     @session_aware
     @schema("rpc/accountant.accountant.json#remote_post")
     def remote_post(self, username, *postings):
+        if not self.accountant.owns_user(username):
+            # Sent before the sender knew the user had been moved
+            self.accountant.accountant_proxy.remote_post(username, *postings)
+            return None
         self.accountant.post_or_fail(*postings).addErrback(log.err)
         # we do not want or need this to propagate back to the caller
         return None
 
+    @export
+    @schema("rpc/accountant.accountant.json#reload_shards")
+    def reload_shards(self, username):
+        self.accountant.reload_shards()
+        return None
+
 class RiskManagerExport(ComponentExport):
     def __init__(self, accountant):
         self.accountant = accountant
@@ -1753,6 +2466,11 @@ class AdministratorExport(ComponentExport):
     def get_margin(self, username):
         return self.accountant.get_margin(username)
 
+    @export
+    @schema("rpc/accountant.administrator.json#migrate_user")
+    def migrate_user(self, username, accountant):
+        return self.accountant.migrate_user(username, accountant)
+
     @export
     @schema("rpc/accountant.administrator.json#liquidate_all")
     def liquidate_all(self, username):
@@ -1764,20 +2482,40 @@ class AdministratorExport(ComponentExport):
         return self.accountant.liquidate_position(username, ticker)
 
 class AccountantProxy:
-    def __init__(self, mode, uri, base_port, timeout=1):
+    def __init__(self, mode, uri, base_port, timeout=1, codec="json"):
         self.num_procs = config.getint("accountant", "num_procs")
+        self.shards = sharding.ShardMap(self.num_procs)
         self.proxies = []
         for i in range(self.num_procs):
             if mode == "dealer":
-                proxy = dealer_proxy_async(uri % (base_port + i), timeout=timeout)
+                proxy = dealer_proxy_async(uri % (base_port + i), timeout=timeout, codec=codec)
             elif mode == "push":
-                proxy = push_proxy_async(uri % (base_port + i))
+                proxy = push_proxy_async(uri % (base_port + i), codec=codec)
             else:
                 raise Exception("Unsupported proxy mode: %s." % mode)
             self.proxies.append(proxy)
 
     def get_accountant_for_user(self, username):
-        return ord(username[0]) % self.num_procs
+        return self.shards.accountant_for(username)
+
+    def load_shards(self, session):
+        """Pick up the users that have been moved to another accountant.
+
+        :returns: list -- the users whose accountant changed
+        """
+        try:
+            return self.shards.load(session)
+        except Exception as e:
+            log.err("Unable to load the shard map: %s" % e)
+            return []
+        finally:
+            session.rollback()
+
+    def watch_shards(self, session):
+        """Load the shard map now and every [accountant] shard_refresh_interval
+        seconds after.
+        """
+        task.LoopingCall(self.load_shards, session).start(config.getfloat("accountant", "shard_refresh_interval"))
 
     def __getattr__(self, key):
         if key.startswith("__") and key.endswith("__"):
@@ -1798,13 +2536,14 @@ if __name__ == "__main__":
     num_procs = config.getint("accountant", "num_procs")
     log.msg("Accountant %d of %d" % (accountant_number+1, num_procs))
 
-    session = database.make_session()
-    engines = {}
-    engine_base_port = config.getint("engine", "accountant_base_port")
-    for contract in session.query(models.Contract).filter_by(active=True).all():
-        engines[contract.ticker] = dealer_proxy_async("tcp://127.0.0.1:%d" %
-                                                      (engine_base_port + int(contract.id)))
-    ledger = dealer_proxy_async(config.get("ledger", "accountant_export"), timeout=None)
+    # Fills only commit, so they need nothing from the database again
+    session = database.make_session(session_args={"expire_on_commit": False})
+    engines = engine_proxies(session.query(models.Contract).filter_by(active=True).all(), "accountant",
+                             codec=config.get("engine", "codec"),
+                             multiplexed=config.getboolean("engine", "multiplex"))
+    ledger = dealer_proxy_async(config.get("ledger", "accountant_export"), timeout=None,
+                                codec=config.get("ledger", "codec"),
+                                multiplexed=config.getboolean("ledger", "multiplex"))
     webserver = push_proxy_async(config.get("webserver", "accountant_export"))
     cashier = push_proxy_async(config.get("cashier", "accountant_export"))
     accountant_proxy = AccountantProxy("push",
@@ -1821,7 +2560,9 @@ if __name__ == "__main__":
                             debug=debug,
                             trial_period=trial_period,
                             mimetic_share=mimetic_share,
-                            sendmail=sendmail)
+                            sendmail=sendmail,
+                            persist_interval=config.getfloat("accountant", "persist_interval"))
+    task.LoopingCall(accountant.reload_shards).start(config.getfloat("accountant", "shard_refresh_interval"))
 
     webserver_export = WebserverExport(accountant)
     engine_export = EngineExport(accountant)
@@ -1852,6 +2593,23 @@ if __name__ == "__main__":
                        config.get("accountant", "accountant_export") %
                        (config.getint("accountant", "accountant_export_base_port") + accountant_number))
 
-    reactor.callWhenRunning(accountant.repair_user_positions)
+    # The marker is only there while we are not running, so if it is missing
+    # we crashed and may not have persisted every position change
+    clean_shutdown_marker = config.get("accountant", "clean_shutdown_marker") % accountant_number
+    if os.path.exists(clean_shutdown_marker):
+        os.remove(clean_shutdown_marker)
+        clean_start = True
+    else:
+        log.msg("No clean shutdown marker at %s, checking positions against the ledger." % clean_shutdown_marker)
+        clean_start = False
+
+    def shutdown():
+        accountant.persist()
+        if not accountant.position_deltas and not accountant.fill_deltas and \
+                not accountant.new_trades and not accountant.trades:
+            open(clean_shutdown_marker, "w").close()
+
+    reactor.addSystemEventTrigger("before", "shutdown", shutdown)
+    reactor.callWhenRunning(accountant.repair_user_positions, check_ledger=not clean_start)
     reactor.run()
 
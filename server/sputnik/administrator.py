@@ -59,6 +59,7 @@ import util
 from sendmail import Sendmail
 from watchdog import watchdog
 from accountant import AccountantProxy
+from engine_host import engine_proxies
 from exception import *
 from zmq_util import export, router_share_async, dealer_proxy_async, push_proxy_async, ComponentExport
 from rpc_schema import schema
@@ -111,7 +112,8 @@ class Administrator:
                  bitgo=None,
                  bitgo_private_key_file=None,
                  bs_cache_update_period=86400,
-                 testnet=True):
+                 testnet=True,
+                 ledger=None):
         """Set up the administrator
 
         :param session: the sqlAlchemy session
@@ -121,8 +123,11 @@ class Administrator:
         :type cashier: dealer_proxy_async
         :param debug: Are we going to permit weird things like position adjusts?
         :type debug: bool
+        :param ledger: The exposed fns on the ledger
+        :type ledger: dealer_proxy_async
         """
         self.session = session
+        self.ledger = ledger
         self.accountant = accountant
         self.accountant_slow = accountant_slow
         self.webserver = webserver
@@ -201,6 +206,8 @@ class Administrator:
             self.session.add(position)
 
         self.session.commit()
+        if self.ledger is not None:
+            self.ledger.reload_user(username)
 
         # Send registration mail
         t = util.get_locale_template(user.locale, self.jinja_env, 'registration.{locale}.email')
@@ -1260,6 +1267,8 @@ class Administrator:
         self.session.commit()
         self.webserver.reload_contract(ticker)
         self.accountant.reload_contract(None, ticker)
+        if self.ledger is not None:
+            self.ledger.reload_contract(ticker)
 
     def get_withdrawals(self):
         withdrawals = self.session.query(models.Withdrawal)
@@ -1426,6 +1435,25 @@ class Administrator:
         
     def liquidate_position(self, username, ticker):
         self.accountant_slow.liquidate_position(username, ticker)
+
+    def migrate_user(self, username, accountant):
+        return self.accountant_slow.migrate_user(username, accountant)
+
+    @inlineCallbacks
+    def rebalance_accountants(self):
+        """Move the users pinned to an accountant by sharding.pins_for to the
+        accountant the hash ring gives them, one at a time.
+        """
+        shards = self.accountant_slow.shards
+        try:
+            pinned = [(shard.username, shard.accountant) for shard in self.session.query(models.AccountantShard)]
+        finally:
+            self.session.rollback()
+
+        for username, accountant in pinned:
+            target = shards.ring_accountant_for(username)
+            if accountant != target:
+                yield self.migrate_user(username, target)
         
     @inlineCallbacks
     def initialize_multisig(self, ticker, public_key, multisig={}):
@@ -1720,6 +1748,8 @@ class AdminWebUI(Resource):
                       '/adjust_position': self.adjust_position,
                       '/liquidate_all': self.liquidate_all,
                       '/liquidate_position': self.liquidate_position,
+                      '/migrate_user': self.migrate_user,
+                      '/rebalance_accountants': self.rebalance_accountants,
                       '/wallets': self.wallets,
                       '/transfer_from_hot_wallet': self.transfer_from_hot_wallet,
                       '/transfer_from_multisig_wallet': self.transfer_from_multisig_wallet,
@@ -2048,6 +2078,27 @@ class AdminWebUI(Resource):
         self.administrator.liquidate_position(request.args['username'][0], request.args['ticker'][0])
         return redirectTo('/user_details?username=%s' % request.args['username'][0], request)
 
+    def migrate_user(self, request):
+        username = request.args['username'][0]
+        d = self.administrator.migrate_user(username, int(request.args['accountant'][0]))
+
+        def migration_done(result):
+            request.write(redirectTo('/user_details?username=%s' % username, request).encode('utf-8'))
+            request.finish()
+
+        d.addCallback(migration_done).addErrback(self.sputnik_error_callback, request).addErrback(self.generic_error_callback, request)
+        return NOT_DONE_YET
+
+    def rebalance_accountants(self, request):
+        d = self.administrator.rebalance_accountants()
+
+        def rebalancing_done(result):
+            request.write(redirectTo('/', request).encode('utf-8'))
+            request.finish()
+
+        d.addCallback(rebalancing_done).addErrback(self.sputnik_error_callback, request).addErrback(self.generic_error_callback, request)
+        return NOT_DONE_YET
+
     def withdrawals(self, request):
         withdrawals = self.administrator.get_withdrawals()
         t = self.jinja_env.get_template('withdrawals.html')
@@ -2369,6 +2420,14 @@ class AdminWebExport(ComponentExport):
     def cancel_order(self, username, id):
         return self.administrator.cancel_order(username, id)
 
+    @session_aware
+    def migrate_user(self, username, accountant):
+        return self.administrator.migrate_user(username, accountant)
+
+    @session_aware
+    def rebalance_accountants(self):
+        return self.administrator.rebalance_accountants()
+
     @session_aware
     def get_journal(self, id):
         return self.administrator.get_journal(id)
@@ -2692,12 +2751,15 @@ if __name__ == "__main__":
                                  config.get("accountant", "administrator_export"),
                                  config.getint("accountant", "administrator_export_base_port"),
                                  timeout=60*20)
+    accountant.watch_shards(session)
+    accountant_slow.watch_shards(session)
 
     # Set the cashier timeout to 5 seconds because sending multisig cash may
     # take a little bit
     cashier = dealer_proxy_async(config.get("cashier", "administrator_export"), timeout=5)
     watchdog(config.get("watchdog", "administrator"))
     webserver = dealer_proxy_async(config.get("webserver", "administrator_export"))
+    ledger = dealer_proxy_async(config.get("ledger", "administrator_export"))
 
     if config.getboolean("webserver", "ssl"):
         protocol = 'https'
@@ -2713,11 +2775,7 @@ if __name__ == "__main__":
     user_limit = config.getint("administrator", "user_limit")
     bs_cache_update = config.getint("administrator", "bs_cache_update")
 
-    engine_base_port = config.getint("engine", "administrator_base_port")
-    engines = {}
-    for contract in session.query(models.Contract).filter_by(active=True):
-        engines[contract.ticker] = dealer_proxy_async("tcp://127.0.0.1:%d" %
-                                                      (engine_base_port + int(contract.id)))
+    engines = engine_proxies(session.query(models.Contract).filter_by(active=True).all(), "administrator")
 
     bitgo_config = {'use_production': not config.getboolean("cashier", "testnet"),
                     'client_id': config.get("bitgo", "client_id"),
@@ -2736,6 +2794,7 @@ if __name__ == "__main__":
                                   bitgo=bitgo,
                                   bitgo_private_key_file=bitgo_private_key_file,
                                   testnet=config.getboolean("cashier", "testnet"),
+                                  ledger=ledger,
                                   )
 
     webserver_export = WebserverExport(administrator)
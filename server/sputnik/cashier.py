@@ -799,6 +799,7 @@ if __name__ == '__main__':
             config.getint("accountant", "cashier_export_base_port"))
 
     session = db.make_session()
+    accountant.watch_shards(session)
     bitcoin_conf = config.get("cashier", "bitcoin_conf")
 
     log.msg('connecting to bitcoin client')
@@ -36,19 +36,31 @@ def get_uri(**kwargs):
         sqlalchemy.event.listen(Engine, "connect", set_sqlite_pragma)
     return uri
 
-def get_session_maker(**kwargs):
+def get_session_maker(session_args=None, **kwargs):
     """
 
+    :param session_args: passed to sessionmaker, to configure the sessions
+    :type session_args: dict
     :param kwargs:
     :returns: sessionmaker
     """
     engine = make_engine(**kwargs)
-    Session = sqlalchemy.orm.sessionmaker(bind=engine)
+    Session = sqlalchemy.orm.sessionmaker(bind=engine, **(session_args or {}))
     return Session
 
-def make_engine(**kwargs):
+def make_engine(engine_args=None, **kwargs):
+    """
+
+    :param engine_args: passed to create_engine, to set up the pool
+    :type engine_args: dict
+    :param kwargs:
+    :returns: Engine
+    """
     uri = get_uri(**kwargs)
-    engine = sqlalchemy.create_engine(uri, echo=False)
+    if uri.split(":")[0] == "sqlite":
+        # sqlite connections are not pooled the same way, so take the defaults
+        engine_args = None
+    engine = sqlalchemy.create_engine(uri, echo=False, **(engine_args or {}))
     return engine
 
 
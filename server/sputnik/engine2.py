@@ -18,14 +18,16 @@ parser.add_option("-c", "--config", dest="filename",
 if options.filename:
     config.reconfigure(options.filename)
 
+import os
 import sys
 import json
-import heapq
 import math
+import bisect
 
 import database
 import models
 import accountant
+import journal
 
 import util
 
@@ -33,7 +35,9 @@ from twisted.internet import reactor
 from twisted.python import log
 from zmq_util import export, router_share_async, push_proxy_async, ComponentExport, connect_publisher
 from rpc_schema import schema
-from collections import defaultdict
+from collections import OrderedDict
+from itertools import izip_longest
+from operator import attrgetter
 from datetime import datetime
 from watchdog import watchdog
 
@@ -49,7 +53,11 @@ class OrderSide:
         return "SELL"
 
 
-class Order:
+class Order(object):
+    # Orders are the bulk of the engine's memory, so keep them compact.
+    __slots__ = ("id", "contract", "quantity", "quantity_left", "price",
+                 "side", "username", "timestamp", "priority")
+
     def __init__(self, id=None, contract=None, quantity=None,
                  quantity_left=None, price=None, side=None, username=None,
                  timestamp=None):
@@ -63,7 +71,10 @@ class Order:
         if timestamp is not None:
             self.timestamp = timestamp
         else:
-            self.timestamp = util.dt_to_timestamp(datetime.utcnow())
+            self.timestamp = util.monotonic_timestamp()
+
+        # Price-Time Priority, computed once so comparisons do not allocate.
+        self.priority = (side * price, self.timestamp)
 
     def to_administrator(self):
         return {'id': self.id,
@@ -84,12 +95,15 @@ class Order:
             "Bid" if self.side < 0 else "Ask", self.price, self.quantity_left, self.quantity, self.id)
 
     def __repr__(self):
-        return self.__dict__.__repr__()
+        return {slot: getattr(self, slot) for slot in self.__slots__}.__repr__()
 
     def __eq__(self, other):
         return self.side == other.side and self.price == other.price \
             and self.timestamp == other.timestamp
 
+    def __ne__(self, other):
+        return not self == other
+
     def __lt__(self, other):
         """
         Returns whether an order is higher than another in the order book.
@@ -98,8 +112,7 @@ class Order:
         if self.side is not other.side:
             raise Exception("Orders are not comparable.")
 
-        # Price-Time Priority
-        return (self.side * self.price, self.timestamp) < (other.side * other.price, other.timestamp)
+        return self.priority < other.priority
 
 
 class EngineListener:
@@ -127,26 +140,145 @@ class EngineListener:
     def on_cancel_fail(self, order_id, reason):
         pass
 
+    def on_cancel_many(self, orders):
+        """
+        Called once when many orders are cancelled together.
+        """
+        for order in orders:
+            self.on_cancel_success(order)
+
+    def on_flush(self):
+        """
+        Called once the engine has finished processing a request. Listeners
+        which batch up their notifications should send them now.
+        """
+        pass
+
+
+class PriceLevel:
+    """
+    All the orders resting at a single price, in time priority.
+    """
+
+    def __init__(self, price):
+        self.price = price
+        # Keyed by order id so that an order can be removed in O(1).
+        self.orders = OrderedDict()
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __iter__(self):
+        return self.orders.itervalues()
+
+    def first(self):
+        return self.orders[next(iter(self.orders))]
+
+    def last(self):
+        return self.orders[next(reversed(self.orders))]
+
+    def add(self, order):
+        if not self.orders or self.last().timestamp <= order.timestamp:
+            self.orders[order.id] = order
+            return
+
+        # The order is older than the tail of the queue. This only happens if
+        #   orders reach the engine out of timestamp order, so just rebuild
+        #   the queue. sorted() is stable, which preserves arrival order for
+        #   orders that share a timestamp.
+        orders = sorted(self.orders.values() + [order], key=attrgetter("timestamp"))
+        self.orders = OrderedDict((o.id, o) for o in orders)
+
+    def remove(self, order):
+        del self.orders[order.id]
+
+
+class OrderBookSide:
+    """
+    One side of the order book, kept as price levels in price-time priority.
+
+    Price levels are indexed by price and their priority keys are kept in a
+    sorted list, so the best level is always at the end of the list.
+    """
+
+    def __init__(self, side):
+        self.side = side
+        self.levels = {}
+        # Sorted ascending by -side * price, so that the best price is last.
+        self.keys = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __nonzero__(self):
+        return self.count > 0
+
+    def __iter__(self):
+        """
+        Iterate over all the orders on this side in priority order.
+        """
+        for key in reversed(self.keys):
+            for order in self.levels[-self.side * key]:
+                yield order
+
+    def iterlevels(self):
+        """
+        Iterate over the price levels on this side, best price first.
+        """
+        for key in reversed(self.keys):
+            yield self.levels[-self.side * key]
+
+    def best(self):
+        if not self.keys:
+            return None
+        return self.levels[-self.side * self.keys[-1]].first()
+
+    def add(self, order):
+        level = self.levels.get(order.price)
+        if level is None:
+            level = PriceLevel(order.price)
+            self.levels[order.price] = level
+            bisect.insort(self.keys, -self.side * order.price)
+        level.add(order)
+        self.count += 1
+
+    def remove(self, order):
+        level = self.levels[order.price]
+        level.remove(order)
+        self.count -= 1
+
+        if not level:
+            del self.levels[order.price]
+            key = -self.side * order.price
+            if self.keys[-1] == key:
+                self.keys.pop()
+            else:
+                del self.keys[bisect.bisect_left(self.keys, key)]
+
 
 class Engine:
     def __init__(self):
-        self.orderbook = {OrderSide.BUY: [], OrderSide.SELL: []}
+        self.orderbook = {OrderSide.BUY: OrderBookSide(OrderSide.BUY),
+                          OrderSide.SELL: OrderBookSide(OrderSide.SELL)}
         self.ordermap = {}
         self.listeners = []
 
     @util.timed
-    def place_order(self, order):
+    def place_order(self, order, flush=True):
+
+        other_side = self.orderbook[-order.side]
 
         # Loop until the order or the opposite side is exhausted.
         while order.quantity_left > 0:
 
+            # Find the best counter-offer.
+            passive_order = other_side.best()
+
             # If the other side has run out of orders, break.
-            if not self.orderbook[-order.side]:
+            if passive_order is None:
                 break
 
-            # Find the best counter-offer.
-            passive_order = self.orderbook[-order.side][0]
-
             # We may assume this order is the best offer on its side. If not,
             #   the following will automatically fail since it failed for
             #   better offers already.
@@ -160,24 +292,36 @@ class Engine:
 
             # If the passive order is used up, remove it.
             if passive_order.quantity_left <= 0:
-                heapq.heappop(self.orderbook[passive_order.side])
+                other_side.remove(passive_order)
                 del self.ordermap[passive_order.id]
 
             # Notify listeners.
             self.notify_trade_success(order, passive_order, price, quantity)
 
-        # If order is not completely filled, push remainder onto heap and make
-        #   an entry in the map.
+        # If order is not completely filled, queue the remainder at its price
+        #   level and make an entry in the map.
         if order.quantity_left > 0:
-            heapq.heappush(self.orderbook[order.side], order)
+            self.orderbook[order.side].add(order)
             self.ordermap[order.id] = order
 
             # Notify listeners
             self.notify_queue_success(order)
 
+        if flush:
+            self.notify_flush()
+
         # Order has been successfully processed.
         return True
 
+    @util.timed
+    def place_orders(self, orders):
+        """
+        Place several orders in turn, flushing the listeners once at the end.
+        """
+        results = [self.place_order(order, flush=False) for order in orders]
+        self.notify_flush()
+        return results
+
     def match(self, order, passive_order):
 
         # Calculate trading quantity and price.
@@ -191,7 +335,7 @@ class Engine:
         return price, quantity
 
     @util.timed
-    def cancel_order(self, id):
+    def cancel_order(self, id, flush=True):
         # Check to make sure order has not already been filled.
         if id not in self.ordermap:
             # Too late to cancel.
@@ -205,13 +349,87 @@ class Engine:
         # Remove the order from the book.
         del self.ordermap[id]
         self.orderbook[order.side].remove(order)
-        heapq.heapify(self.orderbook[order.side]) #yuck
 
         # Notify user of cancellation.
         self.notify_cancel_success(order)
+        if flush:
+            self.notify_flush()
 
         return True
 
+    @util.timed
+    def mass_cancel(self, username=None, ids=None):
+        """
+        Cancel many resting orders in one pass: the orders in ids if given,
+        otherwise all the orders of username if given, otherwise the whole
+        book. If both are given, only the orders in ids which belong to
+        username are cancelled. Orders which are no longer on the book are
+        skipped. Listeners get a single on_cancel_many notification.
+
+        :returns: list -- the ids of the cancelled orders
+        """
+        if ids is not None:
+            orders = OrderedDict((id, self.ordermap[id]) for id in ids if id in self.ordermap).values()
+            if username is not None:
+                orders = [order for order in orders if order.username == username]
+        elif username is not None:
+            orders = [order for order in self.ordermap.itervalues() if order.username == username]
+        else:
+            orders = self.ordermap.values()
+
+        if not orders:
+            return []
+
+        if ids is None and username is None:
+            # Nothing is left, so start afresh rather than unlink every order
+            self.orderbook = {OrderSide.BUY: OrderBookSide(OrderSide.BUY),
+                              OrderSide.SELL: OrderBookSide(OrderSide.SELL)}
+            self.ordermap = {}
+        else:
+            for order in orders:
+                del self.ordermap[order.id]
+                self.orderbook[order.side].remove(order)
+
+        log.msg("Cancelled %d orders." % len(orders))
+        self.notify_cancel_many(orders)
+        self.notify_flush()
+
+        return [order.id for order in orders]
+
+    @util.timed
+    def cancel_orders(self, ids):
+        """
+        Cancel several orders in turn, flushing the listeners once at the end.
+        """
+        results = [self.cancel_order(id, flush=False) for id in ids]
+        self.notify_flush()
+        return results
+
+    def replay(self, records, contract):
+        """
+        Rebuild the book from journal records. Listeners are not notified.
+        """
+        for record in records:
+            kind = record[0]
+            if kind == journal.QUEUE:
+                fields = record[1]
+                order = Order(id=fields["id"], contract=contract, quantity=fields["quantity"],
+                              price=fields["price"], side=fields["side"],
+                              username=fields["username"], timestamp=fields["timestamp"])
+                order.quantity_left = fields["quantity_left"]
+                self.orderbook[order.side].add(order)
+                self.ordermap[order.id] = order
+            elif kind == journal.FILL:
+                order = self.ordermap[record[1]]
+                order.quantity_left -= record[2]
+                if order.quantity_left <= 0:
+                    self.orderbook[order.side].remove(order)
+                    del self.ordermap[order.id]
+            elif kind == journal.CANCEL:
+                order = self.ordermap.pop(record[1], None)
+                if order is not None:
+                    self.orderbook[order.side].remove(order)
+
     def add_listener(self, listener):
         self.listeners.append(listener)
 
@@ -275,6 +493,14 @@ class Engine:
                 log.err("Exception in on_cancel_success of %s: %s." % (listener, e))
                 log.err()
 
+    def notify_cancel_many(self, orders):
+        for listener in self.listeners:
+            try:
+                listener.on_cancel_many(orders)
+            except Exception, e:
+                log.err("Exception in on_cancel_many of %s: %s." % (listener, e))
+                log.err()
+
     def notify_cancel_fail(self, order, reason):
         for listener in self.listeners:
             try:
@@ -283,6 +509,14 @@ class Engine:
                 log.err("Exception in on_cancel_fail of %s: %s." % (listener, e))
                 log.err()
 
+    def notify_flush(self):
+        for listener in self.listeners:
+            try:
+                listener.on_flush()
+            except Exception, e:
+                log.err("Exception in on_flush of %s: %s." % (listener, e))
+                log.err()
+
 
 class LoggingListener:
     def __init__(self, engine, contract):
@@ -292,10 +526,6 @@ class LoggingListener:
     def on_init(self):
         self.ticker = self.contract.ticker
         log.msg("Engine for contract %s (%d) started." % (self.ticker, self.contract.id))
-        log.msg(
-            "Listening for connections on port %d." % (config.getint("engine", "accountant_base_port") + self.contract.id))
-        log.msg(
-            "Listening for connections on port %d." % (config.getint("engine", "administrator_base_port") + self.contract.id))
 
 
     def on_shutdown(self):
@@ -303,7 +533,6 @@ class LoggingListener:
 
     def on_queue_success(self, order):
         log.msg("%s queued." % order)
-        self.print_order_book()
 
     def on_queue_fail(self, order, reason):
         log.msg("%s cannot be queued because %s." % (order, reason))
@@ -311,37 +540,88 @@ class LoggingListener:
     def on_trade_success(self, order, passive_order, price, quantity):
         log.msg("Successful trade between order id=%s and id=%s for %s lots at %s each." % (
             order.id, passive_order.id, quantity, price))
-        self.print_order_book()
 
     def on_trade_fail(self, order, passive_order, reason):
         log.msg("Cannot complete trade between %s and %s." % (order, passive_order))
 
     def on_cancel_success(self, order):
         log.msg("%s cancelled." % order)
-        self.print_order_book()
 
     def on_cancel_fail(self, order, reason):
         log.msg("Cannot cancel %s because %s." % (order, reason))
 
+    def on_cancel_many(self, orders):
+        log.msg("%d orders cancelled." % len(orders))
+
+    def on_flush(self):
+        self.print_order_book()
+
     def print_order_book(self):
         log.msg("Orderbook for %s:" % self.contract.ticker)
         log.msg("Bids                   Asks")
         log.msg("Vol.  Price     Price  Vol.")
-        length = max(len(self.engine.orderbook[OrderSide.BUY]), len(self.engine.orderbook[OrderSide.SELL]))
-        for i in range(length):
-            try:
-                ask = self.engine.orderbook[OrderSide.SELL][i]
+        for bid, ask in izip_longest(self.engine.orderbook[OrderSide.BUY], self.engine.orderbook[OrderSide.SELL]):
+            if ask is not None:
                 ask_str = "{:<5} {:<5}".format(ask.price, ask.quantity_left)
-            except:
+            else:
                 ask_str = "           "
-            try:
-                bid = self.engine.orderbook[OrderSide.BUY][i]
+            if bid is not None:
                 bid_str = "{:>5} {:>5}".format(bid.quantity_left, bid.price)
-            except:
+            else:
                 bid_str = "           "
             log.msg("{}     {}".format(bid_str, ask_str))
 
 
+class JournalListener(EngineListener):
+    """
+    Records every change to the book in a journal so that the book can be
+    rebuilt after a restart. Records are written out whenever the engine
+    flushes, so they survive the engine process dying, and are synced to disk
+    at most once every sync_interval seconds (every flush if it is 0).
+
+    Once snapshot_records records have been written, the book is snapshotted
+    and the journal starts over, so restarts don't depend on history length.
+    """
+
+    def __init__(self, engine, journal, sync_interval=0, snapshot_records=0):
+        self.engine = engine
+        self.journal = journal
+        self.sync_interval = sync_interval
+        self.snapshot_records = snapshot_records
+        self.pending_sync = None
+        self.callLater = reactor.callLater
+
+    def on_queue_success(self, order):
+        self.journal.queue(order)
+
+    def on_trade_success(self, order, passive_order, price, quantity):
+        self.journal.fill(passive_order.id, quantity)
+
+    def on_cancel_success(self, order):
+        self.journal.cancel(order.id)
+
+    def on_flush(self):
+        self.journal.write()
+        if self.snapshot_records and self.journal.records >= self.snapshot_records:
+            # Compaction syncs everything itself
+            self.snapshot()
+        elif not self.sync_interval:
+            self.journal.sync()
+        elif self.pending_sync is None:
+            self.pending_sync = self.callLater(self.sync_interval, self.sync)
+
+    @util.timed
+    def snapshot(self):
+        self.journal.compact(order for side in self.engine.orderbook.itervalues() for order in side)
+
+    def sync(self):
+        self.pending_sync = None
+        self.journal.sync()
+
+    def on_shutdown(self):
+        self.journal.close()
+
+
 class AccountantNotifier(EngineListener):
     def __init__(self, engine, accountant, contract):
         self.engine = engine
@@ -386,70 +666,207 @@ class AccountantNotifier(EngineListener):
 
 
 class WebserverNotifier(EngineListener):
-    def __init__(self, engine, webserver, contract, reg_publish=True):
+    """
+    Keeps the aggregated (price level) book and publishes it to the webserver.
+
+    Changes are collected until the engine flushes, so an order which sweeps
+    several levels results in a single update. If publish_interval is set,
+    updates are further coalesced and sent at most once per publish_interval
+    seconds.
+
+    In the default mode the whole book is sent on every update. In delta mode
+    only the price levels which changed are sent, as a sequence numbered
+    book_delta, and the whole book is sent every snapshot_interval deltas so
+    that consumers which missed a delta can resynchronize.
+
+    Every book and delta carries a sequence number. A delta with sequence n
+    applies on top of the book with sequence n - 1. A book with sequence n
+    already includes every delta up to and including n.
+
+    Bids and asks are always sent best price first. The wire books are cached
+    until the book changes, so they must not be modified by callers.
+    """
+
+    def __init__(self, engine, webserver, contract, reg_publish=True, deltas=False,
+                 snapshot_interval=100, publish_interval=0):
         self.engine = engine
         self.webserver = webserver
         self.contract = contract
-        self.aggregated_book = {"bids": defaultdict(int), "asks": defaultdict(int)}
+        self.aggregated_book = {"bids": {}, "asks": {}}
         self.side_map = { OrderSide.BUY: "bids",
                           OrderSide.SELL: "asks"}
+        # Sorted level keys (side * price) so that the best price comes first
+        self.level_keys = {"bids": [], "asks": []}
+        self.side_sign = {"bids": OrderSide.BUY, "asks": OrderSide.SELL}
+        # depth -> wire book, None is the whole book
+        self.wire_books = {}
+        self.deltas = deltas
+        self.snapshot_interval = snapshot_interval
+        self.sequence = 0
+        # Price levels changed since the last publish, price -> new quantity
+        self.changes = {"bids": {}, "asks": {}}
+        self.publish_interval = publish_interval
+        self.pending_publish = None
+        self.callLater = reactor.callLater
 
         # Publish every 10 min no matter what
         if reg_publish:
             def regular_publish():
-                self.publish_book()
+                self.publish_snapshot()
                 reactor.callLater(600, regular_publish)
 
             reactor.callLater(600, regular_publish)
 
     def on_init(self):
-        self.publish_book()
+        # The engine may have restored its book before we were attached
+        self.aggregated_book = {"bids": {}, "asks": {}}
+        self.level_keys = {"bids": [], "asks": []}
+        for side in self.engine.orderbook.itervalues():
+            for order in side:
+                self.adjust_level(order.side, order.price, order.quantity_left)
+        self.changes = {"bids": {}, "asks": {}}
+
+        self.publish_snapshot()
 
     def on_trade_success(self, order, passive_order, price, quantity):
-        side = self.side_map[passive_order.side]
+        self.adjust_level(passive_order.side, passive_order.price, -quantity)
 
-        self.aggregated_book[side][passive_order.price] -= quantity
-        if self.aggregated_book[side][passive_order.price] == 0:
-            del self.aggregated_book[side][passive_order.price]
+    def on_queue_success(self, order):
+        self.adjust_level(order.side, order.price, order.quantity_left)
 
-        self.publish_book()
+    def on_cancel_success(self, order):
+        self.adjust_level(order.side, order.price, -order.quantity_left)
 
-    def on_queue_success(self, order):
-        side = self.side_map[order.side]
+    def on_flush(self):
+        if not self.publish_interval:
+            self.publish_book()
+        elif self.pending_publish is None:
+            self.pending_publish = self.callLater(self.publish_interval, self.publish_pending)
 
-        self.aggregated_book[side][order.price] += order.quantity_left
+    def publish_pending(self):
+        self.pending_publish = None
         self.publish_book()
 
-    def on_cancel_success(self, order):
-        side = self.side_map[order.side]
+    def adjust_level(self, order_side, price, quantity):
+        side = self.side_map[order_side]
+        levels = self.aggregated_book[side]
+        keys = self.level_keys[side]
+        key = order_side * price
+
+        if price not in levels:
+            levels[price] = 0
+            bisect.insort(keys, key)
+
+        levels[price] += quantity
+        if levels[price] == 0:
+            del levels[price]
+            del keys[bisect.bisect_left(keys, key)]
+            self.changes[side][price] = 0
+        else:
+            self.changes[side][price] = levels[price]
 
-        self.aggregated_book[side][order.price] -= order.quantity_left
-        if self.aggregated_book[side][order.price] == 0:
-            del self.aggregated_book[side][order.price]
+        self.wire_books.clear()
 
-        self.publish_book()
+    def levels(self, side, depth=None):
+        """
+        The price levels of one side ("bids" or "asks"), best price first,
+        optionally limited to the top depth levels.
+        """
+        levels = self.aggregated_book[side]
+        sign = self.side_sign[side]
+        return [{"quantity": levels[sign * key],
+                 "price": sign * key} for key in self.level_keys[side][:depth]]
+
+    def depth_book(self, depth=None):
+        """
+        The top depth levels of each side of the book, or the whole book if
+        depth is None.
+        """
+        if depth not in self.wire_books:
+            self.wire_books[depth] = {"contract": self.contract.ticker,
+                                      "sequence": self.sequence,
+                                      "bids": self.levels("bids", depth),
+                                      "asks": self.levels("asks", depth)}
+        return self.wire_books[depth]
 
     @property
     def wire_book(self):
-        wire_book = {"contract": self.contract.ticker,
-                     "bids": [{"quantity": row[1],
-                               "price": row[0]} for row in self.aggregated_book["bids"].iteritems()],
-                     "asks": [{"quantity": row[1],
-                               "price": row[0]} for row in self.aggregated_book["asks"].iteritems()]}
-        return wire_book
+        return self.depth_book()
+
+    @property
+    def wire_delta(self):
+        """
+        The price levels changed since the last publish. A quantity of 0 means
+        the level has been removed.
+        """
+        wire_delta = {"contract": self.contract.ticker,
+                      "sequence": self.sequence,
+                      "bids": [{"quantity": row[1],
+                                "price": row[0]} for row in self.changes["bids"].iteritems()],
+                      "asks": [{"quantity": row[1],
+                                "price": row[0]} for row in self.changes["asks"].iteritems()]}
+        return wire_delta
 
     def publish_book(self):
+        if not self.changes["bids"] and not self.changes["asks"]:
+            return
+
+        self.sequence += 1
+        self.wire_books.clear()
+
+        if not self.deltas:
+            self.changes = {"bids": {}, "asks": {}}
+            self.publish_snapshot()
+            return
+
+        self.webserver.book_delta(self.contract.ticker, self.wire_delta)
+        self.changes = {"bids": {}, "asks": {}}
+
+        if self.sequence % self.snapshot_interval == 0:
+            self.publish_snapshot()
+
+    def publish_snapshot(self):
         self.webserver.book(self.contract.ticker, self.wire_book)
 
 
+# Exact, unlike a float number of seconds
+CHECKPOINT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
 class SafePriceNotifier(EngineListener):
-    def __init__(self, session, engine, accountant, webserver, forwarder, contract):
+    """
+    Keeps an exponential moving average of the trade price, weighted by
+    volume, and publishes it as the contract's safe price.
+
+    The state of the average is checkpointed to checkpoint_path (at most once
+    every checkpoint_interval seconds, every trade if it is 0), so on startup
+    only the trades after the checkpoint are read back from the database. A
+    checkpoint which is behind is harmless, the trades since are replayed.
+
+    A new safe price is published at most once every publish_interval
+    seconds, and only once it has moved by more than publish_threshold (a
+    fraction of the last price published). It is published every ten minutes
+    regardless.
+    """
+
+    def __init__(self, session, engine, accountant, webserver, forwarder, contract,
+                 checkpoint_path=None, checkpoint_interval=0, publish_interval=0, publish_threshold=0):
         self.session = session
         self.engine = engine
         self.contract = contract
         self.forwarder = forwarder
         self.accountant = accountant
         self.webserver = webserver
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.pending_checkpoint = None
+        self.publish_interval = publish_interval
+        self.publish_threshold = publish_threshold
+        self.published_price = None
+        self.published_at = None
+        self.pending_publish = None
+        self.callLater = reactor.callLater
+        self.seconds = reactor.seconds
 
         self.ema_price_volume = 0
         self.ema_volume = 0
@@ -464,11 +881,13 @@ class SafePriceNotifier(EngineListener):
         reactor.callLater(600, regular_publish)
 
     def on_init(self):
+        self.load_checkpoint()
         try:
-            trades = self.session.query(models.Trade).filter_by(contract=contract).order_by(
-                models.Trade.timestamp)
-    
-            for trade in trades:
+            trades = self.session.query(models.Trade).filter_by(contract=self.contract)
+            if self.ema_timestamp is not None:
+                trades = trades.filter(models.Trade.timestamp > self.ema_timestamp)
+
+            for trade in trades.order_by(models.Trade.timestamp).yield_per(1000):
                 self.update_safe_price(trade.price, trade.quantity, publish=False, timestamp=trade.timestamp)
             if self.safe_price is None:
                 self.safe_price = 42
@@ -478,10 +897,22 @@ class SafePriceNotifier(EngineListener):
             self.session.rollback()
             raise e
 
+        self.save_checkpoint()
         self.publish_safe_price()
 
     def on_trade_success(self, order, passive_order, price, quantity):
-        self.update_safe_price(price, quantity)
+        # Use the timestamp the accountant gives the trade, so that the
+        # checkpoint lines up with the trades in the database
+        if order.timestamp is not None:
+            timestamp = util.timestamp_to_dt(max(order.timestamp, passive_order.timestamp or 0))
+        else:
+            timestamp = None
+        self.update_safe_price(price, quantity, timestamp=timestamp)
+
+    def on_shutdown(self):
+        if self.pending_checkpoint is not None:
+            self.pending_checkpoint.cancel()
+            self.save_checkpoint()
 
     def update_safe_price(self, price, quantity, publish=True, timestamp=None):
         if timestamp is None:
@@ -490,18 +921,78 @@ class SafePriceNotifier(EngineListener):
         if self.ema_timestamp is None:
             decay = self.decay
         else:
-            seconds = (timestamp - self.ema_timestamp).total_seconds()
+            # Trades may reach us slightly out of order
+            seconds = max(0, (timestamp - self.ema_timestamp).total_seconds())
             decay = math.pow(self.decay, seconds)
 
-        self.ema_timestamp = timestamp
+        if self.ema_timestamp is None or timestamp > self.ema_timestamp:
+            self.ema_timestamp = timestamp
         self.ema_volume = decay * self.ema_volume + (1 - decay) * quantity
         self.ema_price_volume = decay * self.ema_price_volume + (1 - decay) * quantity * price
         self.safe_price = int(self.ema_price_volume / self.ema_volume)
 
         if publish:
+            self.schedule_publish()
+            self.schedule_checkpoint()
+
+    def load_checkpoint(self):
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return
+
+        try:
+            with open(self.checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            self.ema_volume = checkpoint["ema_volume"]
+            self.ema_price_volume = checkpoint["ema_price_volume"]
+            self.ema_timestamp = datetime.strptime(checkpoint["ema_timestamp"], CHECKPOINT_TIME_FORMAT)
+            self.safe_price = checkpoint["safe_price"]
+        except Exception as e:
+            log.err("Ignoring unreadable safe price checkpoint %s: %s" % (self.checkpoint_path, e))
+            self.ema_volume = 0
+            self.ema_price_volume = 0
+            self.ema_timestamp = None
+            self.safe_price = None
+
+    def schedule_checkpoint(self):
+        if self.checkpoint_path is None:
+            return
+        if not self.checkpoint_interval:
+            self.save_checkpoint()
+        elif self.pending_checkpoint is None:
+            self.pending_checkpoint = self.callLater(self.checkpoint_interval, self.save_checkpoint)
+
+    def save_checkpoint(self):
+        self.pending_checkpoint = None
+        if self.checkpoint_path is None or self.ema_timestamp is None:
+            return
+
+        journal.write_atomically(self.checkpoint_path, json.dumps({
+            "ema_volume": self.ema_volume,
+            "ema_price_volume": self.ema_price_volume,
+            "ema_timestamp": self.ema_timestamp.strftime(CHECKPOINT_TIME_FORMAT),
+            "safe_price": self.safe_price}))
+
+    def schedule_publish(self):
+        if self.pending_publish is not None:
+            return
+        if self.published_price is not None:
+            change = abs(self.safe_price - self.published_price)
+            if change == 0 or change <= self.publish_threshold * abs(self.published_price):
+                return
+
+        wait = self.published_at + self.publish_interval - self.seconds() if self.published_at is not None else 0
+        if wait > 0:
+            self.pending_publish = self.callLater(wait, self.publish_safe_price)
+        else:
             self.publish_safe_price()
 
     def publish_safe_price(self):
+        if self.pending_publish is not None and self.pending_publish.active():
+            self.pending_publish.cancel()
+        self.pending_publish = None
+        self.published_price = self.safe_price
+        self.published_at = self.seconds()
+
         self.accountant.safe_prices(None, self.contract.ticker, self.safe_price)
         self.webserver.safe_prices(self.contract.ticker, self.safe_price)
         self.forwarder.publish(json.dumps({self.contract.ticker: self.safe_price}), tag=b'')
@@ -518,11 +1009,26 @@ class AccountantExport(ComponentExport):
     def place_order(self, order):
         return self.engine.place_order(Order(**order))
 
+    @export
+    @schema("rpc/engine.json#place_orders")
+    def place_orders(self, orders):
+        return self.engine.place_orders([Order(**order) for order in orders])
+
     @export
     @schema("rpc/engine.json#cancel_order")
     def cancel_order(self, id):
         return self.engine.cancel_order(id)
 
+    @export
+    @schema("rpc/engine.json#cancel_orders")
+    def cancel_orders(self, ids):
+        return self.engine.cancel_orders(ids)
+
+    @export
+    @schema("rpc/engine.json#mass_cancel")
+    def mass_cancel(self, username=None, ids=None):
+        return self.engine.mass_cancel(username=username, ids=ids)
+
     @export
     @schema("rpc/engine.json#get_safe_price")
     def get_safe_price(self):
@@ -530,8 +1036,8 @@ class AccountantExport(ComponentExport):
 
     @export
     @schema("rpc/engine.json#get_order_book")
-    def get_order_book(self):
-        return self.webserver_notifier.wire_book
+    def get_order_book(self, depth=None):
+        return self.webserver_notifier.depth_book(depth)
 
 class AdministratorExport(ComponentExport):
     def __init__(self, engine):
@@ -546,6 +1052,108 @@ class AdministratorExport(ComponentExport):
         return order_book
 
 
+def reconcile_book(engine, engine_journal, open_orders):
+    """Bring a book restored from the journal into line with the open orders
+    in the database.
+
+    Orders which the accountant has cancelled since are taken off the book.
+    Orders with less left in the database than on the book have been filled
+    further than the journal knows, so they are cut down to the database's
+    quantity_left and the difference is journalled as a fill. When the
+    database has more left, the accountant has not written the fills yet
+    (it writes them in batches, and rebuilds them from the ledger after a
+    crash) and the book is kept.
+
+    :param open_orders: the open orders of the contract in the database
+    :type open_orders: list
+    :returns: list -- the open orders which are not on the book, and so have
+        to be cancelled
+    """
+    open_ids = set(order.id for order in open_orders)
+    stale_ids = [id for id in engine.ordermap if id not in open_ids]
+    if stale_ids:
+        log.msg("Removing %d orders which are no longer open" % len(stale_ids))
+        engine.mass_cancel(ids=stale_ids)
+
+    missing = []
+    clamped = 0
+    for order in open_orders:
+        book_order = engine.ordermap.get(order.id)
+        if book_order is None:
+            missing.append(order)
+        elif order.quantity_left < book_order.quantity_left:
+            log.msg("Order %d has %d left, not %d" % (order.id, order.quantity_left, book_order.quantity_left))
+            engine_journal.fill(order.id, book_order.quantity_left - order.quantity_left)
+            book_order.quantity_left = order.quantity_left
+            clamped += 1
+
+    if clamped:
+        log.msg("Cut down %d orders to the quantity left in the database" % clamped)
+        engine_journal.write()
+        engine_journal.sync()
+
+    return missing
+
+
+def start_engine(session, contract, accountant, webserver, forwarder):
+    """Bring up the engine for a contract: rebuild its book from the journal,
+    reconcile the book with the database and attach the listeners.
+
+    :returns: tuple -- the accountant and administrator exports of the engine
+    """
+    engine = Engine()
+
+    # Rebuild the book as it was when we last stopped
+    engine_journal = journal.Journal(config.get("engine", "journal") % contract.id)
+    records = engine_journal.restore()
+    engine.replay(records, contract.id)
+    log.msg("Restored %d orders for %s from %d journal records." %
+            (len(engine.ordermap), contract.ticker, len(records)))
+    engine_journal.open()
+
+    logger = LoggingListener(engine, contract)
+    accountant_notifier = AccountantNotifier(engine, accountant, contract)
+    webserver_notifier = WebserverNotifier(engine, webserver, contract,
+                                           deltas=config.getboolean("engine", "book_deltas"),
+                                           snapshot_interval=config.getint("engine", "book_snapshot_interval"),
+                                           publish_interval=config.getfloat("engine", "book_publish_interval"))
+    safe_price_notifier = SafePriceNotifier(session, engine, accountant, webserver, forwarder, contract,
+                                            checkpoint_path=config.get("engine", "safe_price_checkpoint") % contract.id,
+                                            checkpoint_interval=config.getfloat("engine", "safe_price_checkpoint_interval"),
+                                            publish_interval=config.getfloat("engine", "safe_price_publish_interval"),
+                                            publish_threshold=config.getfloat("engine", "safe_price_publish_threshold"))
+    journal_listener = JournalListener(engine, engine_journal,
+                                       sync_interval=config.getfloat("engine", "journal_sync_interval"),
+                                       snapshot_records=config.getint("engine", "journal_snapshot_records"))
+
+    engine.add_listener(journal_listener)
+
+    # Reconcile the restored book with the database
+    try:
+        open_orders = session.query(models.Order).filter_by(
+                is_cancelled=False).filter_by(
+                contract_id=contract.id).filter(
+                        models.Order.quantity_left > 0).all()
+    except Exception as e:
+        session.rollback()
+        raise e
+
+    for order in reconcile_book(engine, engine_journal, open_orders):
+        log.msg("Cancelling order %d" % order.id)
+        accountant.cancel_order(order.username, order.id)
+
+    # The other listeners pick up the restored book in on_init
+    engine.add_listener(logger)
+    engine.add_listener(accountant_notifier)
+    engine.add_listener(webserver_notifier)
+    engine.add_listener(safe_price_notifier)
+
+    engine.notify_init()
+    reactor.addSystemEventTrigger("before", "shutdown", engine.notify_shutdown)
+
+    return AccountantExport(engine, safe_price_notifier, webserver_notifier), AdministratorExport(engine)
+
+
 if __name__ == "__main__":
     log.startLogging(sys.stdout)
     session = database.make_session()
@@ -559,49 +1167,25 @@ if __name__ == "__main__":
         log.err()
         raise e
 
-    engine = Engine()
-    administrator_export = AdministratorExport(engine)
-    accountant_port = config.getint("engine", "accountant_base_port") + contract.id
-
-    administrator_port = config.getint("engine", "administrator_base_port") + contract.id
-    router_share_async(administrator_export, "tcp://127.0.0.1:%d" % administrator_port)
-
-    logger = LoggingListener(engine, contract)
     accountant = accountant.AccountantProxy("push",
                                             config.get("accountant", "engine_export"),
-                                            config.getint("accountant", "engine_export_base_port"))
-    accountant_notifier = AccountantNotifier(engine, accountant, contract)
+                                            config.getint("accountant", "engine_export_base_port"),
+                                            codec=config.get("engine", "codec"))
+    accountant.watch_shards(session)
     webserver = push_proxy_async(config.get("webserver", "engine_export"))
-    webserver_notifier = WebserverNotifier(engine, webserver, contract)
-
-
-    watchdog(config.get("watchdog", "engine") %
-             (config.getint("watchdog", "engine_base_port") + contract.id))
-
     forwarder = connect_publisher(config.get("safe_price_forwarder", "zmq_frontend_address"))
 
-    safe_price_notifier = SafePriceNotifier(session, engine, accountant, webserver, forwarder, contract)
-    accountant_export = AccountantExport(engine, safe_price_notifier, webserver_notifier)
-    router_share_async(accountant_export, "tcp://127.0.0.1:%d" % accountant_port)
+    accountant_export, administrator_export = start_engine(session, contract, accountant, webserver, forwarder)
 
-    engine.add_listener(logger)
-    engine.add_listener(accountant_notifier)
-    engine.add_listener(webserver_notifier)
-    engine.add_listener(safe_price_notifier)
+    accountant_port = config.getint("engine", "accountant_base_port") + contract.id
+    router_share_async(accountant_export, "tcp://127.0.0.1:%d" % accountant_port)
+    log.msg("Listening for connections on port %d." % accountant_port)
 
-    # Cancel all orders with some quantity_left that have been dispatched but not cancelled
-    try:
-        for order in session.query(models.Order).filter_by(
-                is_cancelled=False).filter_by(
-                contract_id=contract.id).filter(
-                        models.Order.quantity_left > 0):
-            log.msg("Cancelling order %d" % order.id)
-            accountant.cancel_order(order.username, order.id)
-    except Exception as e:
-        session.rollback()
-        raise e
+    administrator_port = config.getint("engine", "administrator_base_port") + contract.id
+    router_share_async(administrator_export, "tcp://127.0.0.1:%d" % administrator_port)
+    log.msg("Listening for connections on port %d." % administrator_port)
 
-    engine.notify_init()
+    watchdog(config.get("watchdog", "engine") %
+             (config.getint("watchdog", "engine_base_port") + contract.id))
 
     reactor.run()
-
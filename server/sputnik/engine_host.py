@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+"""
+.. module:: engine_host
+
+Runs the matching engines of many contracts in one process.
+
+The active contracts are spread over ``[engine] host_workers`` worker
+processes by contract id. A worker runs the engine of each of its contracts
+in one reactor, with one database session, one watchdog and one set of
+proxies to the other components, and serves all of them on a single router
+socket for the accountants (and another for the administrator).
+
+Every call to an engine host names the ticker of the engine it is for as its
+first argument. Clients use :func:`engine_proxies`, which hands out an
+:class:`EngineProxy` per ticker that adds it, so that they can go on treating
+each engine as if it were its own process. With ``host_workers = 0`` every
+contract runs its own engine2.py as before.
+"""
+
+import config
+
+from zmq_util import export, dealer_proxy_async, ComponentExport
+from exception import RemoteCallException
+
+
+def worker_for_contract(contract_id, workers):
+    return contract_id % workers
+
+
+class EngineProxy:
+    """Looks like a proxy to a single engine, but calls the engine host which
+    runs it, passing the ticker along.
+    """
+
+    def __init__(self, proxy, ticker):
+        self.proxy = proxy
+        self.ticker = ticker
+
+    def __getattr__(self, key):
+        if key.startswith("__") and key.endswith("__"):
+            raise AttributeError
+
+        def routed_method(*args, **kwargs):
+            return getattr(self.proxy, key)(self.ticker, *args, **kwargs)
+
+        return routed_method
+
+
+def engine_proxies(contracts, component, codec="json", multiplexed=False):
+    """Connect to the engines of some contracts, wherever they are running.
+
+    :param contracts: the contracts whose engines we want
+    :type contracts: list
+    :param component: which engine export to use, "accountant" or "administrator"
+    :type component: str
+    :param codec: what to encode requests with, json or msgpack
+    :type codec: str
+    :param multiplexed: send all the calls made in a reactor tick together
+    :type multiplexed: bool
+    :returns: dict -- a proxy to each engine, by ticker
+    """
+    workers = config.getint("engine", "host_workers")
+    if not workers:
+        base_port = config.getint("engine", "%s_base_port" % component)
+        return {contract.ticker: dealer_proxy_async("tcp://127.0.0.1:%d" % (base_port + contract.id),
+                                                    codec=codec, multiplexed=multiplexed)
+                for contract in contracts}
+
+    base_port = config.getint("engine", "host_%s_base_port" % component)
+    hosts = [dealer_proxy_async("tcp://127.0.0.1:%d" % (base_port + worker), codec=codec,
+                                multiplexed=multiplexed)
+             for worker in range(workers)]
+    return {contract.ticker: EngineProxy(hosts[worker_for_contract(contract.id, workers)], contract.ticker)
+            for contract in contracts}
+
+
+class HostExport(ComponentExport):
+    def __init__(self, exports):
+        """
+        :param exports: the export of each engine we run, by ticker
+        :type exports: dict
+        """
+        self.exports = exports
+        ComponentExport.__init__(self, exports)
+
+    def engine(self, ticker):
+        if ticker not in self.exports:
+            raise RemoteCallException("Contract not hosted here: %s" % ticker)
+        return self.exports[ticker]
+
+
+class AccountantHostExport(HostExport):
+    @export
+    def place_order(self, ticker, order):
+        return self.engine(ticker).place_order(order)
+
+    @export
+    def place_orders(self, ticker, orders):
+        return self.engine(ticker).place_orders(orders)
+
+    @export
+    def cancel_order(self, ticker, id):
+        return self.engine(ticker).cancel_order(id)
+
+    @export
+    def cancel_orders(self, ticker, ids):
+        return self.engine(ticker).cancel_orders(ids)
+
+    @export
+    def mass_cancel(self, ticker, username=None, ids=None):
+        return self.engine(ticker).mass_cancel(username=username, ids=ids)
+
+    @export
+    def get_safe_price(self, ticker):
+        return self.engine(ticker).get_safe_price()
+
+    @export
+    def get_order_book(self, ticker, depth=None):
+        return self.engine(ticker).get_order_book(depth=depth)
+
+
+class AdministratorHostExport(HostExport):
+    @export
+    def get_order_book(self, ticker):
+        return self.engine(ticker).get_order_book()
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [-c config] worker")
+    parser.add_option("-c", "--config", dest="filename",
+                      help="config file", default=None)
+    (options, args) = parser.parse_args()
+    if options.filename:
+        config.reconfigure(options.filename)
+
+    import sys
+    import database
+    import models
+    import engine2
+    from accountant import AccountantProxy
+    from watchdog import watchdog
+    from zmq_util import router_share_async, push_proxy_async, connect_publisher
+    from twisted.internet import reactor
+    from twisted.python import log
+
+    log.startLogging(sys.stdout)
+    worker = int(args[0])
+    workers = config.getint("engine", "host_workers")
+    if worker >= workers:
+        parser.error("worker %d does not exist, there are %d engine host workers" % (worker, workers))
+
+    session = database.make_session()
+    try:
+        contracts = [contract for contract in session.query(models.Contract).filter_by(active=True)
+                     if contract.contract_type != "cash" and
+                     worker_for_contract(contract.id, workers) == worker]
+    except Exception as e:
+        session.rollback()
+        raise e
+
+    accountant = AccountantProxy("push",
+                                 config.get("accountant", "engine_export"),
+                                 config.getint("accountant", "engine_export_base_port"),
+                                 codec=config.get("engine", "codec"))
+    accountant.watch_shards(session)
+    webserver = push_proxy_async(config.get("webserver", "engine_export"))
+    forwarder = connect_publisher(config.get("safe_price_forwarder", "zmq_frontend_address"))
+
+    accountant_exports = {}
+    administrator_exports = {}
+    for contract in contracts:
+        accountant_exports[contract.ticker], administrator_exports[contract.ticker] = \
+            engine2.start_engine(session, contract, accountant, webserver, forwarder)
+    log.msg("Engine host %d of %d running %s." % (worker + 1, workers,
+                                                 ", ".join(contract.ticker for contract in contracts)))
+
+    accountant_port = config.getint("engine", "host_accountant_base_port") + worker
+    router_share_async(AccountantHostExport(accountant_exports), "tcp://127.0.0.1:%d" % accountant_port)
+    log.msg("Listening for connections on port %d." % accountant_port)
+
+    administrator_port = config.getint("engine", "host_administrator_base_port") + worker
+    router_share_async(AdministratorHostExport(administrator_exports), "tcp://127.0.0.1:%d" % administrator_port)
+    log.msg("Listening for connections on port %d." % administrator_port)
+
+    watchdog(config.get("watchdog", "engine") %
+             (config.getint("watchdog", "engine_host_base_port") + worker))
+
+    reactor.run()
@@ -16,4 +16,5 @@ class ZendeskException(SputnikException): pass
 class PostgresException(SputnikException): pass
 class RestException(SputnikException): pass
 class RemoteCallException(Exception): pass
-class RemoteCallTimedOut(SputnikException, RemoteCallException): pass
\ No newline at end of file
+class RemoteCallTimedOut(SputnikException, RemoteCallException): pass
+class RemoteCallUnsupportedCodec(SputnikException, RemoteCallException): pass
\ No newline at end of file
@@ -0,0 +1,269 @@
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+"""
+.. module:: journal
+
+An append-only binary journal of the changes made to an engine's order book,
+used to rebuild the book after a restart without going to the database.
+
+The journal records the effect of each request on the book rather than the
+request itself, so replaying it does not match orders again:
+
+* QUEUE  -- an order (or the remainder of one) now rests on the book
+* FILL   -- a resting order was traded against for some quantity
+* CANCEL -- a resting order was removed
+
+Each record is framed with its length and a CRC32 so that a record torn by a
+crash is detected. Replay stops at the first bad record and truncates the
+journal there.
+
+To keep restarts fast the journal is compacted from time to time: a snapshot
+of every resting order is written next to it, as QUEUE records in book
+order, and the journal starts over. Both files carry a generation number.
+A snapshot of generation n covers every journal of generation less than n,
+so if we crash after writing a snapshot but before starting the new journal,
+the old journal is ignored rather than replayed twice.
+"""
+
+import os
+import struct
+import zlib
+
+from twisted.python import log
+
+QUEUE = "Q"
+FILL = "F"
+CANCEL = "C"
+
+VERSION = 1
+JOURNAL_MAGIC = "SPKJ"
+SNAPSHOT_MAGIC = "SPKS"
+
+# magic, version, generation
+JOURNAL_HEADER = struct.Struct("<4sBQ")
+# magic, version, generation, number of orders
+SNAPSHOT_HEADER = struct.Struct("<4sBQQ")
+# payload length, crc32 of the payload
+FRAME = struct.Struct("<II")
+# type, id, side, price, quantity, quantity_left, timestamp, username length
+QUEUE_RECORD = struct.Struct("<cqbqqqqH")
+# type, id, quantity
+FILL_RECORD = struct.Struct("<cqq")
+# type, id
+CANCEL_RECORD = struct.Struct("<cq")
+
+
+def frame(payload):
+    return FRAME.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def encode_queue(order):
+    username = (order.username or "").encode("utf-8")
+    return QUEUE_RECORD.pack(QUEUE, order.id, order.side, order.price, order.quantity,
+                             order.quantity_left, order.timestamp, len(username)) + username
+
+
+def decode(payload):
+    """Decode a record payload into a tuple whose first element is the type.
+    """
+    kind = payload[0]
+    if kind == QUEUE:
+        fields = QUEUE_RECORD.unpack_from(payload)
+        username = payload[QUEUE_RECORD.size:QUEUE_RECORD.size + fields[7]].decode("utf-8")
+        return (QUEUE, {"id": fields[1], "side": fields[2], "price": fields[3],
+                        "quantity": fields[4], "quantity_left": fields[5],
+                        "timestamp": fields[6], "username": username or None})
+    elif kind == FILL:
+        return FILL_RECORD.unpack(payload)
+    elif kind == CANCEL:
+        return CANCEL_RECORD.unpack(payload)
+    raise ValueError("Unknown journal record type %r" % kind)
+
+
+def read_records(data, offset):
+    """Decode the framed records in data from offset onwards.
+
+    :returns: tuple -- the records, and the offset just past the last good one
+    """
+    records = []
+    while offset + FRAME.size <= len(data):
+        length, crc = FRAME.unpack_from(data, offset)
+        payload = data[offset + FRAME.size:offset + FRAME.size + length]
+        if len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+            break
+        records.append(decode(payload))
+        offset += FRAME.size + length
+    return records, offset
+
+
+def check_version(path, magic, expected_magic, version):
+    if magic != expected_magic or version != VERSION:
+        raise Exception("%s is not a version %d %s file" %
+                        (path, VERSION, "journal" if expected_magic == JOURNAL_MAGIC else "snapshot"))
+
+
+def write_atomically(path, data):
+    """Replace the file at path with data, so that a crash leaves either the
+    old or the new file.
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as temp_file:
+        temp_file.write(data)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.rename(temp_path, path)
+
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+class Journal:
+    """Appends book changes to a file.
+
+    Records are buffered in memory until write() is called, and are only
+    guaranteed to survive a machine crash once sync() has been called.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.generation = 0
+        # Records written since the last compaction
+        self.records = 0
+        self.buffer = []
+        self.file = None
+
+    def read_snapshot(self):
+        """
+        :returns: tuple -- the generation of the snapshot and its records
+        """
+        if not os.path.exists(self.snapshot_path):
+            return 0, []
+
+        with open(self.snapshot_path, "rb") as snapshot_file:
+            data = snapshot_file.read()
+
+        magic, version, generation, count = SNAPSHOT_HEADER.unpack_from(data)
+        check_version(self.snapshot_path, magic, SNAPSHOT_MAGIC, version)
+        records, offset = read_records(data, SNAPSHOT_HEADER.size)
+        if len(records) != count or offset != len(data):
+            raise Exception("Snapshot %s is corrupt" % self.snapshot_path)
+
+        return generation, records
+
+    def replay(self):
+        """Read back every complete record in the journal, truncating any
+        torn record at the end.
+
+        :returns: tuple -- the generation of the journal and its records
+        """
+        if not os.path.exists(self.path):
+            return 0, []
+
+        with open(self.path, "r+b") as journal_file:
+            data = journal_file.read()
+
+            if data.startswith(JOURNAL_MAGIC):
+                magic, version, generation = JOURNAL_HEADER.unpack_from(data)
+                check_version(self.path, magic, JOURNAL_MAGIC, version)
+                records, offset = read_records(data, JOURNAL_HEADER.size)
+            else:
+                # Journals from before compaction have no header
+                generation = 0
+                records, offset = read_records(data, 0)
+
+            if offset != len(data):
+                log.msg("Truncating %d bytes of torn journal records in %s." %
+                        (len(data) - offset, self.path))
+                journal_file.truncate(offset)
+
+        return generation, records
+
+    def restore(self):
+        """Read back the latest snapshot and the journal written after it.
+
+        :returns: list -- the records to replay, in order
+        """
+        snapshot_generation, snapshot = self.read_snapshot()
+        generation, records = self.replay()
+
+        if generation < snapshot_generation:
+            # We crashed while compacting, the snapshot already has all of it
+            log.msg("Ignoring journal generation %d, snapshot is generation %d." %
+                    (generation, snapshot_generation))
+            self.start(snapshot_generation)
+            records = []
+
+        self.generation = max(generation, snapshot_generation)
+        self.records = len(records)
+        return snapshot + records
+
+    def start(self, generation):
+        """Replace the journal with an empty one of the given generation.
+        """
+        write_atomically(self.path, JOURNAL_HEADER.pack(JOURNAL_MAGIC, VERSION, generation))
+
+    def compact(self, orders):
+        """Write a snapshot of the resting orders and start a new journal.
+
+        :param orders: every order on the book, in priority order
+        """
+        self.write()
+        self.sync()
+
+        generation = self.generation + 1
+        records = [frame(encode_queue(order)) for order in orders]
+        write_atomically(self.snapshot_path,
+                         SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, VERSION, generation, len(records)) +
+                         "".join(records))
+
+        self.file.close()
+        self.start(generation)
+        self.file = open(self.path, "ab")
+        self.generation = generation
+        self.records = 0
+        log.msg("Compacted journal %s to a snapshot of %d orders, generation %d." %
+                (self.path, len(records), generation))
+
+    def open(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            self.start(self.generation)
+        self.file = open(self.path, "ab")
+
+    def close(self):
+        if self.file is not None:
+            self.write()
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def queue(self, order):
+        self.buffer.append(frame(encode_queue(order)))
+
+    def fill(self, id, quantity):
+        self.buffer.append(frame(FILL_RECORD.pack(FILL, id, quantity)))
+
+    def cancel(self, id):
+        self.buffer.append(frame(CANCEL_RECORD.pack(CANCEL, id)))
+
+    def write(self):
+        """Hand the buffered records to the operating system.
+        """
+        if self.buffer:
+            self.file.write("".join(self.buffer))
+            self.file.flush()
+            self.records += len(self.buffer)
+            self.buffer = []
+
+    def sync(self):
+        """Make sure everything written so far is on disk.
+        """
+        os.fsync(self.file.fileno())
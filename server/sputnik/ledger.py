@@ -10,15 +10,16 @@
 import os
 import sys
 import json
+import random
 import datetime
 from collections import defaultdict
 
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed, fail
 from twisted.protocols.policies import TimeoutMixin
 from twisted.python import log
 
-from sqlalchemy.exc import SQLAlchemyError, DBAPIError
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError, OperationalError
 from sqlalchemy.sql import select
 
 import config
@@ -29,7 +30,6 @@ from zmq_util import router_share_async, export, ComponentExport
 from util import timed
 from rpc_schema import schema
 from watchdog import watchdog
-import time
 from exception import *
 
 ARGUMENT_ERROR = LedgerException("exceptions/ledger/argument_error")
@@ -80,146 +80,299 @@ class PostingGroup(TimeoutMixin):
         self.fail(GROUP_TIMEOUT)
 
 class Ledger:
-    def __init__(self, engine, timeout=None):
+    """
+    Records posting groups in the database.
+
+    A group is checked as soon as all its postings are in, but with a
+    commit_interval it is only written once that much time has passed or
+    commit_size groups are waiting, together with the others, in one
+    transaction. If that transaction fails each group is tried on its own,
+    so that one bad group does not fail the rest.
+
+    Contract ids and user types are cached, up to cache_size of each. They
+    are not expected to change, but the administrator tells us when they
+    might have with reload_contract and reload_user.
+
+    Each commit runs on one connection from the engine's pool. If the
+    connection is lost, or the database asks us to, the commit is retried
+    up to retries times, waiting a random time of up to backoff seconds,
+    doubling each time to at most max_backoff, before each retry. That
+    keeps every ledger from reconnecting at the same moment after a
+    failover. The wait is a timer, so the ledger keeps taking postings
+    meanwhile, and they go out with the next commit: only one commit
+    runs at a time.
+    """
+
+    def __init__(self, engine, timeout=None, commit_interval=0, commit_size=1, cache_size=10000,
+                 retries=10, backoff=0.05, max_backoff=5):
         self.engine = engine
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # the inserts are built once so that they are only compiled once
+        self.journal_insert = Journal.__table__.insert()
+        self.posting_insert = Posting.__table__.insert()
+        self.compiled_cache = {}
+        self.contract_ids = util.LRUCache(cache_size)
+        self.user_types = util.LRUCache(cache_size)
         self.pending = defaultdict(lambda: PostingGroup(timeout))
-
-    def execute(self, *args, **kwargs):
-        conn = self.engine.connect()
-        count = 0
-        while count < 10:
+        self.commit_interval = commit_interval
+        self.commit_size = commit_size
+        # groups which are complete and checked, waiting to be committed
+        self.ready = []
+        self.flush_call = None
+        # the commit in progress
+        self.committing = None
+        self.callLater = reactor.callLater
+
+    def warm(self, connections):
+        """
+        Open connections ahead of time so that the first commits do not
+        have to.
+
+        :param connections: how many
+        """
+        conns = [self.engine.connect() for i in range(connections)]
+        for conn in conns:
+            conn.close()
+
+    def prepared(self, conn):
+        """
+        :returns: Connection -- conn, but reusing the SQL compiled for our
+            inserts the last time they ran
+        """
+        return conn.execution_options(compiled_cache=self.compiled_cache)
+
+    def backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def run_in_transaction(self, function):
+        """
+        Call function with a connection and commit what it did.
+
+        :param function: takes a Connection
+        :returns: Deferred -- fires with whatever function returns
+        """
+        def attempt(number):
+            conn = self.engine.connect()
             try:
-                result = conn.execute(*args, **kwargs)
-                conn.close()
-                return result
+                with conn.begin():
+                    return succeed(function(conn))
             except DBAPIError as e:
                 if e.connection_invalidated:
                     log.err("Connection invalidated! Trying again - %s" % str(e))
+                elif isinstance(e, OperationalError):
+                    log.err("Unable to execute transaction: %s - trying again" % str(e))
                 else:
-                    log.err("Unable to execute query: %s %s: %s - trying again" % (args, kwargs, str(e)))
-
-                conn = self.engine.connect()
-                count += 1
+                    # it will only fail the same way again
+                    return fail()
+            except Exception:
+                return fail()
+            finally:
+                conn.close()
 
-        log.err("Tried to reconnect 10 times, no joy")
-        raise DATABASE_ERROR
+            if number + 1 >= self.retries:
+                log.err("Tried to reconnect %d times, no joy" % self.retries)
+                return fail(DATABASE_ERROR)
 
-    @timed
-    def atomic_commit(self, postings):
+            retry = Deferred()
+            self.callLater(self.backoff_delay(number), retry.callback, number + 1)
+            return retry.addCallback(attempt)
 
-        start = time.time()
-        log.msg("atomic commit called for %s at %f" % (postings, start))
-        try:
-            # sanity check
-            if len(postings) == 0:
-                raise INTERNAL_ERROR
+        return attempt(0)
 
+    def reload_contract(self, ticker):
+        self.contract_ids.invalidate(ticker)
 
-            types = [posting["type"] for posting in postings]
-            counts = [posting["count"] for posting in postings]
+    def reload_user(self, username):
+        self.user_types.invalidate(username)
 
-            if not all(type == types[0] for type in types):
-                raise TYPE_MISMATCH
-            if not all(count == counts[0] for count in counts):
-                raise COUNT_MISMATCH
+    def lookup(self, conn, cache, key_column, value_column, keys):
+        """
+        Look keys up in the cache, going to the database for those which
+        are not in it.
 
-            # balance check
-            debitsum = defaultdict(int)
-            creditsum = defaultdict(int)
+        :returns: dict -- the value of each key which exists
+        """
+        values = {}
+        missing = []
+        for key in keys:
+            value = cache.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                values[key] = value
 
-            log.msg("auditing postings at %f" % (time.time() - start))
-            for posting in postings:
-                if posting["direction"] == "debit":
-                    debitsum[posting["contract"]] += posting["quantity"]
-                if posting["direction"] == "credit":
-                    creditsum[posting["contract"]] += posting["quantity"]
+        if missing:
+            for key, value in conn.execute(select([key_column, value_column], key_column.in_(missing))):
+                cache[key] = value
+                values[key] = value
 
-            for ticker in debitsum:
-                if debitsum[ticker] - creditsum[ticker] is not 0:
-                    raise QUANTITY_MISMATCH
+        return values
 
-            # create the journal and postings
-            # The journal is created separately from the postings but this is ok because
-            # all the postings are created at once. If the posting commit fails then we'll
-            # just end up with an empty journal which won't break anything
-            # TODO: Create the journal and postings together
-            log.msg("creating the journal at %f" % (time.time() - start))
-            ins = Journal.__table__.insert()
+    def check(self, postings):
+        """
+        Make sure a posting group is consistent and balances.
 
-            result = self.execute(ins, type=types[0], timestamp=datetime.datetime.utcnow())
+        :raises: LedgerException
+        """
+        # sanity check
+        if len(postings) == 0:
+            raise INTERNAL_ERROR
+
+        types = [posting["type"] for posting in postings]
+        counts = [posting["count"] for posting in postings]
+
+        if not all(type == types[0] for type in types):
+            raise TYPE_MISMATCH
+        if not all(count == counts[0] for count in counts):
+            raise COUNT_MISMATCH
+
+        # balance check
+        debitsum = defaultdict(int)
+        creditsum = defaultdict(int)
+
+        for posting in postings:
+            if posting["direction"] == "debit":
+                debitsum[posting["contract"]] += posting["quantity"]
+            if posting["direction"] == "credit":
+                creditsum[posting["contract"]] += posting["quantity"]
+
+        for ticker in debitsum:
+            if debitsum[ticker] - creditsum[ticker] is not 0:
+                raise QUANTITY_MISMATCH
+
+    def insert_journals(self, conn, journals):
+        """
+        :returns: list -- the id of each journal
+        """
+        table = Journal.__table__
+        if len(journals) > 1 and self.engine.dialect.implicit_returning:
+            # postgres hands back the ids of a multi-row insert in order
+            result = conn.execute(table.insert().values(journals).returning(table.c.id))
+            return [row[0] for row in result]
+        return [self.prepared(conn).execute(self.journal_insert, journal).inserted_primary_key[0]
+                for journal in journals]
 
-            journal_id = result.inserted_primary_key[0]
+    @timed
+    def commit(self, groups):
+        """
+        Write posting groups which have been checked in one transaction.
+
+        :param groups: the postings of each group
+        :type groups: list
+        :returns: Deferred
+        """
+        def write(conn):
+            tickers = set(posting["contract"] for postings in groups for posting in postings)
+            contract_table = Contract.__table__
+            contract_ids = self.lookup(conn, self.contract_ids,
+                                       contract_table.c.ticker, contract_table.c.id, tickers)
+
+            usernames = set(posting["username"] for postings in groups for posting in postings)
+            user_table = User.__table__
+            user_types = self.lookup(conn, self.user_types,
+                                     user_table.c.username, user_table.c.type, usernames)
+
+            now = datetime.datetime.utcnow()
+            journal_ids = self.insert_journals(conn, [{"type": postings[0]["type"], "timestamp": now}
+                                                      for postings in groups])
 
-            log.msg("creating the db postings at %f" % (time.time() - start))
             db_postings = []
-            for posting in postings:
-                contract_table = Contract.__table__
-                s = select([contract_table.c.id], contract_table.c.ticker==posting["contract"])
-                result = self.execute(s)
-                contract_id = result.first()[0]
-
-                user_table = User.__table__
-                s = select([user_table.c.type], user_table.c.username==posting["username"])
-                result = self.execute(s)
-                user_type = result.first()[0]
-
-                username = posting["username"]
-                quantity = posting["quantity"]
-                direction = posting["direction"]
-                note = posting["note"]
-                if posting["timestamp"] is not None:
-                    timestamp = util.timestamp_to_dt(posting["timestamp"])
-                else:
-                    timestamp = None
+            for journal_id, postings in zip(journal_ids, groups):
+                for posting in postings:
+                    if posting["contract"] not in contract_ids or posting["username"] not in user_types:
+                        raise ARGUMENT_ERROR
 
-                if direction == 'debit':
-                    if user_type == 'Asset':
-                        sign = 1
+                    if posting["timestamp"] is not None:
+                        timestamp = util.timestamp_to_dt(posting["timestamp"])
                     else:
-                        sign = -1
-                else:
-                    if user_type == 'Asset':
-                        sign = -1
-                    else:
-                        sign = 1
-
-                posting = {'username': username,
-                           'contract_id': contract_id,
-                           'quantity': sign * quantity,
-                           'note': note,
-                           'timestamp': timestamp,
-                           'journal_id': journal_id
-                }
-                db_postings.append(posting)
-                log.msg("done making posting at %f: %s" % (time.time() - start, posting))
-
-
-            ins = Posting.__table__.insert()
-            result = self.execute(ins, db_postings)
-            log.msg("Inserted %d rows of %d postings" % (result.rowcount, len(db_postings)))
-            log.msg("Done committing postings at %f" % (time.time() - start))
-
-
-            return True
+                        timestamp = None
 
-        except Exception, e:
+                    if posting["direction"] == 'debit':
+                        if user_types[posting["username"]] == 'Asset':
+                            sign = 1
+                        else:
+                            sign = -1
+                    else:
+                        if user_types[posting["username"]] == 'Asset':
+                            sign = -1
+                        else:
+                            sign = 1
+
+                    db_postings.append({'username': posting["username"],
+                                        'contract_id': contract_ids[posting["contract"]],
+                                        'quantity': sign * posting["quantity"],
+                                        'note': posting["note"],
+                                        'timestamp': timestamp,
+                                        'journal_id': journal_id})
+
+            result = self.prepared(conn).execute(self.posting_insert, db_postings)
+            log.msg("Inserted %d rows of %d postings in %d journals" %
+                    (result.rowcount, len(db_postings), len(journal_ids)))
+
+        def failed(failure):
             log.err("Caught exception trying to commit. Postings were:")
-            for posting in postings:
-                log.err(str(posting))
+            for postings in groups:
+                for posting in postings:
+                    log.err(str(posting))
             log.err("Stack trace follows:")
-            log.err()
-            if isinstance(e, SQLAlchemyError):
+            log.err(failure)
+            if failure.check(SQLAlchemyError):
                 raise DATABASE_ERROR
-            raise e
+            return failure
+
+        return self.run_in_transaction(write).addErrback(failed)
+
+    def flush(self):
+        """
+        Commit every group which is ready. If a commit is in progress they
+        go out once it is done.
+
+        :returns: Deferred -- fires once they are committed
+        """
+        if self.flush_call is not None:
+            if self.flush_call.active():
+                self.flush_call.cancel()
+            self.flush_call = None
+
+        if self.committing is None:
+            ready, self.ready = self.ready, []
+            if not ready:
+                return succeed(None)
+
+            def committed(ignored):
+                for group in ready:
+                    group.succeed()
+
+            def failed(failure):
+                if len(ready) == 1:
+                    ready[0].fail(failure.value)
+                    return
+
+                log.msg("Group commit of %d posting groups failed, committing them one at a time." % len(ready))
+                d = succeed(None)
+                for group in ready:
+                    d.addCallback(lambda ignored, group=group: self.commit([group.postings]))
+                    d.addCallbacks(lambda ignored, group=group: group.succeed(),
+                                   lambda failure, group=group: group.fail(failure.value))
+                return d
+
+            self.committing = committing = self.commit([group.postings for group in ready])
+            committing.addCallbacks(committed, failed)
+            committing.addBoth(self.committed)
+        else:
+            committing = self.committing
+
+        result = Deferred()
+        committing.addBoth(lambda ignored: result.callback(None))
+        return result
 
-        finally:
-            # We have a long running session object, so we must make sure it
-            # is clean at all times. If there is an exception in the exception
-            # handler, session.rollback() might not get called. This way it is
-            # guaranteed to happen.
-            # 
-            # This is safe to run after a commit.
-            pass
+    def committed(self, ignored):
+        self.committing = None
+        # these became ready while we were committing
+        if self.ready:
+            return self.flush()
 
     def post_one(self, posting):
         uid = posting["uid"]
@@ -232,12 +385,21 @@ class Ledger:
         # consistency yet. Wait until we have them all.
 
         if group.ready():
+            del self.pending[uid]
             try:
-                self.atomic_commit(group.postings)
-                group.succeed()
+                self.check(group.postings)
             except Exception, e:
+                log.err("Posting group with uid: %s is invalid: %s" % (uid, e))
                 group.fail(e)
-            del self.pending[uid]
+                return response
+
+            # the group is complete, stop its timer while it waits
+            group.setTimeout(None)
+            self.ready.append(group)
+            if not self.commit_interval or len(self.ready) >= self.commit_size:
+                self.flush()
+            elif self.flush_call is None:
+                self.flush_call = self.callLater(self.commit_interval, self.flush)
        
         return response
 
@@ -269,6 +431,21 @@ class AccountantExport(ComponentExport):
     def post(self, *postings):
         return self.ledger.post(list(postings))
 
+class AdministratorExport(ComponentExport):
+    def __init__(self, ledger):
+        self.ledger = ledger
+        ComponentExport.__init__(self, ledger)
+
+    @export
+    @schema("rpc/ledger.json#reload_contract")
+    def reload_contract(self, ticker):
+        return self.ledger.reload_contract(ticker)
+
+    @export
+    @schema("rpc/ledger.json#reload_user")
+    def reload_user(self, username):
+        return self.ledger.reload_user(username)
+
 def create_posting(type, username, contract, quantity, direction, note=None, timestamp=None):
     if timestamp is None:
         timestamp = util.dt_to_timestamp(datetime.datetime.utcnow())
@@ -279,12 +456,25 @@ def create_posting(type, username, contract, quantity, direction, note=None, tim
 if __name__ == "__main__":
     fo = log.startLogging(sys.stdout)
     fo.formatTime = lambda x: datetime.datetime.fromtimestamp(x).strftime("%Y-%m-%d %H:%M:%S.%f")
-    engine = database.make_engine()
+    engine = database.make_engine(engine_args={"pool_size": config.getint("ledger", "pool_size"),
+                                               "max_overflow": config.getint("ledger", "max_overflow"),
+                                               "pool_recycle": config.getint("ledger", "pool_recycle")})
     timeout = config.getint("ledger", "timeout")
-    ledger = Ledger(engine, timeout)
+    ledger = Ledger(engine, timeout,
+                    commit_interval=config.getfloat("ledger", "commit_interval"),
+                    commit_size=config.getint("ledger", "commit_size"),
+                    cache_size=config.getint("ledger", "cache_size"),
+                    retries=config.getint("ledger", "retries"),
+                    backoff=config.getfloat("ledger", "backoff"),
+                    max_backoff=config.getfloat("ledger", "max_backoff"))
+    reactor.addSystemEventTrigger("before", "shutdown", ledger.flush)
+    ledger.warm(config.getint("ledger", "pool_size"))
     accountant_export = AccountantExport(ledger)
+    administrator_export = AdministratorExport(ledger)
     watchdog(config.get("watchdog", "ledger"))
     router_share_async(accountant_export,
             config.get("ledger", "accountant_export"))
+    router_share_async(administrator_export,
+            config.get("ledger", "administrator_export"))
     reactor.run()
 
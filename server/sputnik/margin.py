@@ -18,170 +18,334 @@ class MarginException(Exception):
     pass
 
 
-def calculate_margin(user, session, safe_prices={}, order_id=None, withdrawals=None, trial_period=False, position_overrides={},
-                     cash_overrides={}):
+def order_cash_spent(user, contract, side, price, quantity, quantity_left, trial_period=False, fees=None):
     """
-    calculates the low and high margin for a given user
-    :param order_id: order we're considering throwing in
-    :type order_id: int
-    :param user: the user
-    :type user: User
+    what an open order could take out of each cash position, fees included
+    :param fees: the fees of the order, if we already know them
+    :type fees: dict
+    :returns: dict - the amount by cash ticker
+    """
+    if fees is None:
+        fees = util.get_fees(user, contract, price, quantity, trial_period=trial_period)
+    fees = dict(fees)
+    cash_spent = collections.defaultdict(int)
+
+    # Deal with cash_pair orders separately because there are no cash_pair positions
+    if contract.contract_type == 'cash_pair':
+        transaction_size = util.get_cash_spent(contract, price, quantity)
+
+        if side == 'BUY':
+            cash_spent[contract.denominated_contract.ticker] += transaction_size
+            if contract.payout_contract.ticker in fees:
+                fees[contract.payout_contract.ticker] = max(0, fees[contract.payout_contract.ticker] - quantity_left)
+        if side == 'SELL':
+            cash_spent[contract.payout_contract.ticker] += quantity_left
+            if contract.denominated_contract.ticker in fees:
+                fees[contract.denominated_contract.ticker] = max(0, fees[contract.denominated_contract.ticker] - transaction_size)
+
+    for ticker, fee in fees.iteritems():
+        cash_spent[ticker] += fee
+
+    return cash_spent
+
+
+def contract_margin(position, orders, safe_prices):
+    """
+    the low and high margin needed for one non-cash contract
+    :param position: the position, as in position_overrides
+    :type position: dict
+    :param orders: totals over the open orders in the contract
+    :type orders: dict
     :returns: tuple - low and high margin
     """
+    contract = position['contract']
+    max_position = position['position'] + orders['buy']
+    min_position = position['position'] - orders['sell']
+
+    if contract.contract_type == 'futures':
+        if contract.ticker not in safe_prices:
+            log.err("%s not in safe_prices, marking margin high" % contract.ticker)
+            return 2**48, 2**48
 
-    low_margin = high_margin = 0
+        SAFE_PRICE = safe_prices[contract.ticker]
 
-    cash_position = collections.defaultdict(int)
+        if position['reference_price'] is None:
+            if position['position'] != 0:
+                raise MarginException("No reference price with non-zero position")
 
-    # let's start with positions
-    positions = {position.contract.ticker: { 'position': position.position,
-                                         'reference_price': position.reference_price,
-                                         'contract': position.contract }
-                 for position in
-                 session.query(models.Position).filter_by(user=user)}
+            reference_price = SAFE_PRICE
+        else:
+            reference_price = position['reference_price']
 
-    # Override some positions
-    positions.update(position_overrides)
+        # We divide by 100 because contract.margin_low and contract.margin_high are percentages from 0-100
+        low_max = abs(max_position) * contract.margin_low * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + max_position * (
+            reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
+        low_min = abs(min_position) * contract.margin_low * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + min_position * (
+            reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
+        high_max = abs(max_position) * contract.margin_high * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + max_position * (
+            reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
+        high_min = abs(min_position) * contract.margin_high * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + min_position * (
+            reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
+        log.msg("%s" % ["Margin:", contract.ticker, max_position, min_position, low_max, low_min, high_max, high_min])
 
-    open_orders = session.query(models.Order).filter_by(user=user).filter(
-        models.Order.quantity_left > 0).filter_by(is_cancelled=False, accepted=True).all()
+        return max(low_max, low_min), max(high_max, high_min)
 
-    if order_id:
-        open_orders += session.query(models.Order).filter_by(id=order_id).all()
-
-    # Make a blank position for all contracts which have an open order but no position
-    for order in open_orders:
-        if order.contract.ticker not in positions:
-            positions[order.contract.ticker] = {
-                'position': 0,
-                'reference_price': None,
-                'contract': order.contract
-            }
-
-    for position in positions.values():
-        max_position = position['position'] + sum(
-            order.quantity_left for order in open_orders if
-            order.contract == position['contract'] and order.side == 'BUY')
-        min_position = position['position'] - sum(
-            order.quantity_left for order in open_orders if
-            order.contract == position['contract'] and order.side == 'SELL')
-
-        contract = position['contract']
-
-        if contract.contract_type == 'futures':
-            if contract.ticker not in safe_prices:
-                log.err("%s not in safe_prices, marking margin high" % contract.ticker)
-                high_margin += 2**48
-                low_margin += 2**48
+    if contract.contract_type == 'prediction':
+        payoff = contract.lot_size
+
+        # case where all our buy orders are hit: orders['spent']
+        # case where all our sell orders are hit: orders['received']
+        worst_short_cover = -min_position * payoff if min_position < 0 else 0
+        best_short_cover = -max_position * payoff if max_position < 0 else 0
+
+        additional_margin = max(orders['spent'] + best_short_cover, -orders['received'] + worst_short_cover)
+        return additional_margin, additional_margin
+
+    return 0, 0
+
+
+def no_orders(contract):
+    return {'contract': contract, 'buy': 0, 'sell': 0, 'spent': 0, 'received': 0, 'count': 0}
+
+
+class MarginState:
+    """
+    The positions and open orders of one user, and what they add up to, kept
+    up to date as orders are accepted, filled and cancelled and as positions
+    change. Checking the margin for a new order then only looks at the
+    contracts the user holds, however many orders the user has open.
+
+    The margin of each contract is remembered along with the safe price it
+    was worked out at, and only worked out again when the contract's position
+    or orders change or the safe price moves.
+    """
+
+    def __init__(self, user, trial_period=False):
+        self.user = user
+        self.trial_period = trial_period
+        # by ticker, as in position_overrides
+        self.positions = {}
+        # by order id
+        self.orders = {}
+        # totals over the open orders in each contract, by ticker
+        self.contract_orders = {}
+        # what the open orders could take out of each cash position, and how
+        # many orders have a share in it, by ticker
+        self.cash_spent = collections.defaultdict(int)
+        self.cash_spent_orders = collections.defaultdict(int)
+        # the safe price and low and high margin last worked out, by ticker
+        self.contract_margins = {}
+
+    @classmethod
+    def from_session(cls, user, session, trial_period=False):
+        state = cls(user, trial_period=trial_period)
+        for position in session.query(models.Position).filter_by(user=user):
+            state.set_position(position.contract, position.position, position.reference_price)
+
+        for order in session.query(models.Order).filter_by(user=user).filter(
+                models.Order.quantity_left > 0).filter_by(is_cancelled=False, accepted=True):
+            state.add_order(order)
+
+        return state
+
+    def open_order(self, order, quantity_left=None):
+        if quantity_left is None:
+            quantity_left = order.quantity_left
+        contract = order.contract
+        fees = util.get_fees(self.user, contract, order.price, order.quantity, trial_period=self.trial_period)
+        open_order = {'contract': contract,
+                      'side': order.side,
+                      'price': order.price,
+                      'quantity': order.quantity,
+                      'quantity_left': quantity_left,
+                      'fees': fees}
+        self.order_totals(open_order)
+        return open_order
+
+    def order_totals(self, order):
+        contract = order['contract']
+        quantity_left = order['quantity_left']
+        order['buy'] = quantity_left if order['side'] == 'BUY' else 0
+        order['sell'] = quantity_left if order['side'] == 'SELL' else 0
+        value = quantity_left * order['price'] * contract.lot_size / contract.denominator
+        order['spent'] = value if order['side'] == 'BUY' else 0
+        order['received'] = value if order['side'] == 'SELL' else 0
+        order['cash_spent'] = order_cash_spent(self.user, contract, order['side'], order['price'],
+                                               order['quantity'], quantity_left, fees=order['fees'])
+
+    def count_order(self, order, sign):
+        ticker = order['contract'].ticker
+        totals = self.contract_orders.setdefault(ticker, no_orders(order['contract']))
+        for key in 'buy', 'sell', 'spent', 'received':
+            totals[key] += sign * order[key]
+        totals['count'] += sign
+        if not totals['count']:
+            del self.contract_orders[ticker]
+        self.contract_margins.pop(ticker, None)
+
+        for cash_ticker, spent in order['cash_spent'].iteritems():
+            self.cash_spent[cash_ticker] += sign * spent
+            self.cash_spent_orders[cash_ticker] += sign
+            if not self.cash_spent_orders[cash_ticker]:
+                del self.cash_spent[cash_ticker]
+                del self.cash_spent_orders[cash_ticker]
+
+    def add_order(self, order, quantity_left=None):
+        """
+        :param order: an order which has been accepted
+        :type order: Order
+        :param quantity_left: what is left of the order, if not order.quantity_left
+        :type quantity_left: int
+        """
+        if order.id in self.orders:
+            return
+        open_order = self.open_order(order, quantity_left)
+        if open_order['quantity_left'] <= 0:
+            return
+        self.orders[order.id] = open_order
+        self.count_order(open_order, 1)
+
+    def fill_order(self, id, quantity):
+        open_order = self.orders.get(id)
+        if open_order is None:
+            return
+        self.count_order(open_order, -1)
+        open_order['quantity_left'] -= quantity
+        if open_order['quantity_left'] <= 0:
+            del self.orders[id]
+            return
+        self.order_totals(open_order)
+        self.count_order(open_order, 1)
+
+    def remove_order(self, id):
+        open_order = self.orders.pop(id, None)
+        if open_order is not None:
+            self.count_order(open_order, -1)
+
+    def set_position(self, contract, position, reference_price=None):
+        self.positions[contract.ticker] = {'position': position,
+                                           'reference_price': reference_price,
+                                           'contract': contract}
+        self.contract_margins.pop(contract.ticker, None)
+
+    def adjust_position(self, contract, quantity):
+        if contract.ticker not in self.positions:
+            self.set_position(contract, 0)
+        self.positions[contract.ticker]['position'] += quantity
+        self.contract_margins.pop(contract.ticker, None)
+
+    def set_reference_price(self, contract, reference_price):
+        if contract.ticker not in self.positions:
+            self.set_position(contract, 0)
+        self.positions[contract.ticker]['reference_price'] = reference_price
+        self.contract_margins.pop(contract.ticker, None)
+
+    def margin(self, safe_prices={}, orders=[], withdrawals=None, position_overrides={}, cash_overrides={}):
+        """
+        calculates the low and high margin
+        :param orders: orders we're considering throwing in
+        :type orders: list
+        :returns: tuple - low and high margin, and the most each cash position could be drawn down
+        """
+        low_margin = high_margin = 0
+
+        # totals including the orders we're considering, for the contracts they are in
+        extra_orders = {}
+        max_cash_spent = collections.defaultdict(int, self.cash_spent)
+        for order in orders:
+            open_order = self.open_order(order)
+            ticker = order.contract.ticker
+            if ticker not in extra_orders:
+                extra_orders[ticker] = dict(self.contract_orders.get(ticker, no_orders(order.contract)))
+            totals = extra_orders[ticker]
+            for key in 'buy', 'sell', 'spent', 'received':
+                totals[key] += open_order[key]
+            for ticker, spent in open_order['cash_spent'].iteritems():
+                max_cash_spent[ticker] += spent
+
+        cash_position = collections.defaultdict(int)
+        tickers = set(self.positions) | set(self.contract_orders) | set(extra_orders) | set(position_overrides)
+        for ticker in tickers:
+            totals = extra_orders.get(ticker) or self.contract_orders.get(ticker)
+            if ticker in position_overrides:
+                position = position_overrides[ticker]
+            elif ticker in self.positions:
+                position = self.positions[ticker]
+            else:
+                # Make a blank position for contracts which have an open order but no position
+                position = {'position': 0, 'reference_price': None, 'contract': totals['contract']}
+
+            if position['contract'].contract_type == 'cash':
+                cash_position[ticker] = position['position']
+                continue
+
+            if totals is None:
+                totals = no_orders(position['contract'])
+
+            if ticker in position_overrides or ticker in extra_orders:
+                low, high = contract_margin(position, totals, safe_prices)
+            else:
+                safe_price = safe_prices.get(ticker)
+                cached = self.contract_margins.get(ticker)
+                if cached is None or cached[0] != safe_price:
+                    cached = (safe_price,) + contract_margin(position, totals, safe_prices)
+                    self.contract_margins[ticker] = cached
+                low, high = cached[1:]
+
+            low_margin += low
+            high_margin += high
+
+        # Override cash position
+        cash_position.update(cash_overrides)
+
+        # Make sure max_cash_spent has something in it for every cash contract
+        for ticker in cash_position.iterkeys():
+            if ticker not in max_cash_spent:
+                max_cash_spent[ticker] = 0
+
+        # Deal with withdrawals
+        if withdrawals:
+            for ticker, amount in withdrawals.iteritems():
+                max_cash_spent[ticker] += amount
+                # The fee is deducted from the withdrawal amount, not added to the withdrawal
+
+        for cash_ticker, max_spent in max_cash_spent.iteritems():
+            if cash_ticker == 'BTC':
+                additional_margin = max_spent
             else:
-                SAFE_PRICE = safe_prices[contract.ticker]
-
-                #log.msg(low_margin)
-                # print 'max position:', max_position
-                # print 'contract.margin_low :', contract.margin_low
-                # print 'SAFE_PRICE :', SAFE_PRICE
-                # print 'position.reference_price :', position['reference_price']
-                # print position
-                if position['reference_price'] is None:
-                    if position['position'] != 0:
-                        raise MarginException("No reference price with non-zero position")
-
-                    reference_price = SAFE_PRICE
+                if max_spent <= cash_position[cash_ticker]:
+                    additional_margin = 0
                 else:
-                    reference_price = position['reference_price']
-
-                # We divide by 100 because contract.margin_low and contract.margin_high are percentages from 0-100
-                low_max = abs(max_position) * contract.margin_low * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + max_position * (
-                    reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
-                low_min = abs(min_position) * contract.margin_low * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + min_position * (
-                    reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
-                high_max = abs(max_position) * contract.margin_high * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + max_position * (
-                    reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
-                high_min = abs(min_position) * contract.margin_high * SAFE_PRICE * contract.lot_size / contract.denominator / 100 + min_position * (
-                    reference_price - SAFE_PRICE) * contract.lot_size / contract.denominator
-                # log.msg(low_max)
-                # log.msg(low_min)
-                log.msg("%s" % ["Margin:", contract.ticker, max_position, min_position, low_max, low_min, high_max, high_min])
-
-                high_margin += max(high_max, high_min)
-                low_margin += max(low_max, low_min)
-
-        if contract.contract_type == 'prediction':
-            payoff = contract.lot_size
-
-            # case where all our buy orders are hit
-            max_spent = sum(order.quantity_left * order.price * order.contract.lot_size / order.contract.denominator
-                            for order in open_orders if
-                            order.contract == contract and order.side == 'BUY')
-
-            # case where all our sell orders are hit
-            max_received = sum(order.quantity_left * order.price * order.contract.lot_size / order.contract.denominator
-                               for order in open_orders if
-                               order.contract == contract and order.side == 'SELL')
-
-            worst_short_cover = -min_position * payoff if min_position < 0 else 0
-            best_short_cover = -max_position * payoff if max_position < 0 else 0
-
-            additional_margin = max(max_spent + best_short_cover, -max_received + worst_short_cover)
+                    # TODO: We should fix this hack and just check max_cash_spent in check_margin
+                    log.msg("max_spent (%d) > cash_position[%s] (%d)" % (max_spent, cash_ticker, cash_position[cash_ticker]))
+                    additional_margin = 2**48
+
             low_margin += additional_margin
             high_margin += additional_margin
 
-        if contract.contract_type == 'cash':
-            cash_position[contract.ticker] = position['position']
+        return low_margin, high_margin, max_cash_spent
 
-    # Override cash position
-    cash_position.update(cash_overrides)
-
-    max_cash_spent = collections.defaultdict(int)
-
-    # Deal with cash_pair orders separately because there are no cash_pair positions
-    for order in open_orders:
-        fees = util.get_fees(user, order.contract, order.price, order.quantity, trial_period=trial_period)
-        
-        if order.contract.contract_type == 'cash_pair':
-            transaction_size = util.get_cash_spent(order.contract, order.price, order.quantity)
-            
-            if order.side == 'BUY':
-                max_cash_spent[order.contract.denominated_contract.ticker] += transaction_size
-                if order.contract.payout_contract.ticker in fees:
-                    fees[order.contract.payout_contract.ticker] = max(0, fees[order.contract.payout_contract.ticker] - order.quantity_left)
-            if order.side == 'SELL':
-                max_cash_spent[order.contract.payout_contract.ticker] += order.quantity_left
-                if order.contract.denominated_contract.ticker in fees:
-                    fees[order.contract.denominated_contract.ticker] = max(0, fees[order.contract.denominated_contract.ticker] - transaction_size)
-
-        for ticker, fee in fees.iteritems():
-            max_cash_spent[ticker] += fee
-
-    # Make sure max_cash_spent has something in it for every cash contract
-    for ticker in cash_position.iterkeys():
-        if ticker not in max_cash_spent:
-            max_cash_spent[ticker] = 0
-
-    # Deal with withdrawals
-    if withdrawals:
-        for ticker, amount in withdrawals.iteritems():
-            max_cash_spent[ticker] += amount
-            # The fee is deducted from the withdrawal amount, not added to the withdrawal
-            # contract = util.get_contract(session, ticker)
-            # fees = util.get_withdraw_fees(user, contract, amount, trial_period=trial_period)
-            # for fee_ticker, fee in fees.iteritems():
-            #     max_cash_spent[fee_ticker] += fee
-
-    for cash_ticker, max_spent in max_cash_spent.iteritems():
-        if cash_ticker == 'BTC':
-            additional_margin = max_spent
-        else:
-            if max_spent <= cash_position[cash_ticker]:
-                additional_margin = 0
-            else:
-                # TODO: We should fix this hack and just check max_cash_spent in check_margin
-                log.msg("max_spent (%d) > cash_position[%s] (%d)" % (max_spent, cash_ticker, cash_position[cash_ticker]))
-                additional_margin = 2**48
 
-        low_margin += additional_margin
-        high_margin += additional_margin
+def calculate_margin(user, session, safe_prices={}, order_id=None, withdrawals=None, trial_period=False, position_overrides={},
+                     cash_overrides={}, order_ids=None):
+    """
+    calculates the low and high margin for a given user
+    :param order_id: order we're considering throwing in
+    :type order_id: int
+    :param order_ids: several orders we're considering throwing in together
+    :type order_ids: list
+    :param user: the user
+    :type user: User
+    :returns: tuple - low and high margin
+    """
+    state = MarginState.from_session(user, session, trial_period=trial_period)
 
-    return low_margin, high_margin, max_cash_spent
+    orders = []
+    if order_id:
+        orders += session.query(models.Order).filter_by(id=order_id).all()
 
+    if order_ids:
+        orders += session.query(models.Order).filter(models.Order.id.in_(order_ids)).all()
 
+    return state.margin(safe_prices, orders=orders, withdrawals=withdrawals,
+                        position_overrides=position_overrides, cash_overrides=cash_overrides)
@@ -389,6 +389,23 @@ class Notification(db.Base):
     def __repr__(self):
         return "<Notification('%s', '%s', '%s')" % (self.username, self.type, self.method)
 
+class AccountantShard(db.Base):
+    """Pins a user to an accountant other than the one the hash ring picks,
+    see :mod:`sharding`.
+    """
+    __tablename__ = 'accountant_shards'
+    __table_args__ = {'extend_existing': True}
+
+    username = Column(String, ForeignKey('users.username'), primary_key=True)
+    accountant = Column(Integer, nullable=False)
+
+    def __init__(self, username, accountant):
+        self.username = username
+        self.accountant = accountant
+
+    def __repr__(self):
+        return "<AccountantShard('%s', %d)>" % (self.username, self.accountant)
+
 class User(db.Base):
     __tablename__ = 'users'
     __table_args__ = {'extend_existing': True}
@@ -0,0 +1,378 @@
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+"""
+.. module:: risk
+
+Works out the margin of every user at once, for the risk manager.
+
+The positions and open orders of all the users are loaded with a few
+queries into NumPy arrays of users by contracts. The low and high margin
+of everyone is then worked out from them in one pass for a set of safe
+prices, giving the same numbers margin.calculate_margin gives for each
+user on their own.
+
+The arrays are int64, like the BigInteger columns they are loaded from.
+"""
+
+from sqlalchemy import func, and_
+from twisted.python import log
+
+import models
+import util
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# What margin.calculate_margin charges when it cannot tell what the margin is
+UNKNOWN_MARGIN = 2**48
+
+
+def columns(rows, count):
+    """Turn a list of rows into a list of columns.
+    """
+    if not rows:
+        return [()] * count
+    return zip(*rows)
+
+
+def int_array(values):
+    return numpy.array(values, dtype=numpy.int64)
+
+
+class RiskSweep:
+    """The margin and cash position of every active customer.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        # The users' cash positions from the ledger, and the timestamp of the
+        # last journal entry counted in them
+        self.cash_positions = {}
+        self.counted_until = None
+        self.usernames = []
+        self.tickers = []
+        # The users with a position or an open order in each contract, by
+        # ticker, as of the last load
+        self.users_by_contract = {}
+        # The safe prices we last checked the margins at
+        self.safe_prices = {}
+
+    def load(self):
+        """Load the users, contracts, positions and open orders.
+        """
+        session = self.session
+
+        users = session.query(models.User.username, models.FeeGroup.aggressive_factor,
+                              models.FeeGroup.passive_factor).join(models.User.fees).filter(
+            models.User.active == True, models.User.type == 'Liability').all()
+        usernames, aggressive_factors, passive_factors = columns(users, 3)
+        self.usernames = list(usernames)
+        self.user_index = {username: index for index, username in enumerate(self.usernames)}
+        # Before an order trades we assume it pays the higher fee, like util.get_fees
+        self.fee_factor = numpy.maximum(int_array(aggressive_factors), int_array(passive_factors))
+
+        contracts = session.query(models.Contract).order_by(models.Contract.id).all()
+        self.contract_index = {contract.id: index for index, contract in enumerate(contracts)}
+        ticker_index = {contract.ticker: index for index, contract in enumerate(contracts)}
+        self.tickers = [contract.ticker for contract in contracts]
+        self.contract_ids = [contract.id for contract in contracts]
+        self.contract_type = numpy.array([contract.contract_type for contract in contracts])
+        self.lot_size = int_array([contract.lot_size for contract in contracts])
+        self.denominator = int_array([contract.denominator for contract in contracts])
+        self.margin_low = int_array([contract.margin_low or 0 for contract in contracts])
+        self.margin_high = int_array([contract.margin_high or 0 for contract in contracts])
+        self.fees = int_array([contract.fees for contract in contracts])
+        self.denominated = int_array([ticker_index.get(contract.denominated_contract_ticker, -1)
+                                      for contract in contracts])
+        self.payout = int_array([ticker_index.get(contract.payout_contract_ticker, -1) for contract in contracts])
+        self.payout_denominator = int_array([contracts[index].denominator if index >= 0 else 1
+                                             for index in self.payout])
+        self.btc = ticker_index.get('BTC')
+        self.btc_id = contracts[self.btc].id if self.btc is not None else None
+
+        shape = (len(self.usernames), len(contracts))
+        self.position = numpy.zeros(shape, dtype=numpy.int64)
+        self.reference_price = numpy.zeros(shape, dtype=numpy.int64)
+        self.has_reference_price = numpy.zeros(shape, dtype=bool)
+        # Whether the user has a position or an open order in the contract
+        self.present = numpy.zeros(shape, dtype=bool)
+        # Totals over the open orders
+        self.buy = numpy.zeros(shape, dtype=numpy.int64)
+        self.sell = numpy.zeros(shape, dtype=numpy.int64)
+        self.spent = numpy.zeros(shape, dtype=numpy.int64)
+        self.received = numpy.zeros(shape, dtype=numpy.int64)
+        # What the open orders could take out of each cash position
+        self.cash_spent = numpy.zeros(shape, dtype=numpy.int64)
+        self.has_cash_position = numpy.zeros(len(self.usernames), dtype=bool)
+
+        self.load_positions()
+
+    def load_positions(self, users=None):
+        """Load the positions and open orders of the users, in place of
+        what we had for them.
+
+        :param users: the indices of the users to load, or None for everyone
+        :type users: array
+        """
+        session = self.session
+        user_index = self.user_index
+        contract_index = self.contract_index
+
+        positions = session.query(models.Position.username, models.Position.contract_id,
+                                  models.Position.position, models.Position.reference_price).join(
+            models.Position.user).filter(models.User.active == True, models.User.type == 'Liability')
+        orders = session.query(models.Order.username, models.Order.contract_id, models.Order.side,
+                               models.Order.price, models.Order.quantity, models.Order.quantity_left).join(
+            models.Order.user).filter(models.User.active == True, models.User.type == 'Liability').filter(
+            models.Order.quantity_left > 0, models.Order.is_cancelled == False, models.Order.accepted == True)
+        if users is not None:
+            usernames = [self.usernames[index] for index in users]
+            positions = positions.filter(models.Position.username.in_(usernames))
+            orders = orders.filter(models.Order.username.in_(usernames))
+            for array in (self.position, self.reference_price, self.has_reference_price, self.present,
+                          self.buy, self.sell, self.spent, self.received, self.cash_spent):
+                array[users] = 0
+
+        usernames, contract_ids, quantities, reference_prices = columns(positions.all(), 4)
+        user = int_array([user_index[username] for username in usernames])
+        contract = int_array([contract_index[contract_id] for contract_id in contract_ids])
+        self.position[user, contract] = int_array([quantity or 0 for quantity in quantities])
+        self.reference_price[user, contract] = int_array([price or 0 for price in reference_prices])
+        self.has_reference_price[user, contract] = numpy.array([price is not None for price in reference_prices],
+                                                               dtype=bool)
+        self.present[user, contract] = True
+        if self.btc is not None:
+            self.has_cash_position[:] = self.present[:, self.btc]
+
+        usernames, contract_ids, sides, prices, quantities, quantities_left = columns(orders.all(), 6)
+        user = int_array([user_index[username] for username in usernames])
+        contract = int_array([contract_index[contract_id] for contract_id in contract_ids])
+        buy = numpy.array([side == 'BUY' for side in sides], dtype=bool)
+        sell = ~buy
+        price = int_array(prices)
+        quantity = int_array(quantities)
+        quantity_left = int_array(quantities_left)
+        self.present[user, contract] = True
+
+        numpy.add.at(self.buy, (user[buy], contract[buy]), quantity_left[buy])
+        numpy.add.at(self.sell, (user[sell], contract[sell]), quantity_left[sell])
+        value = quantity_left * price * self.lot_size[contract] // self.denominator[contract]
+        numpy.add.at(self.spent, (user[buy], contract[buy]), value[buy])
+        numpy.add.at(self.received, (user[sell], contract[sell]), value[sell])
+
+        # The fees, as util.get_fees works them out
+        cash_pair = self.contract_type[contract] == 'cash_pair'
+        transaction_size = numpy.where(cash_pair,
+                                       quantity * price // (self.denominator[contract] *
+                                                            self.payout_denominator[contract]),
+                                       quantity * price * self.lot_size[contract] // self.denominator[contract])
+        fee = transaction_size * self.fees[contract] * self.fee_factor[user] // 100 // 10000
+        # Selling a cash pair, the fee comes out of what we receive
+        fee = numpy.where(cash_pair & sell, numpy.maximum(0, fee - transaction_size), fee)
+        numpy.add.at(self.cash_spent, (user, self.denominated[contract]), fee)
+
+        # There are no cash_pair positions, just the cash moving
+        buy_pair = cash_pair & buy
+        sell_pair = cash_pair & sell
+        numpy.add.at(self.cash_spent, (user[buy_pair], self.denominated[contract[buy_pair]]),
+                     transaction_size[buy_pair])
+        numpy.add.at(self.cash_spent, (user[sell_pair], self.payout[contract[sell_pair]]),
+                     quantity_left[sell_pair])
+
+        self.users_by_contract = {ticker: numpy.flatnonzero(self.present[:, index])
+                                  for index, ticker in enumerate(self.tickers)}
+
+    def margins(self, safe_prices, users=None):
+        """Work out the users' margin at these safe prices.
+
+        :param safe_prices: the safe price of each contract, by ticker
+        :type safe_prices: dict
+        :param users: the indices of the users to work out, or None for everyone
+        :type users: array
+        :returns: tuple -- arrays of the low and high margin of each user,
+            and of whether the margin could not be worked out
+        """
+        if users is None:
+            users = slice(None)
+        position = self.position[users]
+        present = self.present[users]
+        has_reference_price = self.has_reference_price[users]
+        cash_spent = self.cash_spent[users]
+
+        safe_price = int_array([safe_prices.get(ticker, 0) for ticker in self.tickers])
+        has_safe_price = numpy.array([ticker in safe_prices for ticker in self.tickers], dtype=bool)
+        futures = (self.contract_type == 'futures') & present
+        prediction = self.contract_type == 'prediction'
+        cash = self.contract_type == 'cash'
+
+        max_position = position + self.buy[users]
+        min_position = position - self.sell[users]
+
+        # A position with no reference price yet is worth the safe price
+        reference_price = numpy.where(has_reference_price, self.reference_price[users], safe_price)
+        failed = (futures & ~has_reference_price & (position != 0)).any(axis=1)
+
+        def futures_margin(margin_rate):
+            # We divide by 100 because the margin rates are percentages from 0-100
+            def at(position):
+                return abs(position) * margin_rate * safe_price * self.lot_size // self.denominator // 100 + \
+                       position * (reference_price - safe_price) * self.lot_size // self.denominator
+
+            margin = numpy.maximum(at(max_position), at(min_position))
+            margin = numpy.where(futures & has_safe_price, margin, 0)
+            return numpy.where(futures & ~has_safe_price, UNKNOWN_MARGIN, margin).sum(axis=1)
+
+        payoff = self.lot_size
+        worst_short_cover = numpy.where(min_position < 0, -min_position * payoff, 0)
+        best_short_cover = numpy.where(max_position < 0, -max_position * payoff, 0)
+        prediction_margin = numpy.where(prediction, numpy.maximum(self.spent[users] + best_short_cover,
+                                                                  -self.received[users] + worst_short_cover),
+                                        0).sum(axis=1)
+
+        # BTC spent counts against the margin, spending more of anything else
+        # than we have is not allowed at all
+        short = cash & (cash_spent > position)
+        cash_margin = numpy.zeros(len(position), dtype=numpy.int64)
+        if self.btc is not None:
+            short[:, self.btc] = False
+            cash_margin += cash_spent[:, self.btc]
+        cash_margin += UNKNOWN_MARGIN * short.sum(axis=1)
+
+        low_margin = futures_margin(self.margin_low) + prediction_margin + cash_margin
+        high_margin = futures_margin(self.margin_high) + prediction_margin + cash_margin
+        return low_margin, high_margin, failed
+
+    def update_cash_positions(self, users):
+        """Bring the users' cash positions up to date with the ledger, like
+        util.position_calculated, but with one query for the postings since
+        the last time, and one for the users we have not seen before.
+
+        :param users: the indices of the users we want the cash positions of
+        :type users: array
+        :returns: array -- the cash position of each of them
+        """
+        session = self.session
+        cash_positions = numpy.zeros(len(users), dtype=numpy.int64)
+        if self.btc_id is None:
+            return cash_positions
+
+        until = session.query(func.max(models.Journal.timestamp)).scalar()
+        if self.counted_until is not None and until is not None:
+            rows = session.query(models.Posting.username, func.sum(models.Posting.quantity)).join(
+                models.Journal, models.Journal.id == models.Posting.journal_id).filter(
+                models.Posting.contract_id == self.btc_id,
+                models.Journal.timestamp > self.counted_until,
+                models.Journal.timestamp <= until).group_by(models.Posting.username)
+            for username, quantity in rows:
+                if username in self.cash_positions:
+                    self.cash_positions[username] += int(quantity)
+
+        # Users without a cash position are left out until they have one
+        new_users = [self.usernames[index] for index in users
+                     if self.has_cash_position[index] and self.usernames[index] not in self.cash_positions]
+        if new_users:
+            positions = session.query(models.Position.username, models.Position.position_checkpoint).join(
+                models.Position.user).filter(models.User.active == True, models.User.type == 'Liability').filter(
+                models.Position.contract_id == self.btc_id)
+            postings = session.query(models.Position.username, func.sum(models.Posting.quantity)).join(
+                models.Position.user).join(
+                models.Posting, and_(models.Posting.username == models.Position.username,
+                                     models.Posting.contract_id == models.Position.contract_id)).join(
+                models.Journal, models.Journal.id == models.Posting.journal_id).filter(
+                models.User.active == True, models.User.type == 'Liability').filter(
+                models.Position.contract_id == self.btc_id,
+                models.Journal.timestamp > func.coalesce(models.Position.position_cp_timestamp,
+                                                         util.timestamp_to_dt(0)),
+                models.Journal.timestamp <= until).group_by(models.Position.username)
+            if self.cash_positions:
+                # Only the few who are new, not everyone again
+                positions = positions.filter(models.Position.username.in_(new_users))
+                postings = postings.filter(models.Position.username.in_(new_users))
+
+            new_cash_positions = {username: int(checkpoint or 0) for username, checkpoint in positions}
+            if until is not None:
+                for username, quantity in postings:
+                    new_cash_positions[username] += int(quantity)
+            for username, cash_position in new_cash_positions.iteritems():
+                if username not in self.cash_positions:
+                    self.cash_positions[username] = cash_position
+
+        if until is not None:
+            self.counted_until = until
+
+        for position, index in enumerate(users):
+            cash_positions[position] = self.cash_positions.get(self.usernames[index], 0)
+        return cash_positions
+
+    def check(self, users, safe_prices):
+        """Check the users' margin against their cash position.
+
+        :returns: tuple -- the usernames checked, and (username, cash
+            position, low margin, high margin) for each user whose cash
+            position is below their high margin, the furthest below their
+            low margin first
+        """
+        self.safe_prices = dict(safe_prices)
+        cash_positions = self.update_cash_positions(users)
+        low_margin, high_margin, failed = self.margins(safe_prices, users)
+
+        for index in numpy.flatnonzero(failed):
+            log.err("%s has a futures position with no reference price, cannot check margin" %
+                    self.usernames[users[index]])
+
+        crossing = numpy.flatnonzero((cash_positions < high_margin) & ~failed)
+        crossing = crossing[numpy.argsort(cash_positions[crossing] - low_margin[crossing], kind='mergesort')]
+        return ([self.usernames[index] for index in users],
+                [(self.usernames[users[index]], int(cash_positions[index]), int(low_margin[index]),
+                  int(high_margin[index])) for index in crossing])
+
+    def sweep(self, safe_prices):
+        """Load everything again and check everyone's margin.
+
+        :param safe_prices: the safe price of each contract, by ticker
+        :type safe_prices: dict
+        :returns: tuple -- as check()
+        """
+        self.load()
+        return self.check(numpy.arange(len(self.usernames)), safe_prices)
+
+    def recheck(self, safe_prices):
+        """Check the margin of just the users with a position or an open
+        order in the contracts whose safe price has changed since we last
+        checked. Their positions and open orders are loaded again first, so
+        they are not checked against what they held at the last sweep.
+
+        :param safe_prices: the safe price of each contract, by ticker
+        :type safe_prices: dict
+        :returns: tuple -- as check()
+        """
+        moved = [index for index, ticker in enumerate(self.tickers)
+                 if safe_prices.get(ticker) != self.safe_prices.get(ticker)]
+        if not moved:
+            return [], []
+
+        # Those who held the contracts at the last load, and those who do now
+        users = set()
+        for index in moved:
+            users.update(self.users_by_contract[self.tickers[index]])
+        contract_ids = [self.contract_ids[index] for index in moved]
+        holders = self.session.query(models.Position.username).filter(
+            models.Position.contract_id.in_(contract_ids)).union(
+            self.session.query(models.Order.username).filter(
+                models.Order.contract_id.in_(contract_ids), models.Order.quantity_left > 0,
+                models.Order.is_cancelled == False, models.Order.accepted == True))
+        users.update(self.user_index[username] for username, in holders if username in self.user_index)
+        if not users:
+            self.safe_prices = dict(safe_prices)
+            return [], []
+
+        users = int_array(sorted(users))
+        self.load_positions(users)
+        return self.check(users, safe_prices)
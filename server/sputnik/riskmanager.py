@@ -32,6 +32,7 @@ from sqlalchemy.orm.exc import NoResultFound
 import models
 import database
 import margin
+import risk
 import util
 from sendmail import Sendmail
 from accountant import AccountantProxy
@@ -59,6 +60,8 @@ class RiskManager():
         self.timestamps = {}
         self.low_margin_users = {}
         self.bad_margin_users = {}
+        # Check everyone at once if we have NumPy
+        self.sweep = risk.RiskSweep(session) if risk.numpy is not None else None
 
         self.BTC = self.session.query(models.Contract).filter_by(ticker='BTC').one()
 
@@ -91,51 +94,94 @@ class RiskManager():
         this_call_time = time.time()
         safe_prices = json.loads(args[0])
         log.msg("Safe prices received: %s" % safe_prices)
-        # Don't run more than once per minute
+        # Don't check everyone more than once per minute
         if this_call_time - self.last_call_time > self.nap_time_seconds:
             self.last_call_time = this_call_time
 
 
             self.session.expire_all()
-            for user in self.session.query(models.User).filter_by(active=True).filter_by(type='Liability'):
-                low_margin, high_margin, cash_spent = margin.calculate_margin(user, self.session, safe_prices)
-                try:
-                    cash_position_db = self.session.query(models.Position).filter_by(contract=self.BTC, user=user).one()
-                except NoResultFound:
-                    self.cash_positions[user.username] = 0
-                else:
-                    # Use calculated position
-                    if user.username in self.timestamps:
-                        self.cash_positions[user.username], self.timestamps[user.username] = \
-                            util.position_calculated(cash_position_db, self.session, checkpoint=self.cash_positions[user.username],
-                                                     start=self.timestamps[user.username])
-                    else:
-                        self.cash_positions[user.username], self.timestamps[user.username] = \
-                            util.position_calculated(cash_position_db, self.session)
-
-
-                if self.cash_positions[user.username] < low_margin:
-                    if user.username not in self.bad_margin_users:
-                        self.bad_margin_users[user.username] = datetime.datetime.utcnow()
-                        self.email_user(user, self.cash_positions[user.username], low_margin, high_margin, severe=True)
-
-                    d = self.accountant.liquidate_best(user.username)
-                    d.addErrback(log.err)
-                    result = "CALL"
-                elif self.cash_positions[user.username] < high_margin:
-                    if user.username not in self.low_margin_users:
-                        self.low_margin_users[user.username] = datetime.datetime.utcnow()
-                        self.email_user(user, self.cash_positions[user.username], low_margin, high_margin, severe=False)
-                    result = "WARNING"
-                else:
-                    if user.username in self.low_margin_users:
-                        del self.low_margin_users[user.username] # resolved
-                    if user.username in self.bad_margin_users:
-                        del self.bad_margin_users[user.username] # resolved
-                    result = "OK"
-
-                log.msg("%s: %s / %d %d %d" % (result, user.username, low_margin, high_margin,
-                                                     self.cash_positions[user.username]))
+            if self.sweep is not None:
+                self.check_users(*self.sweep.sweep(safe_prices))
+            else:
+                for user in self.session.query(models.User).filter_by(active=True).filter_by(type='Liability'):
+                    self.check_user(user, safe_prices)
+
+            log.msg("Margins checked in %.3f s: %d calls, %d warnings" %
+                    (time.time() - this_call_time, len(self.bad_margin_users), len(self.low_margin_users)))
+        elif self.sweep is not None:
+            # In between, check the users holding the contracts whose price moved
+            checked, crossing = self.sweep.recheck(safe_prices)
+            if checked:
+                self.check_users(checked, crossing, recheck=True)
+                log.msg("Margins of %d users rechecked in %.3f s" % (len(checked), time.time() - this_call_time))
+
+    def check_users(self, checked, crossing, recheck=False):
+        """Act on a sweep of the users' margins.
+
+        :param checked: the usernames whose margin was checked
+        :type checked: list
+        :param crossing: (username, cash position, low margin, high margin)
+            for the users whose cash position is below their high margin,
+            in the order to deal with them
+        :type crossing: list
+        :param recheck: whether this is a recheck between full sweeps, which
+            leaves users already being liquidated for the next full sweep
+        :type recheck: bool
+        """
+        crossing_usernames = set(username for username, cash_position, low_margin, high_margin in crossing)
+        checked = set(checked)
+        for username in set(self.low_margin_users) | set(self.bad_margin_users):
+            if username in checked and username not in crossing_usernames:
+                # resolved
+                self.low_margin_users.pop(username, None)
+                self.bad_margin_users.pop(username, None)
+
+        for username, cash_position, low_margin, high_margin in crossing:
+            if recheck and username in self.bad_margin_users:
+                continue
+            user = self.session.query(models.User).filter_by(username=username).one()
+            self.handle_margin(user, cash_position, low_margin, high_margin)
+
+    def check_user(self, user, safe_prices):
+        low_margin, high_margin, cash_spent = margin.calculate_margin(user, self.session, safe_prices)
+        try:
+            cash_position_db = self.session.query(models.Position).filter_by(contract=self.BTC, user=user).one()
+        except NoResultFound:
+            self.cash_positions[user.username] = 0
+        else:
+            # Use calculated position
+            if user.username in self.timestamps:
+                self.cash_positions[user.username], self.timestamps[user.username] = \
+                    util.position_calculated(cash_position_db, self.session, checkpoint=self.cash_positions[user.username],
+                                             start=self.timestamps[user.username])
+            else:
+                self.cash_positions[user.username], self.timestamps[user.username] = \
+                    util.position_calculated(cash_position_db, self.session)
+
+        self.handle_margin(user, self.cash_positions[user.username], low_margin, high_margin)
+
+    def handle_margin(self, user, cash_position, low_margin, high_margin):
+        if cash_position < low_margin:
+            if user.username not in self.bad_margin_users:
+                self.bad_margin_users[user.username] = datetime.datetime.utcnow()
+                self.email_user(user, cash_position, low_margin, high_margin, severe=True)
+
+            d = self.accountant.liquidate_best(user.username)
+            d.addErrback(log.err)
+            result = "CALL"
+        elif cash_position < high_margin:
+            if user.username not in self.low_margin_users:
+                self.low_margin_users[user.username] = datetime.datetime.utcnow()
+                self.email_user(user, cash_position, low_margin, high_margin, severe=False)
+            result = "WARNING"
+        else:
+            if user.username in self.low_margin_users:
+                del self.low_margin_users[user.username] # resolved
+            if user.username in self.bad_margin_users:
+                del self.bad_margin_users[user.username] # resolved
+            result = "OK"
+
+        log.msg("%s: %s / %d %d %d" % (result, user.username, low_margin, high_margin, cash_position))
 
 
 if __name__ == "__main__":
@@ -149,6 +195,7 @@ if __name__ == "__main__":
     accountant = AccountantProxy("dealer",
                                  config.get("accountant", "riskmanager_export"),
                                  config.getint("accountant", "riskmanager_export_base_port"))
+    accountant.watch_shards(session)
 
     riskmanager = RiskManager(session, sendmail, safe_price_subscriber, accountant)
 
@@ -17,76 +17,122 @@ from twisted.internet.defer import inlineCallbacks
 class RPCSchemaException(Exception):
     pass
 
-# urldefrag
-
-def validate(x, full_uri):
-    uri, fragment = jsonschema.compat.urldefrag(full_uri)
-    schema_root = config.get("specs", "schema_root")
-    with open(os.path.join(schema_root, uri)) as schema_file:
-        top_schema = json.load(schema_file)
-    resolver = jsonschema.RefResolver("file://" + schema_root + "/", top_schema)
-    schema = resolver.resolve_fragment(top_schema, fragment)
-    jsonschema.Draft4Validator.check_schema(schema)
-    validator = jsonschema.Draft4Validator(schema, resolver=resolver)
-    validator.validate(x)
+# Validators are built once per schema, by (schema_root, full_uri)
+validators = {}
 
 def validator(full_uri):
-    uri, fragment = jsonschema.compat.urldefrag(full_uri)
+    """Build the validator for a schema, or return the one we built before.
+
+    :param full_uri: the schema file, relative to schema_root, and the fragment
+    :type full_uri: str
+    :returns: jsonschema.Draft4Validator
+    """
     schema_root = config.get("specs", "schema_root")
-    with open(os.path.join(schema_root, uri)) as schema_file:
-        top_schema = json.load(schema_file)
-    resolver = jsonschema.RefResolver("file://" + schema_root + "/", top_schema)
-    schema = resolver.resolve_fragment(top_schema, fragment)
-    jsonschema.Draft4Validator.check_schema(schema)
-    return jsonschema.Draft4Validator(schema, resolver=resolver)
-
-def build_call_validate(full_uri):
-    v = validator(full_uri)
-
-    def validate_call(*args, **kwargs):
-        callargs = inspect.getcallargs(f, *args, **kwargs)
-        
-        # hack to handle methods
-        if "self" in callargs:
-            del callargs["self"]
+    key = (schema_root, full_uri)
+    if key not in validators:
+        uri, fragment = jsonschema.compat.urldefrag(full_uri)
+        with open(os.path.join(schema_root, uri)) as schema_file:
+            top_schema = json.load(schema_file)
+        resolver = jsonschema.RefResolver("file://" + schema_root + "/", top_schema)
+        schema = resolver.resolve_fragment(top_schema, fragment)
+        jsonschema.Draft4Validator.check_schema(schema)
+        validators[key] = jsonschema.Draft4Validator(schema, resolver=resolver)
+    return validators[key]
+
+def validate(x, full_uri):
+    validator(full_uri).validate(x)
+
+def validate_internal():
+    """Whether calls between our own components are validated, or only the
+    ones coming in from outside through the public schemas.
+    """
+    if not config.has_option("specs", "validate_internal"):
+        return True
+    return config.getboolean("specs", "validate_internal")
+
+def is_public(path):
+    return path.startswith("public/")
+
+def build_binding(f, drop_args=[]):
+    """Work out once how a call to f binds its arguments, so that each call
+    only has to build the dict of arguments to validate rather than going
+    through inspect.getcallargs.
+
+    :returns: function -- takes args and kwargs and returns the dict
+    """
+    skip = set(drop_args)
+    # hack to handle methods
+    skip.add("self")
+
+    def clean(callargs):
+        for name in skip:
+            callargs.pop(name, None)
 
         # json only accepts lists as arrays, not tuples
         for key in callargs:
             if type(callargs[key]) == tuple:
                 callargs[key] = list(callargs[key])
+        return callargs
 
-        # validate
-        v.validate(callargs)
-
-    return validate_call
-
-def schema(path, drop_args=[]):
-    def wrap(f):
-        f.schema = path
-        f.validator = validator(path)
-        def wrapped_f(*args, **kwargs):
+    spec = inspect.getargspec(f)
+    if spec.varargs is not None or spec.keywords is not None:
+        def bind_slow(args, kwargs):
             try:
                 callargs = inspect.getcallargs(f, *args, **kwargs)
             except TypeError:
                 raise jsonschema.ValidationError("Invalid number of arguments.")
+            return clean(callargs)
+        return bind_slow
+
+    names = spec.args
+    positions = dict((name, i) for i, name in enumerate(names))
+    defaults = spec.defaults or ()
+    missing = object()
+    first_default = len(names) - len(defaults)
+    plan = []
+    for i, name in enumerate(names):
+        default = defaults[i - first_default] if i >= first_default else missing
+        plan.append((i, name, default, name in skip))
+
+    def bind(args, kwargs):
+        if len(args) > len(names):
+            raise jsonschema.ValidationError("Invalid number of arguments.")
+        for name in kwargs:
+            if positions.get(name, -1) < len(args):
+                # unknown, or given positionally as well
+                raise jsonschema.ValidationError("Invalid number of arguments.")
 
-            # hack to handle methods
-            if "self" in callargs:
-                del callargs["self"]
+        callargs = {}
+        for i, name, default, skipped in plan:
+            if i < len(args):
+                value = args[i]
+            else:
+                value = kwargs.get(name, default)
+                if value is missing:
+                    raise jsonschema.ValidationError("Invalid number of arguments.")
+            if skipped:
+                continue
+            # json only accepts lists as arrays, not tuples
+            if type(value) == tuple:
+                value = list(value)
+            callargs[name] = value
+        return callargs
 
-            # We might want to remove things like 'details' for authenticated
-            # WAMPv2 calls
-            for arg in drop_args:
-                if arg in callargs:
-                    del callargs[arg]
+    return bind
 
-            # json only accepts lists as arrays, not tuples
-            for key in callargs:
-                if type(callargs[key]) == tuple:
-                    callargs[key] = list(callargs[key])
+def schema(path, drop_args=[]):
+    def wrap(f):
+        f.schema = path
+        f.validator = validator(path)
+        if not is_public(path) and not validate_internal():
+            return f
 
-            # validate
-            f.validator.validate(callargs)
+        bind = build_binding(f, drop_args)
+        validate_args = f.validator.validate
+        def wrapped_f(*args, **kwargs):
+            # We might want to remove things like 'details' for authenticated
+            # WAMPv2 calls, bind leaves drop_args out
+            validate_args(bind(args, kwargs))
 
             return f(*args, **kwargs)
         return wrapped_f
@@ -28,6 +28,34 @@ from twisted.internet import reactor
 from twisted.python import log
 import json
 
+
+class SafePriceForwarder:
+    """Collects the safe prices from the engines and publishes all of them
+    together, at most once every publish_interval seconds (every update if
+    it is 0).
+    """
+
+    def __init__(self, publisher, publish_interval=0):
+        self.publisher = publisher
+        self.publish_interval = publish_interval
+        self.safe_prices = {}
+        self.pending_publish = None
+        self.callLater = reactor.callLater
+
+    def onPrice(self, *args):
+        update = json.loads(args[0])
+        log.msg("received update: %s" % update)
+        self.safe_prices.update(update)
+        if not self.publish_interval:
+            self.publish()
+        elif self.pending_publish is None:
+            self.pending_publish = self.callLater(self.publish_interval, self.publish)
+
+    def publish(self):
+        self.pending_publish = None
+        self.publisher.publish(json.dumps(self.safe_prices), tag=b'')
+
+
 if __name__ == "__main__":
     import sys
     log.startLogging(sys.stdout)
@@ -36,13 +64,7 @@ if __name__ == "__main__":
 
     subscriber.subscribe("")
 
-    safe_prices = {}
-    def onPrice(*args):
-        update = json.loads(args[0])
-        log.msg("received update: %s" % update)
-        safe_prices.update(update)
-        publisher.publish(json.dumps(safe_prices), tag=b'')
-
-    subscriber.gotMessage = onPrice
+    forwarder = SafePriceForwarder(publisher,
+                                   publish_interval=config.getfloat("safe_price_forwarder", "publish_interval"))
+    subscriber.gotMessage = forwarder.onPrice
     reactor.run()
-
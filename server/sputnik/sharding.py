@@ -0,0 +1,136 @@
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+"""
+.. module:: sharding
+
+Decides which accountant looks after each user.
+
+The whole username is hashed onto a ring with many points for each
+accountant, and the user belongs to the first accountant clockwise from
+it. Usernames spread evenly over the accountants that way, and going from
+n to n + 1 accountants only moves about 1 / (n + 1) of the users, all of
+them to the new accountant.
+
+A user can also be pinned to some other accountant with a
+models.AccountantShard row. That is how users are moved between
+accountants while everything is running: first every user that a new
+accountant would take over is pinned where they are (:func:`pins_for`), so
+that adding the accountant moves nobody, and then the accountants hand
+them over one at a time with Accountant.migrate_user, which deletes the
+pin once the user is where the ring wants them.
+"""
+
+import bisect
+import hashlib
+
+import models
+
+# How many points each accountant has on the ring
+REPLICAS = 128
+
+
+def hash_key(key):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=REPLICAS):
+        """
+        :param nodes: the nodes to spread the keys over
+        :type nodes: list
+        :param replicas: how many points each node has on the ring
+        :type replicas: int
+        """
+        points = sorted((hash_key("%s:%d" % (node, replica)), node)
+                        for node in nodes for replica in range(replicas))
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    def node_for(self, key):
+        """
+        :param key: the key to place
+        :type key: str
+        :returns: the node the key belongs to
+        """
+        if not self.nodes:
+            raise KeyError("There are no nodes on the ring.")
+        index = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.nodes[index]
+
+
+class ShardMap:
+    def __init__(self, num_procs, assignments=None, replicas=REPLICAS):
+        """
+        :param num_procs: how many accountants there are
+        :type num_procs: int
+        :param assignments: accountants users are pinned to, by username
+        :type assignments: dict
+        """
+        self.num_procs = num_procs
+        self.replicas = replicas
+        self.ring = HashRing(range(num_procs), replicas)
+        self.assignments = dict(assignments or {})
+
+    def ring_accountant_for(self, username):
+        return self.ring.node_for(username)
+
+    def accountant_for(self, username):
+        """
+        :param username: the user
+        :type username: str
+        :returns: int -- the accountant that looks after the user
+        """
+        accountant = self.assignments.get(username)
+        if accountant is None or accountant >= self.num_procs:
+            return self.ring_accountant_for(username)
+        return accountant
+
+    def load(self, session):
+        """Read the pinned users from the database.
+
+        :returns: list -- the users whose accountant changed
+        """
+        assignments = dict(session.query(models.AccountantShard.username,
+                                         models.AccountantShard.accountant))
+        return self.set_assignments(assignments)
+
+    def set_assignments(self, assignments):
+        """
+        :param assignments: accountants users are pinned to, by username
+        :type assignments: dict
+        :returns: list -- the users whose accountant changed
+        """
+        changed = [username for username in set(assignments) | set(self.assignments)
+                   if assignments.get(username) != self.assignments.get(username)]
+        before = {username: self.accountant_for(username) for username in changed}
+        self.assignments = dict(assignments)
+        return [username for username in changed if self.accountant_for(username) != before[username]]
+
+
+def pins_for(usernames, shards, num_procs):
+    """Work out how to pin users before changing the number of accountants,
+    so that the change moves nobody.
+
+    :param usernames: every user
+    :type usernames: list
+    :param shards: the shard map in use now
+    :type shards: ShardMap
+    :param num_procs: how many accountants there will be
+    :type num_procs: int
+    :returns: dict -- the accountant to pin each user who would move to
+    """
+    new_shards = ShardMap(num_procs, shards.assignments, shards.replicas)
+    pins = {}
+    for username in usernames:
+        accountant = shards.accountant_for(username)
+        # Users of accountants that are going away have to be moved first
+        if accountant < num_procs and new_shards.accountant_for(username) != accountant:
+            pins[username] = accountant
+    return pins
@@ -25,6 +25,7 @@ from zmq_util import ComponentExport
 from sqlalchemy.orm.session import Session
 import hashlib
 from decimal import Decimal
+from collections import OrderedDict
 
 #
 # This doesn't work properly
@@ -44,8 +45,11 @@ def except_trace_alert(func):
 
 def session_aware(func):
     def wrapped(self, *args, **kwargs):
+        succeeded = False
         try:
-            return func(self, *args, **kwargs)
+            result = func(self, *args, **kwargs)
+            succeeded = True
+            return result
         finally:
             if isinstance(self, ComponentExport):
                 session = self.component.session
@@ -53,9 +57,23 @@ def session_aware(func):
                 session = self.session
 
             if isinstance(session, Session):
-                session.rollback()
+                if succeeded and not session.expire_on_commit and not has_changes(session):
+                    # There is nothing to undo, and unlike a rollback a
+                    # commit leaves what the session has loaded alone
+                    session.commit()
+                else:
+                    session.rollback()
     return wrapped
 
+def has_changes(session):
+    """
+    :returns: bool -- whether anything has been added, changed or deleted in
+        the session since the last commit or rollback
+    """
+    transaction = session.transaction
+    return bool(session.new or session.dirty or session.deleted or transaction is None or
+                transaction._new or transaction._dirty or transaction._deleted)
+
 def get_locale_template(locale, jinja_env, template):
     locales = [locale, "root"]
     templates = [template.format(locale=locale) for locale in locales]
@@ -71,6 +89,42 @@ def timed(f):
         return result
     return wrapped
 
+class LRUCache:
+    """
+    A mapping which holds at most size entries, dropping the one used least
+    recently to make room for a new one.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return default
+        self.entries[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
 def get_uid():
     return uuid.uuid4().get_hex()
 
@@ -164,6 +218,24 @@ def dt_to_timestamp(dt):
     timestamp = int(delta.total_seconds() * 1e6)
     return timestamp
 
+_last_timestamp = 0
+
+def monotonic_timestamp():
+    """Returns the current time as a Sputnik timestamp (microseconds since epoch)
+
+    Unlike dt_to_timestamp(datetime.utcnow()), this does not build a datetime,
+    and it never returns the same value twice or goes backwards if the clock
+    is adjusted.
+
+    :returns: int
+    """
+    global _last_timestamp
+    timestamp = int(time.time() * 1e6)
+    if timestamp <= _last_timestamp:
+        timestamp = _last_timestamp + 1
+    _last_timestamp = timestamp
+    return timestamp
+
 def timestamp_to_dt(timestamp):
     """Turns a sputnik timestamp into a python datetime
 
@@ -75,9 +75,15 @@ if __name__ == "__main__":
         watchdogs[name] = Watchdog(name, config.get("watchdog", "accountant") % (config.getint("watchdog", "accountant_base_port") + i), proxy)
         watchdogs[name].run()
 
+    engine_hosts = config.getint("engine", "host_workers")
+    for i in range(engine_hosts):
+        name = "engine_host_%d" % i
+        watchdogs[name] = Watchdog(name, config.get("watchdog", "engine") % (config.getint("watchdog", "engine_host_base_port") + i), proxy)
+        watchdogs[name].run()
+
     engine_base_port = config.getint("watchdog", "engine_base_port")
     for contract in session.query(models.Contract).filter_by(active=True).all():
-        if contract.contract_type != "cash":
+        if contract.contract_type != "cash" and not engine_hosts:
             watchdogs[contract.ticker] = Watchdog(contract.ticker, config.get("watchdog", "engine") % (engine_base_port +
                                                                                           int(contract.id)), proxy)
             watchdogs[contract.ticker].run()
@@ -13,6 +13,7 @@ debug, log, warn, error, critical = observatory.get_loggers("accountant_proxy")
 
 from sputnik.webserver.plugin import BackendPlugin
 from sputnik import accountant
+from twisted.internet.task import LoopingCall
 
 class AccountantProxy(BackendPlugin):
     def __init__(self):
@@ -20,3 +21,17 @@ class AccountantProxy(BackendPlugin):
         self.proxy = accountant.AccountantProxy("dealer",
             config.get("accountant", "webserver_export"),
             config.getint("accountant", "webserver_export_base_port"))
+
+    def init(self):
+        self.db = self.require("sputnik.webserver.plugins.db.postgres.PostgresDatabase")
+        self.shards_call = LoopingCall(self.load_shards)
+        self.shards_call.start(config.getfloat("accountant", "shard_refresh_interval"))
+
+    def shutdown(self):
+        self.shards_call.stop()
+
+    def load_shards(self):
+        d = self.db.get_accountant_shards()
+        d.addCallback(self.proxy.shards.set_assignments)
+        d.addErrback(error)
+        return d
@@ -154,6 +154,11 @@ class PostgresDatabase(DatabasePlugin):
                    'timestamp': util.dt_to_timestamp(r[1])} for r in results]
         returnValue(trades)
 
+    @inlineCallbacks
+    def get_accountant_shards(self):
+        result = yield self.dbpool.runQuery("SELECT username, accountant FROM accountant_shards")
+        returnValue(dict(result))
+
     @inlineCallbacks
     def get_permissions(self, username):
         result = yield self.dbpool.runQuery(
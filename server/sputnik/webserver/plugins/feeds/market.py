@@ -32,6 +32,10 @@ class MarketAnnouncer(ServicePlugin):
         ticker = self.encode_ticker(ticker)
         self.publish(u"feeds.market.book.%s" % ticker, book)
 
+    def on_book_delta(self, ticker, delta):
+        ticker = self.encode_ticker(ticker)
+        self.publish(u"feeds.market.book_delta.%s" % ticker, delta)
+
     def on_safe_prices(self, ticker, price):
         ticker = self.encode_ticker(ticker)
         self.publish(u"feeds.market.safe_prices.%s" % ticker, price)
@@ -23,6 +23,11 @@ class EngineReceiver(ReceiverPlugin):
         log("Got 'book' for %s / %s" % (ticker, book))
         self.emit("book", ticker, book)
 
+    @export
+    def book_delta(self, ticker, delta):
+        debug("Got 'book_delta' for %s / %s" % (ticker, delta))
+        self.emit("book_delta", ticker, delta)
+
     @export
     def safe_prices(self, ticker, price):
         log("Got safe price for %s: %s" % (ticker, price))
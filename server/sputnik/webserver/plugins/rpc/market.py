@@ -26,6 +26,11 @@ class MarketService(ServicePlugin):
         ServicePlugin.__init__(self)
         self.markets = {}
         self.books = {}
+        # Price levels per contract, built from snapshots and deltas
+        self.book_levels = {}
+        self.book_sequences = {}
+        # Contracts which missed a delta and are waiting for a snapshot
+        self.stale_books = set()
         self.trade_history = {}
         self.ohlcv_history = {}
         self.safe_prices = {}
@@ -60,7 +65,56 @@ class MarketService(ServicePlugin):
             self.update_ohlcv(trade, period=period, update_feed=True)
 
     def on_book(self, contract, book):
+        # Each engine pushes books and deltas down a single socket, so they
+        #   arrive in order and a snapshot is always at least as new as any
+        #   delta we have applied.
         self.books[contract] = book
+        self.book_sequences[contract] = book.get("sequence")
+        # Rebuilt from the snapshot when the next delta arrives
+        self.book_levels.pop(contract, None)
+        if contract in self.stale_books:
+            log("Resynchronized book for %s at sequence %s" % (contract, book.get("sequence")))
+            self.stale_books.discard(contract)
+
+    def on_book_delta(self, contract, delta):
+        if contract in self.stale_books:
+            return
+
+        sequence = self.book_sequences.get(contract)
+        if sequence is None or delta["sequence"] > sequence + 1:
+            warn("Missed book deltas for %s (have %s, got %s), waiting for snapshot" %
+                 (contract, sequence, delta["sequence"]))
+            self.stale_books.add(contract)
+            return
+        if delta["sequence"] <= sequence:
+            # Already included in the snapshot we have
+            return
+
+        if contract not in self.book_levels:
+            book = self.books[contract]
+            self.book_levels[contract] = {side: {row["price"]: row["quantity"] for row in book[side]}
+                                          for side in ["bids", "asks"]}
+
+        levels = self.book_levels[contract]
+        for side in ["bids", "asks"]:
+            for row in delta[side]:
+                if row["quantity"] == 0:
+                    levels[side].pop(row["price"], None)
+                else:
+                    levels[side][row["price"]] = row["quantity"]
+
+        self.book_sequences[contract] = delta["sequence"]
+        # The full book is rebuilt lazily by get_order_book
+        self.books.pop(contract, None)
+
+    def build_book(self, contract):
+        levels = self.book_levels[contract]
+        return {'contract': contract,
+                'sequence': self.book_sequences[contract],
+                'bids': [{'price': price, 'quantity': levels['bids'][price]}
+                         for price in sorted(levels['bids'], reverse=True)],
+                'asks': [{'price': price, 'quantity': levels['asks'][price]}
+                         for price in sorted(levels['asks'])]}
 
     def on_safe_prices(self, contract, price):
         self.safe_prices[contract] = price
@@ -161,9 +215,12 @@ class MarketService(ServicePlugin):
             raise WebserverException("exceptions/webserver/no-such-ticker", contract)
 
         if contract not in self.books:
-            log("Warning: %s not in books" % contract)
-            # TODO: Get book from engine
-            self.books[contract] = {'contract': contract, 'bids': [], 'asks': []}
+            if contract in self.book_levels:
+                self.books[contract] = self.build_book(contract)
+            else:
+                log("Warning: %s not in books" % contract)
+                # TODO: Get book from engine
+                self.books[contract] = {'contract': contract, 'bids': [], 'asks': []}
 
         result = yield succeed(self.books[contract])
         returnValue(result)
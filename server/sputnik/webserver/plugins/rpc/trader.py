@@ -49,6 +49,28 @@ class TraderService(ServicePlugin):
         result = yield self.accountant.proxy.place_order(username, order)
         returnValue(result)
 
+    @wamp.register(u"rpc.trader.place_orders")
+    @error_handler
+    @authenticated
+    @schema(u"public/trader.json#place_orders")
+    def place_orders(self, orders, username=None):
+        """Places several orders at once. Either all of them are accepted or
+        none are.
+
+        :returns: Deferred -- list of order ids
+        """
+        timestamp = util.dt_to_timestamp(datetime.datetime.utcnow())
+        for order in orders:
+            order["timestamp"] = timestamp
+            order['username'] = username
+
+            # Check for zero price or quantity
+            if order["price"] == 0 or order["quantity"] == 0:
+                raise WebserverException("exceptions/webserver/invalid_price_quantity")
+
+        result = yield self.accountant.proxy.place_orders(username, orders)
+        returnValue(result)
+
     @wamp.register(u"rpc.trader.request_support_nonce")
     @error_handler
     @authenticated
@@ -316,6 +338,20 @@ class TraderService(ServicePlugin):
         result = yield self.accountant.proxy.cancel_order(username, id)
         returnValue(result)
 
+    @wamp.register(u"rpc.trader.cancel_orders")
+    @error_handler
+    @authenticated
+    @schema(u"public/trader.json#cancel_orders")
+    def cancel_orders(self, ids, username=None):
+        """
+        Cancels several orders at once
+        :returns: Deferred
+        :param ids: the order ids
+        """
+
+        result = yield self.accountant.proxy.cancel_orders(username, ids)
+        returnValue(result)
+
     @inlineCallbacks
     def register(self, endpoint, procedure = None, options = None):
         results = yield ServicePlugin.register(self, endpoint, procedure, options=RegisterOptions(details_arg="details", discloseCaller=True))
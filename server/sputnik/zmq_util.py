@@ -8,11 +8,12 @@
 
 import inspect
 import json
+import math
 import zmq
 import uuid
 import time
 from txzmq import ZmqFactory, ZmqEndpoint
-from txzmq import ZmqREQConnection, ZmqREPConnection
+from txzmq import ZmqREQConnection, ZmqREPConnection, ZmqDealerConnection
 from txzmq import ZmqPullConnection, ZmqPushConnection
 from txzmq import ZmqRequestTimeoutError
 from txzmq import ZmqSubConnection, ZmqPubConnection
@@ -24,6 +25,68 @@ import observatory
 debug, log, warn, error, critical = observatory.get_loggers("zmq")
 from exception import *
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONCodec:
+    name = "json"
+
+    def dumps(self, value):
+        return json.dumps(value)
+
+    def loads(self, message):
+        return json.loads(message)
+
+
+class MsgpackCodec:
+    """
+    msgpack, with strings coming back as unicode the way they do from json.
+    """
+    name = "msgpack"
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=False)
+
+    def loads(self, message):
+        return msgpack.unpackb(message, raw=False)
+
+
+json_codec = JSONCodec()
+codecs = {"json": json_codec}
+if msgpack is not None:
+    codecs["msgpack"] = MsgpackCodec()
+
+def get_codec(name):
+    """
+    Look up the codec to send messages with, falling back to json if it is
+    not available here.
+
+    :param name: json or msgpack
+    :returns: JSONCodec or MsgpackCodec
+    """
+    if name in codecs:
+        return codecs[name]
+    warn("Codec %s is not available, falling back to json." % name)
+    return json_codec
+
+def message_codec(message):
+    """
+    Work out which codec a message was encoded with. Every message is a map,
+    so json messages start with "{" and msgpack ones never do.
+
+    :param message:
+    :returns: JSONCodec or MsgpackCodec
+    :raises: RemoteCallUnsupportedCodec
+    """
+    if message[:1] == "{":
+        return json_codec
+    if "msgpack" in codecs:
+        return codecs["msgpack"]
+    raise RemoteCallUnsupportedCodec("exceptions/zmq/unsupported-codec")
+
 class ComponentExport():
     def __init__(self, component):
         self.component = component
@@ -55,10 +118,23 @@ class Export:
         debug("Decoding message...")
 
         # deserialize
+        codec = message_codec(message)
         try:
-            request = json.loads(message)
+            request = codec.loads(message)
         except:
-            raise RemoteCallException("Invalid JSON received.")
+            raise RemoteCallException("Invalid %s received." % codec.name)
+
+        return self.parse_request(request)
+
+    def parse_request(self, request):
+        """
+
+        :param request: a decoded request
+        :type request: dict
+        :return: :raise RemoteCallException:
+        """
+        if not isinstance(request, dict):
+            raise RemoteCallException("Request is not a map.")
 
         # extract method name and arguments
         method_name = request.get("method", None)
@@ -81,9 +157,30 @@ class Export:
 
         return method_name, args, kwargs
 
-    def encode(self, success, value):
+    def encode(self, success, value, codec=json_codec):
+        """
+
+        :param success:
+        :param value: the result, or the exception if there was a failure
+        :param codec: the codec the request came in
+        :returns: str
+        """
         debug("Encoding message...")
 
+        envelope = self.envelope(success, value)
+        try:
+            return codec.dumps(envelope)
+        except:
+            error("Message cannot be serialized. Converting to string.")
+            return codec.dumps(self.stringify(envelope))
+
+    def envelope(self, success, value):
+        """
+
+        :param success:
+        :param value: the result, or the exception if there was a failure
+        :returns: dict
+        """
         # try to serialize Exception if there was a failure
         if not success:
             if isinstance(value, Exception):
@@ -91,24 +188,25 @@ class Export:
                 value = {"class":klass.__name__, "module": klass.__module__,
                     "args":value.args}
 
-        # test to see if result serializes
-        try:
-            json.dumps(value)
-        except:
-            error("Message cannot be serialized. Converting to string.")
-            # do our best to serialize
-            try:
-                value = repr(value)
-            except:
-                success = False
-                value = "Result could not be serialized."
-
-        debug("success=%d, value=%s" % (success, json.dumps(value)))
+        debug("success=%d, value=%s" % (success, value))
 
         if success:
-            return json.dumps({"success":success, "result":value})
+            return {"success":success, "result":value}
 
-        return json.dumps({"success":success, "exception":value})
+        return {"success":success, "exception":value}
+
+    def stringify(self, envelope):
+        """
+        Do our best with an envelope which did not serialize.
+
+        :param envelope:
+        :returns: dict
+        """
+        success = envelope["success"]
+        try:
+            return self.envelope(success, repr(envelope["result" if success else "exception"]))
+        except:
+            return self.envelope(False, "Result could not be serialized.")
 
 class AsyncExport(Export):
     def dispatch(self, method_name, args, kwargs):
@@ -197,7 +295,12 @@ class AsyncRouterExport(AsyncExport):
         AsyncExport.__init__(self, wrapped)
         self.connection = connection
         self.connection.gotMessage = self.gotMessage
+        self.connection.gotBatch = self.gotBatch
         self.counter = 0
+        # replies to batched calls, by sender and codec, sent together
+        self.pending_replies = {}
+        self.pending_flush = None
+        self.callLater = reactor.callLater
 
     def gotMessage(self, message_id, message):
         """
@@ -212,20 +315,72 @@ class AsyncRouterExport(AsyncExport):
 
         debug("%s queue length: %s" % (self, self.counter))
 
+        # reply in whatever the request came in
+        codec = json_codec
         try:
+            codec = message_codec(message)
             method_name, args, kwargs = self.decode(message)
         except Exception, e:
             error("RPC Error: %s" % e)
-            return self.connection.reply(message_id, self.encode(False, e))
+            return self.connection.reply(message_id, self.encode(False, e, codec))
+
+        def result(value):
+            log("Got result for method %s." % method_name)
+            self.connection.reply(message_id, self.encode(True, value, codec))
+
+        def exception(failure):
+            warn("Caught exception in method %s." % method_name)
+            warn(failure)
+            self.connection.reply(message_id, self.encode(False, failure.value, codec))
+
+        def complete(result):
+            self.counter -= 1
+            elapsed = (time.time() - start) * 1000
+            debug("%s completed in %.3f ms." % (method_name, elapsed))
+
+        d = self.dispatch(method_name, args, kwargs)
+        d.addCallbacks(result, exception)
+        d.addCallback(complete)
+
+    def gotBatch(self, sender_id, message):
+        """
+        Handle a batch of calls from a DealerProxyMultiplexed. Each call is
+        dispatched on its own, and the replies which are ready by the end of
+        the reactor tick go back to the sender together.
+
+        :param sender_id:
+        :param message:
+        """
+        codec = json_codec
+        try:
+            codec = message_codec(message)
+            batch = codec.loads(message)["batch"]
+        except Exception, e:
+            error("RPC Error: %s" % e)
+            # without the call ids all we can do is send back the error
+            return self.connection.sendBatch(sender_id, self.encode(False, e, codec))
+
+        for call_id, request in batch:
+            self.dispatch_call(sender_id, codec, call_id, request)
+
+    def dispatch_call(self, sender_id, codec, call_id, request):
+        self.counter += 1
+        start = time.time()
+
+        try:
+            method_name, args, kwargs = self.parse_request(request)
+        except Exception, e:
+            error("RPC Error: %s" % e)
+            return self.queue_reply(sender_id, codec, call_id, False, e)
 
         def result(value):
             log("Got result for method %s." % method_name)
-            self.connection.reply(message_id, self.encode(True, value))
+            self.queue_reply(sender_id, codec, call_id, True, value)
 
         def exception(failure):
             warn("Caught exception in method %s." % method_name)
             warn(failure)
-            self.connection.reply(message_id, self.encode(False, failure.value))
+            self.queue_reply(sender_id, codec, call_id, False, failure.value)
 
         def complete(result):
             self.counter -= 1
@@ -236,6 +391,31 @@ class AsyncRouterExport(AsyncExport):
         d.addCallbacks(result, exception)
         d.addCallback(complete)
 
+    def queue_reply(self, sender_id, codec, call_id, success, value):
+        self.pending_replies.setdefault((sender_id, codec), []).append(
+            [call_id, self.envelope(success, value)])
+        if self.pending_flush is None:
+            self.pending_flush = self.callLater(0, self.flush_replies)
+
+    def flush_replies(self):
+        self.pending_flush = None
+        pending_replies, self.pending_replies = self.pending_replies, {}
+        for (sender_id, codec), replies in pending_replies.iteritems():
+            try:
+                message = codec.dumps({"batch": replies})
+            except:
+                error("Message cannot be serialized. Converting to string.")
+                message = codec.dumps({"batch": [[call_id, self.serializable(envelope, codec)]
+                                                 for call_id, envelope in replies]})
+            self.connection.sendBatch(sender_id, message)
+
+    def serializable(self, envelope, codec):
+        try:
+            codec.dumps(envelope)
+            return envelope
+        except:
+            return self.stringify(envelope)
+
 class SyncPullExport(SyncExport):
     def __init__(self, wrapped, connection):
         """
@@ -291,25 +471,27 @@ class SyncRouterExport(SyncExport):
         sender_id = message[0]
         message_id = message[1]
         message = message[3]
+        codec = json_codec
         try:
+            codec = message_codec(message)
             method_name, args, kwargs = self.decode(message)
         except Exception, e:
             error("RPC Error: %s" % e)
             error()
             return self.connection.send_multipart(
-                [sender_id, message_id, "", self.encode(False, e)])
+                [sender_id, message_id, "", self.encode(False, e, codec)])
 
         def result(value):
             log("Got result for method %s id: %s" %
                     (method_name, message_id))
             self.connection.send_multipart(
-                [sender_id, message_id, "", self.encode(True, value)])
+                [sender_id, message_id, "", self.encode(True, value, codec)])
 
         def exception(failure):
             warn("Caught exception in method %s." % method_name)
             warn(failure)
             self.connection.send_multipart(
-                [sender_id, message_id, "", self.encode(False, failure)])
+                [sender_id, message_id, "", self.encode(False, failure, codec)])
 
         try:
             result(self.dispatch(method_name, args, kwargs))
@@ -332,6 +514,25 @@ def connect_subscriber(address):
     socket = ZmqSubConnection(ZmqFactory(), ZmqEndpoint("connect", address))
     return socket
 
+class MultiplexedREPConnection(ZmqREPConnection):
+    """
+    A ZmqREPConnection which also takes batches of calls from
+    DealerProxyMultiplexed. Those come straight from a DEALER socket, so
+    there is no message id between the sender and the empty delimiter.
+    """
+
+    def messageReceived(self, message):
+        if len(message) == 3 and message[1] == b'':
+            self.gotBatch(message[0], message[2])
+        else:
+            ZmqREPConnection.messageReceived(self, message)
+
+    def gotBatch(self, sender_id, message):
+        raise NotImplementedError(self)
+
+    def sendBatch(self, sender_id, message):
+        self.send([sender_id, b'', message])
+
 def router_share_async(obj, address):
     """
 
@@ -339,7 +540,7 @@ def router_share_async(obj, address):
     :param address:
     :returns: AsyncRouterExport
     """
-    socket = ZmqREPConnection(ZmqFactory(), ZmqEndpoint("bind", address))
+    socket = MultiplexedREPConnection(ZmqFactory(), ZmqEndpoint("bind", address))
     return AsyncRouterExport(obj, socket)
 
 def pull_share_async(obj, address):
@@ -379,12 +580,14 @@ def pull_share_sync(obj, address):
         spe.process(socket.recv_multipart())
 
 class Proxy:
-    def __init__(self, connection):
+    def __init__(self, connection, codec="json"):
         """
 
         :param connection:
+        :param codec: what to encode requests with, json or msgpack
         """
         self._connection = connection
+        self._codec = get_codec(codec)
 
     def decode(self, message):
         """
@@ -395,12 +598,23 @@ class Proxy:
         """
         debug("Decoding message...")
 
-        # deserialize
+        # deserialize, replies come in whatever the request went in, except
+        # for errors from exports which cannot decode the request
         try:
-            response = json.loads(message)
+            response = message_codec(message).loads(message)
         except:
-            raise Exception("Invalid JSON received.")
+            raise Exception("Invalid message received.")
+
+        return self.parse_response(response)
 
+    def parse_response(self, response):
+        """
+
+        :param response: a decoded reply
+        :type response: dict
+        :returns: tuple
+        :raises: Exception
+        """
         # extract success and result
         success = response.get("success", None)
         if success == None:
@@ -450,7 +664,7 @@ class Proxy:
         debug("Encoding message...")
         debug("method=%s, args=%s, kwargs=%s" % (method_name, args, kwargs))
 
-        return json.dumps({"method":method_name, "args":args, "kwargs":kwargs})
+        return self._codec.dumps({"method":method_name, "args":args, "kwargs":kwargs})
 
     def __getattr__(self, key):
         """
@@ -484,21 +698,30 @@ class Proxy:
                 # raise it
                 raise result
 
+            def fall_back(failure):
+                failure.trap(RemoteCallUnsupportedCodec)
+                warn("Remote end does not support %s, falling back to json." % self._codec.name)
+                self._codec = json_codec
+                return remote_method(*args, **kwargs)
+
             if isinstance(d, Deferred):
                 d.addCallback(strip_multipart)
                 d.addCallback(parse_result)
+                if self._codec is not json_codec:
+                    d.addErrback(fall_back)
 
             return d
 
         return remote_method
 
 class DealerProxyAsync(Proxy):
-    def __init__(self, connection):
+    def __init__(self, connection, codec="json"):
         """
 
         :param connection:
+        :param codec:
         """
-        Proxy.__init__(self, connection)
+        Proxy.__init__(self, connection, codec)
 
     def send(self, message):
         """
@@ -514,6 +737,150 @@ class DealerProxyAsync(Proxy):
 
         return d.addErrback(convertTimeout)
 
+class TimerWheel:
+    """
+    Times things out with a single timer. Deadlines are rounded up to the
+    next multiple of resolution and kept in one slot per multiple, so adding
+    one is cheap, and nothing has to be cancelled when it completes in time;
+    expire is called with the keys of each slot as it comes due and should
+    ignore those which are done.
+    """
+
+    def __init__(self, expire, resolution=0.1):
+        self.expire = expire
+        self.resolution = resolution
+        self.slots = {}
+        self.timer = None
+        self.callLater = reactor.callLater
+        self.seconds = reactor.seconds
+
+    def add(self, key, timeout):
+        slot = int(math.ceil((self.seconds() + timeout) / self.resolution))
+        self.slots.setdefault(slot, []).append(key)
+        if self.timer is None:
+            self.schedule()
+
+    def schedule(self):
+        due = min(self.slots) * self.resolution
+        self.timer = self.callLater(max(0, due - self.seconds()), self.tick)
+
+    def tick(self):
+        self.timer = None
+        now = self.seconds() / self.resolution
+        for slot in sorted(slot for slot in self.slots if slot <= now):
+            self.expire(self.slots.pop(slot))
+        if self.slots:
+            self.schedule()
+
+class DealerProxyMultiplexed(Proxy):
+    """
+    Like DealerProxyAsync, but all the calls made in one reactor tick go out
+    in a single message, and their replies come back in batches, matched up
+    by call id. Timeouts go on a TimerWheel rather than a DelayedCall each.
+    Needs a router_share_async export on the other end.
+    """
+
+    def __init__(self, connection, timeout=1, codec="json"):
+        """
+
+        :param connection: a DEALER connection
+        :param timeout: seconds, or None to wait forever
+        :param codec:
+        """
+        Proxy.__init__(self, connection, codec)
+        self._connection.gotMessage = self.gotMessage
+        self._timeout = timeout
+        self._next_id = 0
+        # call id -> (request, Deferred)
+        self._calls = {}
+        self._queued = []
+        self._flush = None
+        self._wheel = TimerWheel(self.expire)
+        self.callLater = reactor.callLater
+
+    def encode(self, method_name, args, kwargs):
+        debug("method=%s, args=%s, kwargs=%s" % (method_name, args, kwargs))
+        return {"method":method_name, "args":args, "kwargs":kwargs}
+
+    def decode(self, envelope):
+        return self.parse_response(envelope)
+
+    def send(self, request):
+        """
+
+        :param request:
+        :returns: Deferred
+        """
+        self._next_id += 1
+        call_id = self._next_id
+        d = Deferred()
+        self._calls[call_id] = (request, d)
+        self.queue(call_id, request)
+        if self._timeout is not None:
+            self._wheel.add(call_id, self._timeout)
+        return d
+
+    def queue(self, call_id, request):
+        self._queued.append([call_id, request])
+        if self._flush is None:
+            self._flush = self.callLater(0, self.flush)
+
+    def flush(self):
+        self._flush = None
+        queued, self._queued = self._queued, []
+        self._connection.send([b'', self._codec.dumps({"batch": queued})])
+
+    def expire(self, call_ids):
+        for call_id in call_ids:
+            call = self._calls.pop(call_id, None)
+            if call is not None:
+                call[1].errback(RemoteCallTimedOut("exceptions/zmq/call-timed-out"))
+
+    def gotMessage(self, *message):
+        """
+
+        :param message: the parts of the message, the last is the batch
+        """
+        try:
+            response = message_codec(message[-1]).loads(message[-1])
+        except Exception, e:
+            error("Invalid reply received: %s" % e)
+            return
+
+        batch = response.get("batch", None)
+        if batch is None:
+            # the export could not read our batch at all
+            try:
+                success, exception = self.parse_response(response)
+            except Exception, e:
+                exception = e
+            if isinstance(exception, RemoteCallUnsupportedCodec) and self._codec is not json_codec:
+                # so it ran none of our calls, send them all again
+                warn("Remote end does not support %s, falling back to json." % self._codec.name)
+                self._codec = json_codec
+                queued = set(call_id for call_id, request in self._queued)
+                for call_id in sorted(self._calls):
+                    if call_id not in queued:
+                        self.queue(call_id, self._calls[call_id][0])
+            else:
+                # we cannot tell which batch it was, so fail every call
+                # which has been sent
+                error("Batch failed: %s" % exception)
+                if not isinstance(exception, Exception):
+                    exception = RemoteCallException("exceptions/zmq/batch-failed")
+                queued = set(call_id for call_id, request in self._queued)
+                failed = [call_id for call_id in sorted(self._calls) if call_id not in queued]
+                for call_id in failed:
+                    self._calls.pop(call_id)[1].errback(exception)
+            return
+
+        for call_id, envelope in batch:
+            call = self._calls.pop(call_id, None)
+            if call is None:
+                # timed out already
+                continue
+            call[1].callback([envelope])
+
 class PushProxyAsync(Proxy):
     def send(self, message):
         """
@@ -524,14 +891,15 @@ class PushProxyAsync(Proxy):
         return self._connection.push(message)
 
 class DealerProxySync(Proxy):
-    def __init__(self, connection, timeout=1):
+    def __init__(self, connection, timeout=1, codec="json"):
         """
 
         :param connection:
         :param timeout:
+        :param codec:
         """
         self._timeout = timeout
-        Proxy.__init__(self, connection)
+        Proxy.__init__(self, connection, codec)
         self._connection.RCVTIMEO = int(timeout * 1000)
 
     def send(self, message):
@@ -563,45 +931,54 @@ class PushProxySync(Proxy):
         self._connection.send(message)
         return None
 
-def dealer_proxy_async(address, timeout=1):
+def dealer_proxy_async(address, timeout=1, codec="json", multiplexed=False):
     """
 
     :param address:
-    :returns: DealerProxyAsync
+    :param codec: json, or msgpack if the export supports it (falls back to json if not)
+    :param multiplexed: batch up the calls made in each reactor tick
+    :returns: DealerProxyAsync or DealerProxyMultiplexed
     """
+    if multiplexed:
+        socket = ZmqDealerConnection(ZmqFactory(), ZmqEndpoint("connect", address))
+        return DealerProxyMultiplexed(socket, timeout=timeout, codec=codec)
+
     socket = ZmqREQConnection(ZmqFactory(), ZmqEndpoint("connect", address))
     socket.defaultRequestTimeout = timeout
-    return DealerProxyAsync(socket)
+    return DealerProxyAsync(socket, codec=codec)
 
-def push_proxy_async(address):
+def push_proxy_async(address, codec="json"):
     """
 
 
     :param address:
+    :param codec: json, or msgpack if the puller supports it
     :returns: PushProxyAsync
     """
     socket = ZmqPushConnection(ZmqFactory(), ZmqEndpoint("connect", address))
-    return PushProxyAsync(socket)
+    return PushProxyAsync(socket, codec=codec)
 
-def dealer_proxy_sync(address):
+def dealer_proxy_sync(address, codec="json"):
     """
 
     :param address:
+    :param codec:
     :returns: DealerProxySync
     """
     context = zmq.Context()
     socket = context.socket(zmq.DEALER)
     socket.connect(address)
-    return DealerProxySync(socket)
+    return DealerProxySync(socket, codec=codec)
 
-def push_proxy_sync(address):
+def push_proxy_sync(address, codec="json"):
     """
 
     :param address:
+    :param codec:
     :returns: PushProxySync
     """
     context = zmq.Context()
     socket = context.socket(zmq.PUSH)
     socket.connect(address)
-    return PushProxySync(socket)
+    return PushProxySync(socket, codec=codec)
 
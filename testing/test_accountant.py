@@ -25,7 +25,7 @@ permissions add Trade trade login
 permissions add Withdraw withdraw login
 """
 
-from sputnik.exception import AccountantException
+from sputnik.exception import AccountantException, RemoteCallException
 
 
 class FakeEngine(FakeComponent):
@@ -36,11 +36,23 @@ class FakeEngine(FakeComponent):
         # Always return a good fake result
         return defer.succeed(order.id)
 
+    def place_orders(self, orders):
+        self._log_call('place_orders', orders)
+        return defer.succeed([True] * len(orders))
+
     def cancel_order(self, id):
         self._log_call('cancel_order', id)
         # Always return success, with None
         return defer.succeed(None)
 
+    def cancel_orders(self, ids):
+        self._log_call('cancel_orders', ids)
+        return defer.succeed([True] * len(ids))
+
+    def mass_cancel(self, username=None, ids=None):
+        self._log_call('mass_cancel', username=username, ids=ids)
+        return defer.succeed(ids)
+
 
 class FakeLedger(FakeComponent):
     name = "ledger"
@@ -75,6 +87,9 @@ class FakeWebserverNotifier():
                  "asks": [{"quantity": 1,
                            "price": 2}]})
 
+    def depth_book(self, depth=None):
+        return self.wire_book
+
 
 class TestAccountantBase(TestSputnik):
     def setUp(self):
@@ -416,6 +431,26 @@ class TestCashierExport(TestAccountant):
         position = self.cashier_export.get_position('test', 'BTC')
         self.assertEqual(position, 10)
 
+    def test_position_cache(self):
+        self.create_account('test', '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+
+        position = self.accountant.get_position('test', 'MXN')
+        self.assertIs(self.accountant.get_position('test', 'MXN'), position)
+        self.assertIs(self.accountant.get_user('test'), position.user)
+
+        # a new position which is rolled back is created again
+        self.session.rollback()
+        self.assertNotIn(position, self.session)
+        new_position = self.accountant.get_position('test', 'MXN')
+        self.assertIsNot(new_position, position)
+        self.assertIn(new_position, self.session)
+
+        # committed changes are seen through the cache
+        new_position.position = 5
+        self.session.commit()
+        self.session.rollback()
+        self.assertEqual(self.accountant.get_position_value('test', 'MXN'), 5)
+
 
 class TestAdministratorExport(TestAccountant):
     def test_change_fee_group(self):
@@ -730,6 +765,63 @@ class TestAdministratorExport(TestAccountant):
         d.addCallback(onSuccess)
         return d
 
+    def test_persist_batched(self):
+        from sputnik import models
+
+        self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        clock = task.Clock()
+        self.accountant.callLater = clock.callLater
+        self.accountant.persist_interval = 1
+
+        self.successResultOf(self.administrator_export.adjust_position('test', 'BTC', 10, admin_username='test_admin'))
+        self.successResultOf(self.administrator_export.adjust_position('test', 'BTC', 5, admin_username='test_admin'))
+
+        # nothing is waiting on the ledger, and the changes are only in memory so far
+        self.assertEqual(dict(self.accountant.pending_postings), {})
+        self.assertEqual(self.accountant.get_position_value('test', 'BTC'), 15)
+        position = self.session.query(models.Position).filter_by(username="test").one()
+        self.assertEqual(position.position, 0)
+
+        clock.advance(1)
+        self.session.expire(position)
+        self.assertEqual(position.position, 15)
+        self.assertEqual(self.accountant.get_position_value('test', 'BTC'), 15)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_mismatched_users(self):
+        from sputnik import models
+
+        self.create_account("test")
+        self.create_account("other")
+        self.successResultOf(self.administrator_export.adjust_position('test', 'BTC', 10, admin_username='test_admin'))
+        self.successResultOf(self.administrator_export.adjust_position('other', 'BTC', 10, admin_username='test_admin'))
+        self.assertEqual(self.accountant.get_mismatched_users(), set())
+
+        # As if we had crashed before persisting the change
+        position = self.session.query(models.Position).filter_by(username="test").one()
+        position.position = 0
+        self.session.commit()
+        self.assertEqual(self.accountant.get_mismatched_users(), set(["test"]))
+
+    def test_check_user_twice(self):
+        from sputnik import models
+
+        self.create_account("test")
+        self.successResultOf(self.administrator_export.adjust_position('test', 'BTC', 10, admin_username='test_admin'))
+
+        position = self.session.query(models.Position).filter_by(username="test").one()
+        position.position = 0
+        self.session.commit()
+
+        # A second repair must not count the postings before the checkpoint again
+        self.accountant.check_user("test")
+        self.accountant.check_user("test")
+        self.session.expire(position)
+        self.assertEqual(position.position, 10)
+        self.assertEqual(position.position_checkpoint, 10)
+        self.assertIsNotNone(position.position_cp_timestamp)
+        self.assertEqual(self.accountant.get_mismatched_users(), set())
+
     def test_change_permission_group(self):
         from sputnik import models
 
@@ -911,10 +1003,115 @@ class TestEngineExport(TestAccountant):
             self.assertEqual(aggressive_user_mxn_position.position, round(1800000 * 0.99) + 500000)
             self.assertEqual(passive_user_mxn_position.position, round(3000000 - 1800000 * 1.01))
 
+            # With no persist interval the fill and the trade are written straight away
+            for id in aggressive_order, passive_order:
+                self.assertEqual(self.session.query(models.Order).filter_by(id=id).one().quantity_left, 0)
+            trade = self.session.query(models.Trade).one()
+            self.assertEqual((trade.aggressive_order_id, trade.passive_order_id), (aggressive_order, passive_order))
+            self.assertTrue(trade.posted)
+
+            # As if we had crashed before marking it posted
+            trade.posted = False
+            self.session.commit()
+            self.accountant.repair_trades()
+            self.session.expire(trade)
+            self.assertTrue(trade.posted)
+
+            # As if we had crashed before writing the fill and the trade
+            self.session.delete(trade)
+            for id in aggressive_order, passive_order:
+                self.session.query(models.Order).filter_by(id=id).one().quantity_left = 3000000
+            self.session.commit()
+            self.accountant.repair_fills()
+            self.accountant.repair_fills()
+            for id in aggressive_order, passive_order:
+                order = self.session.query(models.Order).filter_by(id=id).one()
+                self.session.expire(order)
+                self.assertEqual(order.quantity_left, 0)
+            trade = self.session.query(models.Trade).one()
+            self.assertEqual((trade.aggressive_order_id, trade.passive_order_id, trade.price, trade.quantity),
+                             (aggressive_order, passive_order, 60000000, 3000000))
+            self.assertTrue(trade.posted)
+
         dl = defer.DeferredList([d1, d2])
         dl.addCallback(onSuccess)
         return dl
 
+    def test_post_transaction_queries(self):
+        from sputnik import util, models
+        from sqlalchemy import event
+        import datetime
+
+        # as the accountant's own session is set up
+        self.session.expire_on_commit = False
+
+        self.create_account("aggressive_user", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.create_account("passive_user", '28cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 'MXN')
+        self.add_address('aggressive_user', 'BTC_address_2', 'BTC')
+        self.add_address('passive_user', 'MXN_address_2', 'MXN')
+        self.set_permissions_group("aggressive_user", 'Deposit')
+        self.set_permissions_group("passive_user", "Deposit")
+        self.cashier_export.deposit_cash('aggressive_user', 'BTC_address_2', 400000000)
+        self.cashier_export.deposit_cash('passive_user', 'MXN_address_2', 5000000)
+        self.set_permissions_group("aggressive_user", 'Trade')
+        self.set_permissions_group("passive_user", "Trade")
+
+        def place(username, side):
+            return self.webserver_export.place_order(username, {'username': username,
+                                                                'contract': 'BTC/MXN',
+                                                                'price': 60000000,
+                                                                'quantity': 3000000,
+                                                                'side': side,
+                                                                'timestamp': util.dt_to_timestamp(
+                                                                    datetime.datetime.utcnow())})
+
+        passive_order = place('passive_user', 'BUY')
+        aggressive_order = place('aggressive_user', 'SELL')
+
+        def fill():
+            uid = util.get_uid()
+            timestamp = util.dt_to_timestamp(datetime.datetime.utcnow())
+            transaction = {'contract': 'BTC/MXN', 'price': 60000000, 'quantity': 1000000,
+                           'uid': uid, 'timestamp': timestamp}
+            aggressive = dict(transaction, username='aggressive_user', aggressive=True, side='SELL',
+                              order=aggressive_order, other_order=passive_order)
+            passive = dict(transaction, username='passive_user', aggressive=False, side='BUY',
+                           order=passive_order, other_order=aggressive_order)
+            return defer.DeferredList([self.engine_export.post_transaction('aggressive_user', aggressive),
+                                       self.engine_export.post_transaction('passive_user', passive)])
+
+        clock = task.Clock()
+        self.accountant.callLater = clock.callLater
+        self.accountant.persist_interval = 1
+
+        # the first fill looks everything up
+        self.successResultOf(fill())
+        clock.advance(1)
+
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(self.session.bind, "before_cursor_execute", count)
+        try:
+            self.successResultOf(fill())
+            # Nothing but the ledger's postings is written until the fills are persisted
+            self.assertEqual([statement for statement in statements
+                              if not statement.startswith(("INSERT INTO journal", "INSERT INTO posting"))], [])
+            orders = [args[1] for name, args, kwargs in self.webserver.log if name == "order"]
+            self.assertEqual(orders[-1]["quantity_left"], 1000000)
+
+            clock.advance(1)
+        finally:
+            event.remove(self.session.bind, "before_cursor_execute", count)
+
+        self.assertEqual([statement for statement in statements if statement.startswith("SELECT")], [])
+        # The fill and the trade are written with the positions
+        self.assertTrue(any(statement.startswith("UPDATE orders") for statement in statements))
+        self.assertTrue(any(statement.startswith("INSERT INTO trades") for statement in statements))
+        for id in aggressive_order, passive_order:
+            self.assertEqual(self.session.query(models.Order).filter_by(id=id).one().quantity_left, 1000000)
+        self.assertEqual([trade.posted for trade in self.session.query(models.Trade)], [True, True])
+
     """
     # Not implemented yet
     def test_safe_prices(self):
@@ -1198,6 +1395,163 @@ class TestWebserverExport(TestAccountant):
                                                            datetime.datetime.utcnow())})
 
 
+    def test_place_orders(self):
+        self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.add_address("test", '28cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 'MXN')
+        self.set_permissions_group("test", 'Deposit')
+        self.cashier_export.deposit_cash("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 5000000)
+        self.set_permissions_group("test", 'Trade')
+
+        from sputnik import util
+        import datetime
+
+        timestamp = util.dt_to_timestamp(datetime.datetime.utcnow())
+        ids = self.webserver_export.place_orders('test', [{'username': 'test',
+                                                           'contract': 'BTC/MXN',
+                                                           'price': price,
+                                                           'quantity': 2000000,
+                                                           'side': 'SELL',
+                                                           'timestamp': timestamp} for price in 1000000, 1100000])
+
+        from sputnik import models
+
+        orders = [self.session.query(models.Order).filter_by(id=id).one() for id in ids]
+        self.assertEqual([order.price for order in orders], [1000000, 1100000])
+        self.assertTrue(all(order.accepted and order.dispatched for order in orders))
+
+        # One engine call for the whole batch
+        self.assertEqual(len(self.engines['BTC/MXN'].component.log), 1)
+        self.assertEqual([order.id for order in self.engines['BTC/MXN'].component.log[0][1][0]], ids)
+
+    def test_place_orders_no_cash(self):
+        self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.add_address("test", '28cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 'MXN')
+        self.set_permissions_group("test", 'Deposit')
+        self.cashier_export.deposit_cash("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 5000000)
+        self.set_permissions_group("test", 'Trade')
+
+        from sputnik import util
+        import datetime
+
+        # Each order fits on its own, but not both together
+        timestamp = util.dt_to_timestamp(datetime.datetime.utcnow())
+        with self.assertRaisesRegexp(AccountantException, 'insufficient_margin'):
+            self.webserver_export.place_orders('test', [{'username': 'test',
+                                                         'contract': 'BTC/MXN',
+                                                         'price': 1000000,
+                                                         'quantity': 3000000,
+                                                         'side': 'SELL',
+                                                         'timestamp': timestamp}] * 2)
+
+        from sputnik import models
+
+        self.assertEqual(self.session.query(models.Order).count(), 0)
+        self.assertEqual(self.engines['BTC/MXN'].component.log, [])
+
+    def test_cancel_orders_success(self):
+        self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.add_address("test", '28cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 'MXN')
+        self.set_permissions_group("test", 'Deposit')
+        self.cashier_export.deposit_cash("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 5000000)
+        self.set_permissions_group("test", 'Trade')
+
+        from sputnik import util
+        import datetime
+
+        timestamp = util.dt_to_timestamp(datetime.datetime.utcnow())
+        ids = self.webserver_export.place_orders('test', [{'username': 'test',
+                                                           'contract': 'BTC/MXN',
+                                                           'price': 1000000,
+                                                           'quantity': 1000000,
+                                                           'side': 'SELL',
+                                                           'timestamp': timestamp}] * 3)
+
+        def cancelSuccess(result):
+            from sputnik import models
+
+            self.assertEqual(result, [True, True, True])
+            self.assertTrue(self.engines['BTC/MXN'].component.check_for_calls([('cancel_orders', (ids,), {})]))
+            for id in ids:
+                self.assertTrue(self.session.query(models.Order).filter_by(id=id).one().is_cancelled)
+
+        d = self.webserver_export.cancel_orders('test', ids)
+        d.addCallback(cancelSuccess)
+        return d
+
+    def test_cancel_orders_engine_fails(self):
+        from sputnik import models
+
+        self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.set_permissions_group("test", 'Trade')
+        self.user = self.get_user("test")
+        ids = [self.create_order('BTC/MXN', 1000000, 1000000, 'SELL'),
+               self.create_order('NETS2015', 1, 500, 'BUY'),
+               self.create_order('BTC/MXN', 1000000, 1000000, 'SELL')]
+        self.engines['NETS2015'].engine.cancel_orders = \
+            lambda ids: defer.fail(RemoteCallException("exceptions/zmq/batch-failed"))
+
+        failure = self.failureResultOf(self.webserver_export.cancel_orders('test', ids), AccountantException)
+        self.assertEqual(failure.value.args, ("exceptions/accountant/cancel_failed", [ids[1]]))
+        self.assertEqual(len(self.flushLoggedErrors(RemoteCallException)), 1)
+
+        # The orders of the engine which replied are cancelled all the same
+        for id, cancelled in zip(ids, [True, False, True]):
+            self.assertEqual(self.session.query(models.Order).filter_by(id=id).one().is_cancelled, cancelled)
+        self.assertEqual(len([call for call in self.webserver.component.log if call[0] == 'order']), 2)
+
+    def test_cancel_orders_wrong_user(self):
+        self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.add_address("test", '28cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 'MXN')
+        self.set_permissions_group("test", 'Deposit')
+        self.cashier_export.deposit_cash("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 5000000)
+        self.set_permissions_group("test", 'Trade')
+
+        from sputnik import util
+        import datetime
+
+        id = self.webserver_export.place_order('test', {'username': 'test',
+                                                        'contract': 'BTC/MXN',
+                                                        'price': 1000000,
+                                                        'quantity': 3000000,
+                                                        'side': 'SELL',
+                                                        'timestamp': util.dt_to_timestamp(datetime.datetime.utcnow())})
+
+        with self.assertRaisesRegexp(AccountantException, "user_order_mismatch"):
+            self.webserver_export.cancel_orders('wrong', [id])
+
+    def test_cancel_user_orders(self):
+        self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.add_address("test", '28cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 'MXN')
+        self.set_permissions_group("test", 'Deposit')
+        self.cashier_export.deposit_cash("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 5000000)
+        self.set_permissions_group("test", 'Trade')
+
+        from sputnik import util
+        import datetime
+
+        timestamp = util.dt_to_timestamp(datetime.datetime.utcnow())
+        ids = self.webserver_export.place_orders('test', [{'username': 'test',
+                                                           'contract': 'BTC/MXN',
+                                                           'price': 1000000,
+                                                           'quantity': 1000000,
+                                                           'side': 'SELL',
+                                                           'timestamp': timestamp}] * 3)
+
+        def cancelled(result):
+            from sputnik import models
+
+            # One engine call for all the orders
+            self.assertTrue(self.engines['BTC/MXN'].component.check_for_calls([('mass_cancel', (),
+                                                                                {'username': None, 'ids': ids})]))
+            self.assertEqual(len([call for call in self.engines['BTC/MXN'].component.log
+                                  if call[0] == 'mass_cancel']), 1)
+            for id in ids:
+                self.assertTrue(self.session.query(models.Order).filter_by(id=id).one().is_cancelled)
+
+        d = self.accountant.cancel_user_orders('test')
+        d.addCallback(cancelled)
+        return d
+
     def test_cancel_order_success(self):
         self.create_account("test", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
         self.add_address("test", '28cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv', 'MXN')
@@ -1415,3 +1769,72 @@ class TestRiskManagerExport(TestAccountant):
         return d
 
 
+
+
+class FakeShardedAccountantProxy(FakeAccountantProxy):
+    def __init__(self, accountant, num_procs):
+        from sputnik import sharding
+
+        FakeAccountantProxy.__init__(self, accountant)
+        self.num_procs = num_procs
+        self.shards = sharding.ShardMap(num_procs)
+        self.forwarded = []
+
+    def get_accountant_for_user(self, username):
+        return self.shards.accountant_for(username)
+
+    def load_shards(self, session):
+        return self.shards.load(session)
+
+    def remote_post(self, username, *postings):
+        self.forwarded.append((username, postings))
+
+
+class TestMigration(TestAccountant):
+    def setUp(self):
+        TestAccountant.setUp(self)
+
+        self.accountant.accountant_proxy = FakeShardedAccountantProxy(self.accountant, 2)
+        self.accountant.accountant_export = accountant.AccountantExport(self.accountant)
+        self.clock = task.Clock()
+        self.accountant.callLater = self.clock.callLater
+
+        # carol is on accountant 0 with two accountants
+        self.create_account("carol", '18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv')
+        self.assertTrue(self.accountant.owns_user("carol"))
+
+    def test_migrate_user(self):
+        from sputnik import models
+
+        self.accountant.pending_postings[("carol", "BTC")] = 1
+        d = self.administrator_export.migrate_user("carol", 1)
+        self.assertNoResult(d)
+        self.assertFalse(self.accountant.is_user_enabled("carol"))
+
+        del self.accountant.pending_postings[("carol", "BTC")]
+        self.clock.advance(1)
+        self.assertEqual(self.successResultOf(d), 1)
+
+        shard = self.session.query(models.AccountantShard).filter_by(username="carol").one()
+        self.assertEqual(shard.accountant, 1)
+        self.assertFalse(self.accountant.owns_user("carol"))
+        self.assertRaisesRegexp(AccountantException, "disabled_user", self.cashier_export.deposit_cash,
+                                "carol", "18cPi8tehBK7NYKfw3nNbPE4xTL8P8DJAv", 10)
+
+        from sputnik.ledger import create_posting
+        posting = create_posting("Transfer", "carol", "BTC", 10, "credit", "Moved")
+        posting["count"] = 2
+        posting["uid"] = "uid"
+        self.accountant.accountant_export.remote_post("carol", posting)
+        self.assertEqual(self.accountant.accountant_proxy.forwarded, [("carol", (posting,))])
+
+        # Moving back to where the ring puts carol drops the pin
+        self.session.delete(shard)
+        self.session.commit()
+        self.accountant.reload_shards()
+        self.assertTrue(self.accountant.owns_user("carol"))
+        self.assertTrue(self.accountant.is_user_enabled("carol"))
+
+    def test_migrate_user_not_ours(self):
+        self.accountant.accountant_proxy.shards.set_assignments({"carol": 1})
+        self.assertRaises(AccountantException, self.administrator_export.migrate_user, "carol", 0)
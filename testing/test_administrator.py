@@ -17,7 +17,7 @@ import re
 from twisted.web.test.test_web import DummyRequest
 from twisted.internet import defer
 from datetime import datetime, timedelta
-from sputnik.exception import AdministratorException
+from sputnik.exception import AdministratorException, AccountantException
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                              "../server"))
@@ -36,6 +36,12 @@ class FakeAccountant(FakeComponent):
         self._log_call("get_balance_sheet")
         return defer.succeed({})
 
+    def migrate_user(self, username, accountant):
+        self._log_call("migrate_user", username, accountant)
+        if accountant == 0:
+            return defer.succeed(None)
+        return defer.fail(AccountantException("exceptions/accountant/no_such_accountant"))
+
 class FakeEngine(FakeComponent):
     name = "engine"
 
@@ -896,6 +902,37 @@ class TestAdministratorWebUI(TestAdministrator):
         d.addCallback(rendered)
         return d
 
+    def test_migrate_user(self):
+        request = StupidRequest([''], path='/migrate_user',
+                                args={'username': ['test'],
+                                      'accountant': ['0']})
+        admin_ui = self.web_ui_factory(5)
+        d = self.render_test_helper(admin_ui, request)
+
+        def rendered(ignored):
+            self.assertRegexpMatches(request.redirect_url, 'user_details')
+            self.assertTrue(self.administrator.accountant.component.check_for_calls(
+                [('migrate_user', ('test', 0), {})]))
+
+        d.addCallback(rendered)
+        return d
+
+    def test_migrate_user_fails(self):
+        request = StupidRequest([''], path='/migrate_user',
+                                args={'username': ['test'],
+                                      'accountant': ['7']})
+        admin_ui = self.web_ui_factory(5)
+        d = self.render_test_helper(admin_ui, request)
+
+        def rendered(ignored):
+            # the request is finished with an error page
+            self.assertEqual(request.redirect_url, None)
+            self.assertRegexpMatches(''.join(request.written), 'no_such_accountant')
+            self.flushLoggedErrors()
+
+        d.addCallback(rendered)
+        return d
+
     def test_adjust_position(self):
         request = StupidRequest([''], path='/adjust_position',
                                 args={'username': ['test'],
@@ -10,7 +10,7 @@ import sys
 import os
 import copy
 from test_sputnik import TestSputnik, FakeComponent
-from twisted.internet import defer
+from twisted.internet import defer, task
 from pprint import pprint
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
@@ -32,12 +32,15 @@ class TestEngine(TestSputnik):
 
         self.administrator_export = engine2.AdministratorExport(self.engine)
 
-    def create_order(self, quantity=None, price=None, side=None):
+    def create_order(self, quantity=None, price=None, side=None, timestamp=None):
         from sputnik.engine2 import Order
 
         self.order_counter += 1
         return Order(id=self.order_counter, contract="FOO", quantity=quantity,
-                     price=price, side=side)
+                     price=price, side=side, timestamp=timestamp)
+
+    def get_book(self):
+        return {side: list(orders) for side, orders in self.engine.orderbook.iteritems()}
 
 
 class TestEngineInternals(TestEngine):
@@ -46,7 +49,7 @@ class TestEngineInternals(TestEngine):
         # make a copy of the order to compare against
         order2 = self.create_order(1, 100, -1)
         self.engine.place_order(order)
-        self.assertTrue(FakeComponent.check(self.engine.orderbook, {-1: [order2], 1: []}))
+        self.assertTrue(FakeComponent.check(self.get_book(), {-1: [order2], 1: []}))
         self.assertTrue(self.fake_listener.component.check_for_calls([('on_queue_success',
                                                                        (order2,),
                                                                        {})]))
@@ -56,7 +59,7 @@ class TestEngineInternals(TestEngine):
         # make a copy of the order to compare against
         order2 = self.create_order(1, 100, 1)
         self.engine.place_order(order)
-        self.assertTrue(FakeComponent.check(self.engine.orderbook, {-1: [], 1: [order2]}))
+        self.assertTrue(FakeComponent.check(self.get_book(), {-1: [], 1: [order2]}))
         self.assertTrue(self.fake_listener.component.check_for_calls([('on_queue_success',
                                                                        (order2,),
                                                                        {})]))
@@ -73,7 +76,7 @@ class TestEngineInternals(TestEngine):
 
         self.engine.place_order(order_bid)
         self.engine.place_order(order_ask)
-        self.assertTrue(FakeComponent.check(self.engine.orderbook, {-1: [], 1: []}))
+        self.assertTrue(FakeComponent.check(self.get_book(), {-1: [], 1: []}))
         self.assertTrue(self.fake_listener.component.check_for_calls([('on_queue_success',
                                                                        (order_bid2,),
                                                                        {}),
@@ -95,7 +98,7 @@ class TestEngineInternals(TestEngine):
 
         self.engine.place_order(order_bid)
         self.engine.place_order(order_ask)
-        self.assertTrue(FakeComponent.check(self.engine.orderbook, {-1: [], 1: []}))
+        self.assertTrue(FakeComponent.check(self.get_book(), {-1: [], 1: []}))
         self.assertTrue(self.fake_listener.component.check_for_calls([('on_queue_success',
                                                                        (order_bid2,),
                                                                        {}),
@@ -113,7 +116,7 @@ class TestEngineInternals(TestEngine):
 
         self.engine.place_order(order_bid)
         self.engine.place_order(order_ask)
-        self.assertTrue(FakeComponent.check(self.engine.orderbook, {-1: [order_bid], 1: [order_ask]}))
+        self.assertTrue(FakeComponent.check(self.get_book(), {-1: [order_bid], 1: [order_ask]}))
         self.assertTrue(self.fake_listener.component.check_for_calls([('on_queue_success',
                                                                        (order_bid,),
                                                                        {}),
@@ -211,6 +214,107 @@ class TestEngineInternals(TestEngine):
               {})]))
 
 
+    def test_cancel_order_not_on_book(self):
+        self.assertFalse(self.engine.cancel_order(42))
+        self.assertTrue(self.fake_listener.component.check_for_calls(
+            [('on_cancel_fail',
+              (42, "the order is no longer on the book"),
+              {})]))
+
+    def test_cancel_order_middle_of_level(self):
+        first = self.create_order(1, 100, -1)
+        middle = self.create_order(1, 100, -1)
+        last = self.create_order(1, 100, -1)
+        for order in first, middle, last:
+            self.engine.place_order(order)
+
+        self.assertTrue(self.engine.cancel_order(middle.id))
+        self.assertEqual([o.id for o in self.engine.orderbook[-1]], [first.id, last.id])
+        self.assertNotIn(middle.id, self.engine.ordermap)
+
+    def test_cancel_order_removes_level(self):
+        order_bid = self.create_order(1, 100, -1)
+        order_bid2 = self.create_order(1, 99, -1)
+        self.engine.place_order(order_bid)
+        self.engine.place_order(order_bid2)
+
+        self.engine.cancel_order(order_bid.id)
+        self.assertEqual(self.engine.orderbook[-1].keys, [99])
+        self.assertEqual(self.engine.orderbook[-1].best().id, order_bid2.id)
+
+    def test_time_priority(self):
+        order_ask = self.create_order(1, 100, 1, timestamp=1)
+        order_ask2 = self.create_order(1, 100, 1, timestamp=2)
+        self.engine.place_order(order_ask2)
+        self.engine.place_order(order_ask)
+
+        # The older order is first in line even though it arrived later
+        self.assertEqual([o.id for o in self.engine.orderbook[1]], [order_ask.id, order_ask2.id])
+
+        order_bid = self.create_order(1, 100, -1, timestamp=3)
+        self.engine.place_order(order_bid)
+        self.assertEqual([o.id for o in self.engine.orderbook[1]], [order_ask2.id])
+
+    def test_sweep_levels(self):
+        for price in 103, 101, 102:
+            self.engine.place_order(self.create_order(1, price, 1))
+
+        self.assertEqual([o.price for o in self.engine.orderbook[1]], [101, 102, 103])
+
+        order_bid = self.create_order(3, 102, -1)
+        self.engine.place_order(order_bid)
+        self.assertEqual([o.price for o in self.engine.orderbook[1]], [103])
+        self.assertEqual([o.price for o in self.engine.orderbook[-1]], [102])
+        self.assertEqual(order_bid.quantity_left, 1)
+        self.assertEqual(len(self.engine.ordermap), 2)
+
+
+
+class TestOrder(TestEngine):
+    def test_default_timestamps_increase(self):
+        orders = [self.create_order(1, 100, -1) for i in range(100)]
+        timestamps = [order.timestamp for order in orders]
+        self.assertEqual(timestamps, sorted(set(timestamps)))
+
+    def test_priority(self):
+        better_price = self.create_order(1, 101, -1, timestamp=2)
+        earlier = self.create_order(1, 100, -1, timestamp=1)
+        later = self.create_order(1, 100, -1, timestamp=2)
+        self.assertTrue(better_price < earlier < later)
+
+        ask = self.create_order(1, 100, 1, timestamp=1)
+        better_ask = self.create_order(1, 99, 1, timestamp=2)
+        self.assertTrue(better_ask < ask)
+        self.assertRaises(Exception, lambda: ask < later)
+
+    def test_compact(self):
+        order = self.create_order(1, 100, -1)
+        self.assertFalse(hasattr(order, "__dict__"))
+        order_copy = copy.deepcopy(order)
+        self.assertEqual(repr(order_copy), repr(order))
+
+
+class TestEngineBenchmark(TestEngine):
+    def test_flows_are_reproducible(self):
+        import engine_benchmark
+
+        for flow in engine_benchmark.FLOWS:
+            first = engine_benchmark.run(flow, seed=1, orders=200, depth=20)
+            second = engine_benchmark.run(flow, seed=1, orders=200, depth=20)
+            for key in "operations", "places", "cancels", "resting":
+                self.assertEqual(first[key], second[key])
+            self.assertGreater(first["operations"], 0)
+
+    def test_market_maker_keeps_ladder(self):
+        import engine_benchmark
+
+        result = engine_benchmark.run("market_maker", seed=1, orders=2000, depth=50, cancel_ratio=0.5)
+        # the ladder is not timed, and every filled quote is replaced
+        self.assertTrue(2000 <= result["operations"] <= 2001)
+        self.assertEqual(result["resting"], 100)
+        self.assertGreater(result["cancels"], result["operations"] / 5)
+
+
 class TestAdministratorExport(TestEngine):
     def test_get_order_book(self):
         order_bid = self.create_order(1, 100, -1)
@@ -296,13 +400,16 @@ class TestWebserverNotifier(TestNotifier):
 
     def test_on_queue_success(self):
         self.webserver_notifier.on_queue_success(self.order)
+        self.webserver_notifier.on_flush()
         self.assertTrue(self.webserver.component.check_for_calls([
             ('book', ('FOO', {'asks': [], 'bids': [{'price': 13, 'quantity': 10}], 'contract': 'FOO'}),
              {})]))
 
     def test_on_cancel_success(self):
         self.webserver_notifier.on_queue_success(self.order)
+        self.webserver_notifier.on_flush()
         self.webserver_notifier.on_cancel_success(self.order)
+        self.webserver_notifier.on_flush()
 
         self.assertTrue(self.webserver.component.check_for_calls([('book',
                                                                    ('FOO',
@@ -317,9 +424,12 @@ class TestWebserverNotifier(TestNotifier):
 
     def test_on_cancel_success_not_all(self):
         self.webserver_notifier.on_queue_success(self.order)
+        self.webserver_notifier.on_flush()
         self.webserver_notifier.on_queue_success(self.order)
+        self.webserver_notifier.on_flush()
 
         self.webserver_notifier.on_cancel_success(self.order)
+        self.webserver_notifier.on_flush()
         self.assertTrue(self.webserver.component.check_for_calls([('book',
                                                                    ('FOO',
                                                                     {'asks': [],
@@ -342,7 +452,9 @@ class TestWebserverNotifier(TestNotifier):
 
     def test_on_trade_success(self):
         self.webserver_notifier.on_queue_success(self.passive_order)
+        self.webserver_notifier.on_flush()
         self.webserver_notifier.on_trade_success(self.order, self.passive_order, 13, 5)
+        self.webserver_notifier.on_flush()
         self.assertTrue(self.webserver.component.check_for_calls([('book',
                                                                    ('FOO',
                                                                     {'asks': [],
@@ -361,9 +473,12 @@ class TestWebserverNotifier(TestNotifier):
         order_bid = self.create_order(1, 100, -1)
         order_ask = self.create_order(2, 100, 1)
         self.webserver_notifier.on_queue_success(order_bid)
+        self.webserver_notifier.on_flush()
         self.webserver_notifier.on_trade_success(order_ask, order_bid, 100, 1)
+        self.webserver_notifier.on_flush()
         order_ask.quantity_left = 1
         self.webserver_notifier.on_queue_success(order_ask)
+        self.webserver_notifier.on_flush()
         self.assertTrue(self.webserver.component.check_for_calls([('book',
                                                                    ('FOO',
                                                                     {'asks': [],
@@ -381,6 +496,446 @@ class TestWebserverNotifier(TestNotifier):
         ))
 
 
+class TestWebserverNotifierBook(TestNotifier):
+    def setUp(self):
+        TestNotifier.setUp(self)
+        from sputnik import engine2
+
+        self.webserver = FakeComponent()
+        self.webserver_notifier = engine2.WebserverNotifier(self.engine, self.webserver, self.contract,
+                                                            reg_publish=False)
+        self.engine.add_listener(self.webserver_notifier)
+        self.accountant_export = engine2.AccountantExport(self.engine, None, self.webserver_notifier)
+
+        for price, side in (12, -1), (10, -1), (11, -1), (15, 1), (13, 1), (14, 1):
+            self.engine.place_order(self.create_order(1, price, side))
+
+    def test_sorted(self):
+        book = self.webserver_notifier.wire_book
+        self.assertEqual([row["price"] for row in book["bids"]], [12, 11, 10])
+        self.assertEqual([row["price"] for row in book["asks"]], [13, 14, 15])
+
+    def test_depth(self):
+        self.assertEqual(self.accountant_export.get_order_book(depth=1),
+                         {'contract': 'FOO', 'sequence': 6,
+                          'bids': [{'price': 12, 'quantity': 1}],
+                          'asks': [{'price': 13, 'quantity': 1}]})
+        self.assertEqual(len(self.accountant_export.get_order_book()["bids"]), 3)
+
+    def test_cached_until_changed(self):
+        book = self.webserver_notifier.wire_book
+        self.assertIs(self.webserver_notifier.wire_book, book)
+
+        self.engine.place_order(self.create_order(1, 12, 1))
+        book = self.webserver_notifier.wire_book
+        self.assertEqual(book["sequence"], 7)
+        self.assertEqual(book["bids"][0], {'price': 11, 'quantity': 1})
+        self.assertEqual(self.webserver_notifier.depth_book(1)["bids"], [{'price': 11, 'quantity': 1}])
+
+
+class TestWebserverNotifierCoalescing(TestNotifier):
+    def setUp(self):
+        TestNotifier.setUp(self)
+        from sputnik import engine2
+
+        self.webserver = FakeComponent()
+        self.webserver_notifier = engine2.WebserverNotifier(self.engine, self.webserver, self.contract,
+                                                            reg_publish=False)
+        self.engine.add_listener(self.webserver_notifier)
+
+    def test_sweep_publishes_once(self):
+        for price in 10, 11, 12:
+            self.engine.place_order(self.create_order(1, price, 1))
+        del self.webserver.log[:]
+
+        self.engine.place_order(self.create_order(4, 12, -1))
+        self.assertEqual(self.webserver.log, [
+            ('book', ('FOO', {'asks': [], 'bids': [{'price': 12, 'quantity': 1}],
+                              'contract': 'FOO', 'sequence': 4}), {})])
+
+    def test_publish_interval(self):
+        clock = task.Clock()
+        self.webserver_notifier.publish_interval = 0.5
+        self.webserver_notifier.callLater = clock.callLater
+
+        self.engine.place_order(self.create_order(1, 10, 1))
+        self.engine.place_order(self.create_order(2, 11, 1))
+        self.engine.place_order(self.create_order(1, 10, -1))
+        self.assertEqual(self.webserver.log, [])
+
+        clock.advance(0.5)
+        self.assertEqual(self.webserver.log, [
+            ('book', ('FOO', {'asks': [{'price': 11, 'quantity': 2}], 'bids': [],
+                              'contract': 'FOO', 'sequence': 1}), {})])
+
+        # nothing changed, nothing to publish
+        clock.advance(0.5)
+        self.assertEqual(len(self.webserver.log), 1)
+
+
+class TestWebserverNotifierDeltas(TestNotifier):
+    def setUp(self):
+        TestNotifier.setUp(self)
+        from sputnik import engine2
+
+        self.webserver = FakeComponent()
+        self.webserver_notifier = engine2.WebserverNotifier(self.engine, self.webserver, self.contract,
+                                                            reg_publish=False, deltas=True, snapshot_interval=3)
+
+    def test_deltas(self):
+        self.webserver_notifier.on_queue_success(self.order)
+        self.webserver_notifier.on_flush()
+        self.webserver_notifier.on_queue_success(self.small_order)
+        self.webserver_notifier.on_flush()
+        self.webserver_notifier.on_cancel_success(self.order)
+        self.webserver_notifier.on_flush()
+        self.assertEqual(self.webserver.log, [
+            ('book_delta', ('FOO', {'asks': [], 'bids': [{'price': 13, 'quantity': 10}],
+                                    'contract': 'FOO', 'sequence': 1}), {}),
+            ('book_delta', ('FOO', {'asks': [], 'bids': [{'price': 13, 'quantity': 15}],
+                                    'contract': 'FOO', 'sequence': 2}), {}),
+            ('book_delta', ('FOO', {'asks': [], 'bids': [{'price': 13, 'quantity': 5}],
+                                    'contract': 'FOO', 'sequence': 3}), {}),
+            # every snapshot_interval deltas we get a complete book
+            ('book', ('FOO', {'asks': [], 'bids': [{'price': 13, 'quantity': 5}],
+                              'contract': 'FOO', 'sequence': 3}), {})])
+
+    def test_level_removed(self):
+        self.webserver_notifier.on_queue_success(self.passive_order)
+        self.webserver_notifier.on_flush()
+        self.webserver_notifier.on_trade_success(self.order, self.passive_order, 10, 10)
+        self.webserver_notifier.on_flush()
+        self.assertEqual(self.webserver.log[-1],
+            ('book_delta', ('FOO', {'asks': [{'price': 10, 'quantity': 0}], 'bids': [],
+                                    'contract': 'FOO', 'sequence': 2}), {}))
+
+    def test_snapshot(self):
+        self.engine.add_listener(self.webserver_notifier)
+        self.engine.place_order(self.order)
+        self.webserver_notifier.on_init()
+        self.assertEqual(self.webserver.log[-1],
+            ('book', ('FOO', {'asks': [], 'bids': [{'price': 13, 'quantity': 10}],
+                              'contract': 'FOO', 'sequence': 1}), {}))
+
+
+class TestEngineBatches(TestNotifier):
+    def setUp(self):
+        TestNotifier.setUp(self)
+        from sputnik import engine2
+
+        self.webserver = FakeComponent()
+        self.webserver_notifier = engine2.WebserverNotifier(self.engine, self.webserver, self.contract,
+                                                            reg_publish=False)
+        self.engine.add_listener(self.webserver_notifier)
+
+    def test_place_orders(self):
+        orders = [self.create_order(1, price, 1) for price in 10, 11, 12]
+        self.assertEqual(self.engine.place_orders(orders), [True, True, True])
+        self.assertEqual(self.get_book()[1], orders)
+        # one book for the whole batch
+        self.assertEqual([call[0] for call in self.webserver.log], ['book'])
+
+    def test_cancel_orders(self):
+        orders = [self.create_order(1, price, 1) for price in 10, 11, 12]
+        self.engine.place_orders(orders)
+        del self.webserver.log[:]
+
+        self.assertEqual(self.engine.cancel_orders([1, 3, 99]), [True, True, False])
+        self.assertEqual(self.get_book()[1], orders[1:2])
+        self.assertEqual([call[0] for call in self.webserver.log], ['book'])
+
+
+class TestEngineMassCancel(TestNotifier):
+    def setUp(self):
+        TestNotifier.setUp(self)
+        from sputnik import engine2
+
+        self.webserver = FakeComponent()
+        self.webserver_notifier = engine2.WebserverNotifier(self.engine, self.webserver, self.contract,
+                                                            reg_publish=False)
+        self.engine.add_listener(self.webserver_notifier)
+
+        self.orders = [self.create_order(1, 10, 1), self.create_order(1, 11, 1),
+                       self.create_order(1, 5, -1), self.create_order(1, 11, 1)]
+        self.orders[1].username = "other"
+        self.engine.place_orders(self.orders)
+        del self.webserver.log[:]
+        del self.fake_listener.log[:]
+
+    def test_ids(self):
+        self.assertEqual(self.engine.mass_cancel(ids=[4, 99, 1, 4]), [4, 1])
+        self.assertEqual(self.get_book(), {-1: self.orders[2:3], 1: self.orders[1:2]})
+        self.assertEqual(sorted(self.engine.ordermap), [2, 3])
+
+    def test_username(self):
+        self.assertEqual(self.engine.mass_cancel(username="other"), [2])
+        self.assertEqual(self.get_book(), {-1: self.orders[2:3], 1: [self.orders[0], self.orders[3]]})
+
+    def test_whole_book(self):
+        self.assertEqual(sorted(self.engine.mass_cancel()), [1, 2, 3, 4])
+        self.assertEqual(self.get_book(), {-1: [], 1: []})
+        self.assertEqual(self.engine.ordermap, {})
+        self.assertEqual(self.webserver.log, [
+            ('book', ('FOO', {'asks': [], 'bids': [], 'contract': 'FOO', 'sequence': 2}), {})])
+
+        # the book still works afterwards
+        self.engine.place_order(self.create_order(1, 10, 1))
+        self.assertEqual(len(self.engine.orderbook[1]), 1)
+
+    def test_one_notification(self):
+        self.engine.mass_cancel(ids=[1, 2, 3])
+        self.assertEqual([call[0] for call in self.fake_listener.log], ['on_cancel_many', 'on_flush'])
+        self.assertEqual([call[0] for call in self.webserver.log], ['book'])
+
+    def test_nothing_to_cancel(self):
+        self.assertEqual(self.engine.mass_cancel(username="nobody"), [])
+        self.assertEqual(self.fake_listener.log, [])
+
+
+class TestJournalListener(TestEngine):
+    def setUp(self):
+        TestEngine.setUp(self)
+        from sputnik import engine2, journal
+
+        from tempfile import mkstemp
+        fd, self.path = mkstemp(prefix='journal')
+        os.close(fd)
+        self.journal = journal.Journal(self.path)
+        self.journal.open()
+        self.journal_listener = engine2.JournalListener(self.engine, self.journal)
+        self.engine.add_listener(self.journal_listener)
+
+    def tearDown(self):
+        self.journal.close()
+        for path in self.path, self.journal.snapshot_path:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def restore(self):
+        from sputnik import engine2, journal
+
+        engine = engine2.Engine()
+        engine.replay(journal.Journal(self.path).restore(), "FOO")
+        return engine
+
+    def assertRestored(self):
+        engine = self.restore()
+        self.assertEqual({side: [order.__repr__() for order in orders]
+                          for side, orders in engine.orderbook.iteritems()},
+                         {side: [order.__repr__() for order in orders]
+                          for side, orders in self.engine.orderbook.iteritems()})
+        self.assertEqual(sorted(engine.ordermap), sorted(self.engine.ordermap))
+
+    def test_replay(self):
+        for price, side in (10, 1), (11, 1), (11, 1), (5, -1), (6, -1):
+            self.engine.place_order(self.create_order(2, price, side))
+        # partial fill of a resting order, a sweep and a remainder
+        self.engine.place_order(self.create_order(3, 10, -1))
+        self.engine.place_order(self.create_order(4, 11, -1))
+        self.engine.cancel_order(4)
+        self.engine.mass_cancel(ids=[5])
+        self.assertRestored()
+
+    def test_snapshot(self):
+        self.journal_listener.snapshot_records = 4
+        for price, side in (10, 1), (11, 1), (11, 1), (5, -1), (6, -1):
+            self.engine.place_order(self.create_order(2, price, side))
+        self.assertEqual(self.journal.generation, 1)
+        self.assertEqual(self.journal.records, 1)
+
+        self.engine.place_order(self.create_order(3, 10, -1))
+        self.engine.cancel_order(2)
+        self.assertRestored()
+
+    def test_replay_empty(self):
+        self.assertEqual(len(self.restore().ordermap), 0)
+
+    def test_reconcile(self):
+        from sputnik import engine2
+
+        for price in 10, 11, 12, 13:
+            self.engine.place_order(self.create_order(5, price, 1))
+        engine = self.restore()
+
+        # The database as the accountant left it: 1 was cancelled, 2 was
+        # filled further than the journal knows, 3 has fills on the way
+        # and 5 never reached the engine
+        open_orders = [self.create_order(5, price, 1) for price in 11, 12, 13, 14]
+        for order, id in zip(open_orders, [2, 3, 4, 5]):
+            order.id = id
+        open_orders[0].quantity_left = 2
+        open_orders[1].quantity_left = 5
+        open_orders[2].quantity_left = 7
+
+        missing = engine2.reconcile_book(engine, self.journal, open_orders)
+        self.assertEqual([order.id for order in missing], [5])
+        self.assertEqual({id: order.quantity_left for id, order in engine.ordermap.iteritems()},
+                         {2: 2, 3: 5, 4: 5})
+        # and the cut down order is journalled
+        self.assertEqual(self.restore().ordermap[2].quantity_left, 2)
+
+    def test_sync_interval(self):
+        from twisted.internet import task
+
+        clock = task.Clock()
+        self.journal_listener.sync_interval = 0.05
+        self.journal_listener.callLater = clock.callLater
+        syncs = []
+        self.journal.sync = lambda: syncs.append(True)
+
+        self.engine.place_order(self.create_order(1, 10, 1))
+        self.engine.place_order(self.create_order(1, 11, 1))
+        # written out straight away, synced later
+        self.assertEqual(len(self.restore().ordermap), 2)
+        self.assertEqual(syncs, [])
+        clock.advance(0.05)
+        self.assertEqual(syncs, [True])
+
+
+class TestWebserverNotifierRestore(TestNotifier):
+    def test_on_init(self):
+        from sputnik import engine2
+
+        self.engine.place_order(self.create_order(1, 10, 1))
+        self.engine.place_order(self.create_order(2, 10, 1))
+        self.engine.place_order(self.create_order(1, 9, -1))
+
+        webserver = FakeComponent()
+        webserver_notifier = engine2.WebserverNotifier(self.engine, webserver, self.contract, reg_publish=False)
+        self.engine.add_listener(webserver_notifier)
+        webserver_notifier.on_init()
+        self.assertEqual(webserver.log, [
+            ('book', ('FOO', {'asks': [{'price': 10, 'quantity': 3}], 'bids': [{'price': 9, 'quantity': 1}],
+                              'contract': 'FOO', 'sequence': 0}), {})])
+
+
 class TestSafePriceNotifier(TestNotifier):
-    pass
+    def setUp(self):
+        TestNotifier.setUp(self)
+
+        from tempfile import mkstemp
+        fd, self.path = mkstemp(prefix='safe_price')
+        os.close(fd)
+        os.remove(self.path)
+
+        self.create_account("customer")
+        self.user = self.get_user("customer")
+        self.contract = self.get_contract("NETS2015")
+        self.notifiers = []
+
+    def tearDown(self):
+        from twisted.internet import reactor
+
+        # regular publishing
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def add_trade(self, price, quantity, minutes):
+        from sputnik import models
+        from datetime import datetime, timedelta
+
+        timestamp = datetime(2015, 1, 1) + timedelta(minutes=minutes)
+        aggressive = models.Order(self.user, self.contract, quantity, price, "BUY", timestamp=timestamp)
+        passive = models.Order(self.user, self.contract, quantity, price, "SELL", timestamp=timestamp)
+        self.session.add_all([aggressive, passive])
+        self.session.flush()
+        trade = models.Trade(aggressive, passive, price, quantity)
+        self.session.add(trade)
+        self.session.commit()
+        return trade
+
+    def start_notifier(self, checkpoint_path=None, clock=None, **kwargs):
+        from sputnik import engine2
 
+        notifier = engine2.SafePriceNotifier(self.session, self.engine, FakeComponent("accountant"),
+                                             FakeComponent("webserver"), FakeComponent("forwarder"),
+                                             self.contract, checkpoint_path=checkpoint_path, **kwargs)
+        if clock is not None:
+            notifier.callLater = clock.callLater
+            notifier.seconds = clock.seconds
+        notifier.on_init()
+        return notifier
+
+    def ema(self, notifier):
+        return notifier.ema_volume, notifier.ema_price_volume, notifier.ema_timestamp, notifier.safe_price
+
+    def test_default(self):
+        self.assertEqual(self.start_notifier(self.path).safe_price, 42)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_checkpoint(self):
+        old_trades = [self.add_trade(100, 5, 0), self.add_trade(120, 3, 1)]
+        self.start_notifier(self.path)
+        self.assertTrue(os.path.exists(self.path))
+
+        self.add_trade(90, 4, 2)
+        expected = self.ema(self.start_notifier())
+
+        # Only the trades after the checkpoint are read back
+        for trade in old_trades:
+            self.session.delete(trade)
+        self.session.commit()
+        restored = self.ema(self.start_notifier(self.path))
+        self.assertEqual(restored[2:], expected[2:])
+        self.assertAlmostEqual(restored[0], expected[0])
+        self.assertAlmostEqual(restored[1], expected[1])
+
+    def test_checkpoint_live_trades(self):
+        from sputnik import engine2, util
+        from datetime import datetime
+
+        notifier = self.start_notifier(self.path)
+        timestamp = util.dt_to_timestamp(datetime(2015, 1, 1))
+        notifier.on_trade_success(engine2.Order(id=1, price=100, quantity=5, side=-1, timestamp=timestamp),
+                                  engine2.Order(id=2, price=100, quantity=5, side=1, timestamp=timestamp - 1),
+                                  100, 5)
+
+        self.assertEqual(self.ema(self.start_notifier(self.path)), self.ema(notifier))
+
+    def test_unreadable_checkpoint(self):
+        with open(self.path, "w") as checkpoint_file:
+            checkpoint_file.write("{")
+        self.add_trade(100, 5, 0)
+
+        self.assertEqual(self.start_notifier(self.path).safe_price, 100)
+
+    def test_publish_throttled(self):
+        from datetime import datetime, timedelta
+
+        hours = lambda n: datetime(2015, 1, 1) + timedelta(hours=n)
+        clock = task.Clock()
+        notifier = self.start_notifier(clock=clock, publish_interval=1, publish_threshold=0.01)
+        published = lambda: [call[1] for call in notifier.webserver.log]
+        self.assertEqual(published(), [("NETS2015", 42)])
+
+        # Too soon after the last one, wait for the interval
+        notifier.update_safe_price(100, 5, timestamp=hours(0))
+        notifier.update_safe_price(110, 5, timestamp=hours(1))
+        self.assertEqual(len(published()), 1)
+        clock.advance(1)
+        self.assertEqual(published(), [("NETS2015", 42), ("NETS2015", notifier.safe_price)])
+        self.assertEqual(len(notifier.forwarder.log), 2)
+        self.assertEqual(len(notifier.accountant.log), 2)
+
+        # Too small a change
+        clock.advance(10)
+        notifier.update_safe_price(notifier.safe_price, 5, timestamp=hours(2))
+        self.assertEqual(len(published()), 2)
+
+        # Big enough, and long enough since the last one
+        notifier.update_safe_price(200, 5, timestamp=hours(3))
+        self.assertEqual(published()[-1], ("NETS2015", notifier.safe_price))
+        self.assertEqual(len(published()), 3)
+
+    def test_publish_every_change(self):
+        from datetime import datetime, timedelta
+
+        hours = lambda n: datetime(2015, 1, 1) + timedelta(hours=n)
+        notifier = self.start_notifier()
+        notifier.update_safe_price(100, 5, timestamp=hours(0))
+        notifier.update_safe_price(100, 5, timestamp=hours(1))
+        notifier.update_safe_price(110, 5, timestamp=hours(2))
+        self.assertEqual([call[1] for call in notifier.webserver.log],
+                         [("NETS2015", 42), ("NETS2015", 100), ("NETS2015", notifier.safe_price)])
@@ -0,0 +1,80 @@
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import sys
+import os
+from test_sputnik import TestSputnik, FakeComponent
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../server"))
+
+
+class TestEngineHost(TestSputnik):
+    def setUp(self):
+        TestSputnik.setUp(self)
+
+        from sputnik import engine2, engine_host, models
+
+        self.engines = {}
+        accountant_exports = {}
+        administrator_exports = {}
+        for ticker in "FOO", "BAR":
+            engine = engine2.Engine()
+            webserver_notifier = engine2.WebserverNotifier(engine, FakeComponent("webserver"),
+                                                           models.Contract(ticker), reg_publish=False)
+            engine.add_listener(webserver_notifier)
+            self.engines[ticker] = engine
+            accountant_exports[ticker] = engine2.AccountantExport(engine, None, webserver_notifier)
+            administrator_exports[ticker] = engine2.AdministratorExport(engine)
+
+        self.accountant_export = engine_host.AccountantHostExport(accountant_exports)
+        self.administrator_export = engine_host.AdministratorHostExport(administrator_exports)
+
+    def order(self, id, price, side):
+        return {"id": id, "contract": 1, "username": "customer", "quantity": 1,
+                "price": price, "side": side, "timestamp": 1}
+
+    def test_routes_by_ticker(self):
+        self.accountant_export.place_order("FOO", self.order(1, 100, -1))
+        self.accountant_export.place_orders("BAR", [self.order(2, 105, 1), self.order(3, 106, 1)])
+
+        self.assertEqual(self.engines["FOO"].ordermap.keys(), [1])
+        self.assertEqual(sorted(self.engines["BAR"].ordermap.keys()), [2, 3])
+        self.assertEqual(self.accountant_export.get_order_book("BAR", depth=1)["asks"],
+                         [{"price": 105, "quantity": 1}])
+        self.assertEqual(self.administrator_export.get_order_book("FOO")["BUY"].keys(), [1])
+
+        self.accountant_export.cancel_order("FOO", 1)
+        self.accountant_export.mass_cancel("BAR", ids=[2])
+        self.assertEqual(self.engines["FOO"].ordermap, {})
+        self.assertEqual(self.engines["BAR"].ordermap.keys(), [3])
+
+    def test_unknown_ticker(self):
+        from sputnik.exception import RemoteCallException
+
+        self.assertRaises(RemoteCallException, self.accountant_export.cancel_order, "BAZ", 1)
+        self.assertRaises(RemoteCallException, self.administrator_export.get_order_book, "BAZ")
+
+
+class TestEngineProxy(TestSputnik):
+    def test_adds_ticker(self):
+        from sputnik import engine_host
+
+        host = FakeComponent("engine_host")
+        proxy = engine_host.EngineProxy(host, "FOO")
+        proxy.place_order({"id": 1})
+        proxy.get_order_book(depth=1)
+
+        self.assertEqual(host.log, [("place_order", ("FOO", {"id": 1}), {}),
+                                    ("get_order_book", ("FOO",), {"depth": 1})])
+
+    def test_worker_for_contract(self):
+        from sputnik import engine_host
+
+        self.assertEqual([engine_host.worker_for_contract(id, 3) for id in range(1, 7)],
+                         [1, 2, 0, 1, 2, 0])
@@ -0,0 +1,156 @@
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+from twisted.trial import unittest
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../server"))
+
+
+class FakeOrder:
+    def __init__(self, id, side, price, quantity, quantity_left, timestamp, username):
+        self.id = id
+        self.side = side
+        self.price = price
+        self.quantity = quantity
+        self.quantity_left = quantity_left
+        self.timestamp = timestamp
+        self.username = username
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        from sputnik import journal
+
+        from tempfile import mkstemp
+        fd, self.path = mkstemp(prefix='journal')
+        os.close(fd)
+        self.journal = journal.Journal(self.path)
+        self.journal.open()
+
+    def tearDown(self):
+        self.journal.close()
+        for path in self.path, self.journal.snapshot_path:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_round_trip(self):
+        from sputnik import journal
+
+        self.journal.queue(FakeOrder(1, -1, 100, 10, 7, 1234567890123456, u"caf\xe9"))
+        self.journal.fill(1, 3)
+        self.journal.cancel(1)
+        self.journal.write()
+
+        self.assertEqual(journal.Journal(self.path).restore(), [
+            (journal.QUEUE, {"id": 1, "side": -1, "price": 100, "quantity": 10, "quantity_left": 7,
+                             "timestamp": 1234567890123456, "username": u"caf\xe9"}),
+            (journal.FILL, 1, 3),
+            (journal.CANCEL, 1)])
+
+    def test_buffered_until_write(self):
+        from sputnik import journal
+
+        self.journal.cancel(1)
+        self.assertEqual(journal.Journal(self.path).restore(), [])
+        self.journal.write()
+        self.assertEqual(journal.Journal(self.path).restore(), [(journal.CANCEL, 1)])
+
+    def test_missing(self):
+        from sputnik import journal
+
+        self.assertEqual(journal.Journal(self.path + ".missing").restore(), [])
+
+    def test_torn_tail(self):
+        from sputnik import journal
+
+        self.journal.cancel(1)
+        self.journal.cancel(2)
+        self.journal.write()
+        self.journal.close()
+
+        # Lose the end of the last record, as if we crashed mid-write
+        size = os.path.getsize(self.path)
+        with open(self.path, "r+b") as journal_file:
+            journal_file.truncate(size - 3)
+
+        self.assertEqual(journal.Journal(self.path).restore(), [(journal.CANCEL, 1)])
+        # The torn record is gone, so new records follow the good ones
+        self.journal.open()
+        self.journal.cancel(3)
+        self.journal.write()
+        self.assertEqual(journal.Journal(self.path).restore(), [(journal.CANCEL, 1), (journal.CANCEL, 3)])
+
+    def test_corrupt_record(self):
+        from sputnik import journal
+
+        self.journal.cancel(1)
+        self.journal.cancel(2)
+        self.journal.write()
+
+        with open(self.path, "r+b") as journal_file:
+            journal_file.seek(-1, os.SEEK_END)
+            journal_file.write("\xff")
+
+        self.assertEqual(journal.Journal(self.path).restore(), [(journal.CANCEL, 1)])
+
+    def test_compact(self):
+        from sputnik import journal
+
+        self.journal.queue(FakeOrder(1, -1, 100, 10, 10, 1, "a"))
+        self.journal.queue(FakeOrder(2, 1, 105, 10, 10, 2, "b"))
+        self.journal.cancel(1)
+        self.journal.write()
+        self.assertEqual(self.journal.records, 3)
+
+        self.journal.compact([FakeOrder(2, 1, 105, 10, 10, 2, "b")])
+        self.assertEqual(self.journal.records, 0)
+        self.assertEqual(self.journal.generation, 1)
+
+        # New records go after the snapshot
+        self.journal.fill(2, 4)
+        self.journal.write()
+
+        restored = journal.Journal(self.path)
+        self.assertEqual(restored.restore(), [
+            (journal.QUEUE, {"id": 2, "side": 1, "price": 105, "quantity": 10, "quantity_left": 10,
+                             "timestamp": 2, "username": "b"}),
+            (journal.FILL, 2, 4)])
+        self.assertEqual(restored.generation, 1)
+        self.assertEqual(restored.records, 1)
+
+    def test_crash_while_compacting(self):
+        from sputnik import journal
+
+        self.journal.queue(FakeOrder(1, -1, 100, 10, 10, 1, "a"))
+        self.journal.write()
+
+        # The snapshot made it to disk but the journal was not restarted
+        snapshot = journal.SNAPSHOT_HEADER.pack(journal.SNAPSHOT_MAGIC, journal.VERSION, 1, 1) + \
+                   journal.frame(journal.encode_queue(FakeOrder(1, -1, 100, 10, 10, 1, "a")))
+        with open(self.journal.snapshot_path, "wb") as snapshot_file:
+            snapshot_file.write(snapshot)
+
+        restored = journal.Journal(self.path)
+        self.assertEqual(len(restored.restore()), 1)
+        self.assertEqual(restored.generation, 1)
+        # and the old journal is not replayed next time either
+        self.assertEqual(len(journal.Journal(self.path).restore()), 1)
+
+        os.remove(self.journal.snapshot_path)
+
+    def test_unknown_version(self):
+        from sputnik import journal
+
+        self.journal.close()
+        with open(self.path, "wb") as journal_file:
+            journal_file.write(journal.JOURNAL_HEADER.pack(journal.JOURNAL_MAGIC, journal.VERSION + 1, 0))
+
+        self.assertRaises(Exception, journal.Journal(self.path).restore)
@@ -27,6 +27,14 @@ from sputnik import models
 from sputnik import util
 from sputnik.exception import LedgerException
 
+def make_group(uid, quantity=5, username="customer"):
+    return [{"uid":uid, "count":2, "type":"Trade", "username":username,
+             "contract":"MXN", "quantity":quantity, "direction":"debit", "note": "debit",
+             "timestamp": util.dt_to_timestamp(datetime.datetime.utcnow())},
+            {"uid":uid, "count":2, "type":"Trade", "username":"customer",
+             "contract":"MXN", "quantity":quantity, "direction":"credit", "note": "credit",
+             "timestamp": util.dt_to_timestamp(datetime.datetime.utcnow())}]
+
 class TestLedger(TestSputnik):
     def setUp(self):
         TestSputnik.setUp(self)
@@ -148,3 +156,162 @@ class TestLedger(TestSputnik):
         return self.assertEqual(self.successResultOf(d1),
                 ledger.GROUP_TIMEOUT)
 
+
+    def test_group_commit(self):
+        self.ledger.commit_interval = 1
+        self.ledger.commit_size = 3
+        self.ledger.callLater = self.clock.callLater
+
+        d1 = self.export.post(*make_group("foo"))
+        d2 = self.export.post(*make_group("bar", quantity=7))
+        self.assertNoResult(d1)
+        self.assertEqual(self.session.query(models.Journal).count(), 0)
+
+        self.clock.advance(1)
+        self.assertTrue(self.successResultOf(d1))
+        self.assertTrue(self.successResultOf(d2))
+        self.assertEqual(self.session.query(models.Journal).count(), 2)
+        postings = self.session.query(models.Posting).all()
+        self.assertEqual(sorted(abs(posting.quantity) for posting in postings), [5, 5, 7, 7])
+        for journal in self.session.query(models.Journal):
+            self.assertEqual(sum(posting.quantity for posting in journal.postings), 0)
+
+        # a full batch goes out without waiting
+        ds = [self.export.post(*make_group(uid)) for uid in ("a", "b", "c")]
+        for d in ds:
+            self.assertTrue(self.successResultOf(d))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_group_commit_failures_are_separate(self):
+        self.ledger.commit_interval = 1
+        self.ledger.commit_size = 10
+        self.ledger.callLater = self.clock.callLater
+
+        good = self.export.post(*make_group("foo"))
+        debit, credit = make_group("bar", username="nobody")
+        bad = self.export.post(debit)
+        self.export.post(credit).addErrback(lambda x: None)
+        self.clock.advance(1)
+        self.flushLoggedErrors()
+
+        self.assertTrue(self.successResultOf(good))
+        self.assertEqual(self.failureResultOf(bad, LedgerException).value, ledger.ARGUMENT_ERROR)
+        self.assertEqual(self.session.query(models.Journal).count(), 1)
+
+    def test_lookup_cache(self):
+        self.successResultOf(self.export.post(*make_group("foo")))
+        self.assertEqual(self.ledger.user_types.get("customer"), "Liability")
+        self.assertIn("MXN", self.ledger.contract_ids)
+
+        # a changed user is only seen once the ledger is told about it
+        user = self.session.query(models.User).filter_by(username="customer").one()
+        user.type = "Asset"
+        self.session.commit()
+        self.successResultOf(self.export.post(*make_group("bar")))
+        self.assertEqual(self.ledger.user_types.get("customer"), "Liability")
+
+        ledger.AdministratorExport(self.ledger).reload_user("customer")
+        self.successResultOf(self.export.post(*make_group("baz")))
+        self.assertEqual(self.ledger.user_types.get("customer"), "Asset")
+
+
+class TestLRUCache(TestSputnik):
+    def test_eviction(self):
+        cache = util.LRUCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        self.assertEqual(cache.get("a"), 1)
+        cache["c"] = 3
+        # b was used least recently
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+
+        cache.invalidate("a")
+        self.assertEqual(cache.get("a"), None)
+
+
+class TestLedgerRetries(TestSputnik):
+    def setUp(self):
+        TestSputnik.setUp(self)
+        self.ledger = ledger.Ledger(self.session.bind.engine, retries=4, backoff=1, max_backoff=3)
+        self.clock = task.Clock()
+        self.delays = []
+
+        def callLater(delay, function, *args, **kwargs):
+            self.delays.append(delay)
+            return self.clock.callLater(delay, function, *args, **kwargs)
+        self.ledger.callLater = callLater
+
+    def test_backoff(self):
+        from sqlalchemy.exc import OperationalError
+
+        attempts = []
+        def flaky(conn):
+            attempts.append(conn)
+            if len(attempts) < 3:
+                raise OperationalError("SELECT 1", {}, Exception("server closed the connection"))
+            return "done"
+
+        d = self.ledger.run_in_transaction(flaky)
+        # waiting for a retry does not block
+        self.assertNoResult(d)
+        self.assertEqual(len(attempts), 1)
+        self.clock.advance(3)
+        self.clock.advance(3)
+        self.assertEqual(self.successResultOf(d), "done")
+        self.flushLoggedErrors()
+        self.assertEqual(len(self.delays), 2)
+        self.assertTrue(0 <= self.delays[0] <= 1)
+        self.assertTrue(0 <= self.delays[1] <= 2)
+
+    def test_give_up(self):
+        from sqlalchemy.exc import OperationalError
+
+        def broken(conn):
+            raise OperationalError("SELECT 1", {}, Exception("server closed the connection"))
+
+        d = self.ledger.run_in_transaction(broken)
+        self.clock.pump([3] * 4)
+        self.assertEqual(self.failureResultOf(d, LedgerException).value, ledger.DATABASE_ERROR)
+        self.flushLoggedErrors()
+        self.assertEqual(len(self.delays), 3)
+        # capped at max_backoff
+        self.assertTrue(all(0 <= delay <= 3 for delay in self.delays))
+
+    def test_no_retry(self):
+        from sqlalchemy.exc import IntegrityError
+
+        def conflict(conn):
+            raise IntegrityError("INSERT", {}, Exception("duplicate key"))
+
+        self.failureResultOf(self.ledger.run_in_transaction(conflict), IntegrityError)
+        self.assertEqual(self.delays, [])
+
+    def test_one_commit_at_a_time(self):
+        from sqlalchemy.exc import OperationalError
+
+        export = ledger.AccountantExport(self.ledger)
+        insert_journals = self.ledger.insert_journals
+        inserts = []
+        def flaky(conn, journals):
+            inserts.append(len(journals))
+            if len(inserts) == 1:
+                raise OperationalError("INSERT", {}, Exception("server closed the connection"))
+            return insert_journals(conn, journals)
+        self.ledger.insert_journals = flaky
+
+        first = export.post(*make_group("foo"))
+        # the second group waits for the first to be retried
+        second = export.post(*make_group("bar"))
+        self.assertNoResult(first)
+        self.assertNoResult(second)
+        self.assertEqual(inserts, [1])
+
+        self.clock.advance(3)
+        self.flushLoggedErrors()
+        self.assertTrue(self.successResultOf(first))
+        self.assertTrue(self.successResultOf(second))
+        self.assertEqual(inserts, [1, 1, 1])
+        self.assertEqual(self.session.query(models.Journal).count(), 2)
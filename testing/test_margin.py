@@ -293,3 +293,65 @@ class TestMargin(TestSputnik):
         low, high, _ = margin.calculate_margin(self.user, self.session, {}, id)
         assert high > self.get_position("BTC").position
 
+
+    def test_insufficient_cash_with_orders(self):
+        self.create_position("BTC", 100000000)
+        ids = [self.create_order("BTC/MXN", 60000000, 5500, "SELL", False),
+               self.create_order("BTC/MXN", 50000000, 5500, "SELL", False)]
+
+        low, high, _ = margin.calculate_margin(self.user, self.session, {}, order_ids=ids[:1])
+        assert high < self.get_position("BTC").position
+
+        low, high, _ = margin.calculate_margin(self.user, self.session, {}, order_ids=ids)
+        assert high > self.get_position("BTC").position
+
+class TestMarginState(TestSputnik):
+    def setUp(self):
+        TestSputnik.setUp(self)
+        self.create_account("test")
+        self.user = self.get_user("test")
+
+    def assertMarginMatches(self, state, safe_prices):
+        self.assertEqual(state.margin(safe_prices), margin.calculate_margin(self.user, self.session, safe_prices))
+
+    def test_incremental(self):
+        self.create_position('MXN', 100000)
+        self.create_position('USDBTC0W', 1, reference_price=1000)
+        state = margin.MarginState.from_session(self.user, self.session)
+        safe_prices = {'USDBTC0W': 1000}
+        self.assertMarginMatches(state, safe_prices)
+
+        # Accept some orders
+        ids = [self.create_order('USDBTC0W', 2, 1500, 'SELL'),
+               self.create_order('BTC/MXN', 50000000, 5000, 'BUY'),
+               self.create_order('BTC/MXN', 20000000, 5000, 'SELL'),
+               self.create_order('NETS2015', 2, 500, 'BUY')]
+        for id in ids:
+            state.add_order(self.session.query(models.Order).get(id))
+        self.assertMarginMatches(state, safe_prices)
+
+        # The safe price moves
+        safe_prices = {'USDBTC0W': 1200}
+        self.assertMarginMatches(state, safe_prices)
+
+        # Fill some orders
+        for id, quantity in (ids[0], 1), (ids[2], 10000000), (ids[3], 2):
+            order = self.session.query(models.Order).get(id)
+            order.quantity_left -= quantity
+            self.session.commit()
+            state.fill_order(id, quantity)
+        self.create_position('USDBTC0W', 0)
+        state.adjust_position(self.get_contract('USDBTC0W'), -1)
+        self.create_position('NETS2015', 2)
+        state.adjust_position(self.get_contract('NETS2015'), 2)
+        self.assertMarginMatches(state, safe_prices)
+
+        # Cancel one
+        self.cancel_order(ids[1])
+        state.remove_order(ids[1])
+        self.assertMarginMatches(state, safe_prices)
+
+        # Consider a new order
+        id = self.create_order('USDBTC0W', 3, 1000, 'BUY', False)
+        self.assertEqual(state.margin(safe_prices, orders=[self.session.query(models.Order).get(id)]),
+                         margin.calculate_margin(self.user, self.session, safe_prices, id))
@@ -0,0 +1,143 @@
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import sys
+import os
+from test_sputnik import TestSputnik
+from twisted.trial import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../server"))
+
+
+class TestRiskSweep(TestSputnik):
+    def setUp(self):
+        TestSputnik.setUp(self)
+
+        from sputnik import risk
+        if risk.numpy is None:
+            raise unittest.SkipTest("numpy is not installed")
+
+        self.sweep = risk.RiskSweep(self.session)
+        for username in "one", "two", "three":
+            self.create_account(username)
+
+    def use(self, username):
+        self.user = self.get_user(username)
+
+    def assertMarginsMatch(self, safe_prices):
+        from sputnik import margin
+
+        self.sweep.load()
+        low_margin, high_margin, failed = self.sweep.margins(safe_prices)
+        for index, username in enumerate(self.sweep.usernames):
+            expected = margin.calculate_margin(self.get_user(username), self.session, safe_prices)
+            self.assertEqual((low_margin[index], high_margin[index]), expected[:2])
+        self.assertFalse(failed.any())
+
+    def test_margins(self):
+        self.use("one")
+        self.create_position('MXN', 100000)
+        self.create_position('USDBTC0W', -2, reference_price=1000)
+        self.create_order('USDBTC0W', 1, 1500, 'SELL')
+        self.create_order('BTC/MXN', 50000000, 5000, 'BUY')
+        self.create_order('BTC/MXN', 20000000, 5000, 'SELL')
+
+        self.use("two")
+        self.create_position('NETS2015', -4)
+        self.create_order('NETS2015', 2, 500, 'BUY')
+        self.create_order('NETS2015', 1, 700, 'SELL')
+        # Not accepted, so not counted
+        self.create_order('NETS2015', 5, 700, 'SELL', False)
+        # Too big for the cash we have
+        self.create_order('BTC/MXN', 50000000, 30000, 'BUY')
+
+        self.assertMarginsMatch({'USDBTC0W': 1000})
+        self.assertMarginsMatch({'USDBTC0W': 1700})
+        # No safe price
+        self.assertMarginsMatch({})
+
+    def deposit(self, username, quantity):
+        from sputnik import models
+
+        btc = self.get_contract('BTC')
+        self.session.add(models.Journal('Deposit', [models.Posting(self.get_user(username), btc, quantity, 'credit'),
+                                                    models.Posting(self.get_user("onlinecash"), btc, quantity,
+                                                                   'debit')]))
+        self.session.commit()
+
+    def test_sweep(self):
+        for username in "one", "two":
+            self.use(username)
+            self.create_position('BTC', 0)
+            self.create_position('NETS2015', -4)
+        self.deposit("one", 1000000)
+        self.deposit("two", 5000000)
+
+        self.assertEqual(self.sweep.sweep({})[1], [("one", 1000000, 4000000, 4000000)])
+
+        # Only the new postings are counted after the first sweep
+        self.deposit("one", 3000000)
+        self.assertEqual(self.sweep.sweep({})[1], [])
+        self.assertEqual(self.sweep.cash_positions["one"], 4000000)
+        self.assertEqual(self.sweep.cash_positions["two"], 5000000)
+
+        self.deposit("two", -2000000)
+        self.assertEqual(self.sweep.sweep({})[1], [("two", 3000000, 4000000, 4000000)])
+
+    def test_recheck(self):
+        for username, quantity in ("one", 1), ("two", -2), ("three", 1):
+            self.use(username)
+            self.create_position('BTC', 0)
+            self.create_position('USDBTC0W', quantity, reference_price=1000)
+        self.deposit("one", 50000)
+        self.deposit("two", 200000)
+        self.deposit("three", 30000)
+
+        checked, crossing = self.sweep.sweep({'USDBTC0W': 1000})
+        self.assertTrue({"one", "two", "three"} <= set(checked))
+        self.assertEqual(crossing, [("three", 30000, 25000, 50000)])
+
+        # Nothing moved
+        self.assertEqual(self.sweep.recheck({'USDBTC0W': 1000}), ([], []))
+
+        # Only the users holding the contract are checked, the worst off first
+        checked, crossing = self.sweep.recheck({'USDBTC0W': 800})
+        self.assertEqual(sorted(checked), ["one", "three", "two"])
+        self.assertEqual(crossing, [("three", 30000, 40000, 60000), ("one", 50000, 40000, 60000)])
+
+        checked, crossing = self.sweep.recheck({'USDBTC0W': 1500})
+        self.assertEqual(crossing, [("two", 200000, 175000, 250000)])
+
+    def test_recheck_reloads(self):
+        from sputnik import risk
+
+        for username, quantity in ("one", 1), ("three", 1):
+            self.use(username)
+            self.create_position('BTC', 0)
+            self.create_position('USDBTC0W', quantity, reference_price=1000)
+        self.use("two")
+        self.create_position('BTC', 0)
+        self.deposit("one", 50000)
+        self.deposit("two", 50000)
+        self.deposit("three", 30000)
+        self.sweep.sweep({'USDBTC0W': 1000})
+
+        # What they hold now, not what they held at the last sweep
+        self.use("one")
+        self.create_position('USDBTC0W', 3)
+        self.use("two")
+        self.create_position('USDBTC0W', 1, reference_price=1000)
+        self.use("three")
+        self.create_position('USDBTC0W', 0)
+
+        checked, crossing = self.sweep.recheck({'USDBTC0W': 800})
+        self.assertEqual(sorted(checked), ["one", "three", "two"])
+        self.assertEqual(crossing, risk.RiskSweep(self.session).sweep({'USDBTC0W': 800})[1])
+        self.assertEqual([username for username, cash_position, low_margin, high_margin in crossing],
+                         ["one", "two"])
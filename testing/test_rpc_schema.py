@@ -0,0 +1,93 @@
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import sys
+import os
+from test_sputnik import TestSputnik
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../server"))
+
+
+class TestBinding(TestSputnik):
+    def check(self, f, *args, **kwargs):
+        import inspect
+        from sputnik import rpc_schema
+
+        expected = inspect.getcallargs(f, *args, **kwargs)
+        expected.pop("self", None)
+        expected = {key: list(value) if type(value) == tuple else value for key, value in expected.iteritems()}
+        self.assertEqual(rpc_schema.build_binding(f)(args, kwargs), expected)
+
+    def test_same_as_getcallargs(self):
+        def f(self, a, b=2, c=None):
+            pass
+
+        self.check(f, None, 1)
+        self.check(f, None, 1, 3)
+        self.check(f, None, 1, c=(1, 2))
+        self.check(f, None, a=1, b=4)
+
+    def test_bad_arguments(self):
+        import jsonschema
+        from sputnik import rpc_schema
+
+        def f(a, b=2):
+            pass
+
+        bind = rpc_schema.build_binding(f)
+        for args, kwargs in [((), {}), ((1, 2, 3), {}), ((1,), {"a": 1}), ((1,), {"c": 1})]:
+            self.assertRaises(jsonschema.ValidationError, bind, args, kwargs)
+
+    def test_drop_args(self):
+        from sputnik import rpc_schema
+
+        def f(username, order):
+            pass
+
+        self.assertEqual(rpc_schema.build_binding(f, drop_args=["username"])(("foo",), {"order": 1}),
+                         {"order": 1})
+
+    def test_varargs(self):
+        from sputnik import rpc_schema
+
+        def f(a, *args, **kwargs):
+            pass
+
+        self.assertEqual(rpc_schema.build_binding(f)((1, 2), {"b": 3}), {"a": 1, "args": [2], "kwargs": {"b": 3}})
+
+
+class TestSchema(TestSputnik):
+    def test_validates(self):
+        import jsonschema
+        from sputnik import rpc_schema
+
+        @rpc_schema.schema("rpc/engine.json#cancel_order")
+        def cancel_order(id):
+            return id
+
+        self.assertEqual(cancel_order(5), 5)
+        self.assertRaises(jsonschema.ValidationError, cancel_order, "five")
+
+    def test_validator_cached(self):
+        from sputnik import rpc_schema
+
+        self.assertIs(rpc_schema.validator("rpc/engine.json#cancel_order"),
+                      rpc_schema.validator("rpc/engine.json#cancel_order"))
+
+    def test_validate_internal(self):
+        from sputnik import config, rpc_schema
+
+        config.set("specs", "validate_internal", "false")
+
+        def cancel_order(id):
+            return id
+
+        # Internal calls are trusted, public ones are still checked
+        self.assertIs(rpc_schema.schema("rpc/engine.json#cancel_order")(cancel_order), cancel_order)
+        self.assertIsNot(rpc_schema.schema("public/market.json#get_order_book")(cancel_order), cancel_order)
@@ -0,0 +1,74 @@
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+import sys
+import os
+from test_sputnik import TestSputnik
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../server"))
+
+
+class TestShardMap(TestSputnik):
+    def setUp(self):
+        TestSputnik.setUp(self)
+        self.usernames = ["user%d" % i for i in range(2000)]
+
+    def test_spread(self):
+        from sputnik import sharding
+
+        shards = sharding.ShardMap(4)
+        counts = [0] * 4
+        for username in self.usernames:
+            counts[shards.accountant_for(username)] += 1
+
+        for count in counts:
+            self.assertTrue(300 < count < 700)
+
+        # Usernames which start with the same letter are spread too
+        self.assertEqual(len(set(shards.accountant_for(username) for username in self.usernames[:100])), 4)
+
+    def test_adding_accountant(self):
+        from sputnik import sharding
+
+        before = sharding.ShardMap(4)
+        after = sharding.ShardMap(5)
+        moved = [username for username in self.usernames
+                 if before.accountant_for(username) != after.accountant_for(username)]
+
+        self.assertTrue(len(moved) < len(self.usernames) / 4)
+        self.assertEqual(set(after.accountant_for(username) for username in moved), set([4]))
+
+    def test_pins(self):
+        from sputnik import sharding
+
+        shards = sharding.ShardMap(4)
+        pins = sharding.pins_for(self.usernames, shards, 5)
+        self.assertEqual(shards.set_assignments(pins), [])
+
+        after = sharding.ShardMap(5, pins)
+        for username in self.usernames:
+            self.assertEqual(after.accountant_for(username), shards.accountant_for(username))
+
+        username = sorted(pins)[0]
+        del pins[username]
+        self.assertEqual(after.set_assignments(dict(pins)), [username])
+        self.assertEqual(after.accountant_for(username), 4)
+
+    def test_load(self):
+        from sputnik import sharding, models
+
+        self.create_account("test")
+        shards = sharding.ShardMap(2)
+        other = 1 - shards.accountant_for("test")
+        self.session.add(models.AccountantShard("test", other))
+        self.session.commit()
+
+        self.assertEqual(shards.load(self.session), ["test"])
+        self.assertEqual(shards.accountant_for("test"), other)
+        self.assertEqual(shards.load(self.session), [])
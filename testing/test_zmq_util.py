@@ -74,6 +74,187 @@ class TestAsyncRouterDealer(unittest.TestCase):
         d.addCallbacks(onSuccess, onFail)
         return d
 
+class TestAsyncRouterDealerMsgpack(TestAsyncRouterDealer):
+    def setUp(self):
+        from sputnik import zmq_util
+        if zmq_util.msgpack is None:
+            raise unittest.SkipTest("msgpack is not installed")
+
+        import random
+        port = random.randint(50000, 60000)
+        self.dealer_proxy = zmq_util.dealer_proxy_async("tcp://127.0.0.1:%d" % port, timeout=None,
+                                                        codec="msgpack")
+        self.router_share = zmq_util.router_share_async(TestExport(), "tcp://127.0.0.1:%d" % port)
+
+    def test_fall_back_to_json(self):
+        from sputnik import zmq_util
+
+        # The export cannot decode msgpack
+        self.patch(zmq_util, "codecs", {"json": zmq_util.json_codec})
+        d = self.dealer_proxy.test_function(True)
+
+        def onSuccess(result):
+            self.flushLoggedErrors()
+            self.assertTrue(result)
+            self.assertIs(self.dealer_proxy._codec, zmq_util.json_codec)
+
+        return d.addCallback(onSuccess)
+
+class TestAsyncRouterDealerMultiplexed(TestAsyncRouterDealer):
+    codec = "json"
+
+    def setUp(self):
+        from sputnik import zmq_util
+        import random
+        port = random.randint(50000, 60000)
+        self.dealer_proxy = zmq_util.dealer_proxy_async("tcp://127.0.0.1:%d" % port, timeout=None,
+                                                        codec=self.codec, multiplexed=True)
+        self.router_share = zmq_util.router_share_async(TestExport(), "tcp://127.0.0.1:%d" % port)
+
+    def test_batched(self):
+        from twisted.internet import defer
+
+        sent = []
+        send = self.dealer_proxy._connection.send
+        def record(message):
+            sent.append(message)
+            send(message)
+        self.dealer_proxy._connection.send = record
+
+        d = defer.gatherResults([self.dealer_proxy.test_function(True) for i in range(5)])
+
+        def onSuccess(results):
+            self.assertEqual(results, [True] * 5)
+            self.assertEqual(len(sent), 1)
+
+        return d.addCallback(onSuccess)
+
+    def test_timeout(self):
+        from sputnik import zmq_util
+        from sputnik.exception import RemoteCallTimedOut
+
+        clock = task.Clock()
+        proxy = zmq_util.DealerProxyMultiplexed(FakeDealerConnection(), timeout=1)
+        proxy.callLater = clock.callLater
+        proxy._wheel.callLater = clock.callLater
+        proxy._wheel.seconds = clock.seconds
+
+        d = proxy.test_function(True)
+        clock.advance(0.5)
+        self.assertEqual(len(proxy._connection.sent), 1)
+        self.assertNoResult(d)
+        clock.advance(0.6)
+        self.failureResultOf(d, RemoteCallTimedOut)
+        self.assertEqual(proxy._calls, {})
+
+    def test_batch_failed(self):
+        from sputnik import zmq_util
+        import json
+
+        clock = task.Clock()
+        proxy = zmq_util.DealerProxyMultiplexed(FakeDealerConnection(), timeout=None)
+        proxy.callLater = clock.callLater
+
+        sent = [proxy.test_function(True), proxy.test_function(True)]
+        clock.advance(0)
+        queued = proxy.test_function(True)
+
+        # the export could not run the batch, and does not say which it was
+        proxy.gotMessage(b'', json.dumps({"success": False,
+                                          "exception": {"class": "Exception", "module": "exceptions",
+                                                        "args": ["Ack"]}}))
+        self.flushLoggedErrors()
+        for d in sent:
+            self.assertEqual(self.failureResultOf(d, Exception).value.args, ("Ack",))
+        # calls which have not gone out yet are left alone
+        self.assertNoResult(queued)
+        self.assertEqual(proxy._calls.keys(), [3])
+
+class TestAsyncRouterDealerMultiplexedMsgpack(TestAsyncRouterDealerMultiplexed):
+    codec = "msgpack"
+
+    def setUp(self):
+        from sputnik import zmq_util
+        if zmq_util.msgpack is None:
+            raise unittest.SkipTest("msgpack is not installed")
+        TestAsyncRouterDealerMultiplexed.setUp(self)
+
+    def test_fall_back_to_json(self):
+        from sputnik import zmq_util
+
+        self.patch(zmq_util, "codecs", {"json": zmq_util.json_codec})
+        d = self.dealer_proxy.test_function(True)
+
+        def onSuccess(result):
+            self.flushLoggedErrors()
+            self.assertTrue(result)
+            self.assertIs(self.dealer_proxy._codec, zmq_util.json_codec)
+
+        return d.addCallback(onSuccess)
+
+class FakeDealerConnection:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+class TestTimerWheel(unittest.TestCase):
+    def test_expire(self):
+        from sputnik import zmq_util
+
+        clock = task.Clock()
+        expired = []
+        wheel = zmq_util.TimerWheel(expired.extend, resolution=0.1)
+        wheel.callLater = clock.callLater
+        wheel.seconds = clock.seconds
+
+        wheel.add("a", 1)
+        wheel.add("b", 1.05)
+        wheel.add("c", 2)
+        # one timer for all of them
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+
+        clock.advance(1)
+        self.assertEqual(expired, ["a"])
+        clock.advance(0.1)
+        self.assertEqual(expired, ["a", "b"])
+        clock.advance(1)
+        self.assertEqual(expired, ["a", "b", "c"])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+class TestCodec(unittest.TestCase):
+    def test_message_codec(self):
+        from sputnik import zmq_util
+        from sputnik.exception import RemoteCallUnsupportedCodec
+
+        self.assertIs(zmq_util.message_codec('{"success": true}'), zmq_util.json_codec)
+        self.patch(zmq_util, "codecs", {"json": zmq_util.json_codec})
+        self.assertRaises(RemoteCallUnsupportedCodec, zmq_util.message_codec, "\x82")
+
+    def test_encode(self):
+        from sputnik import zmq_util
+        import json
+
+        export = zmq_util.Export(TestExport())
+        self.assertEqual(json.loads(export.encode(True, [1, "a"])), {"success": True, "result": [1, "a"]})
+        # Things that don't serialize are sent as their repr
+        self.assertEqual(json.loads(export.encode(True, set([1]))), {"success": True, "result": "set([1])"})
+
+    def test_msgpack_round_trip(self):
+        from sputnik import zmq_util
+        if zmq_util.msgpack is None:
+            raise unittest.SkipTest("msgpack is not installed")
+
+        codec = zmq_util.get_codec("msgpack")
+        message = codec.dumps({"method": "place_order", "args": [{"username": "caf\xc3\xa9", "price": 100}],
+                               "kwargs": {}})
+        self.assertIs(zmq_util.message_codec(message), codec)
+        # Strings come back as unicode, the same as from json
+        self.assertEqual(codec.loads(message), {u"method": u"place_order",
+                                                u"args": [{u"username": u"caf\xe9", u"price": 100}],
+                                                u"kwargs": {}})
+
 class TestSyncRouterDealer(unittest.TestCase):
     pass
 
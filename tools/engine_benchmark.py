@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Mimetic Markets, Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+
+"""
+Micro-benchmarks for the matching engine.
+
+Drives engine2.Engine directly (no ZMQ, no accountant) with seeded,
+reproducible synthetic order flow and reports throughput, latency
+percentiles and peak memory. Results are appended to a file as one JSON
+object per line so that runs can be compared across commits.
+
+Flows:
+
+    random_walk   orders around a randomly walking mid price
+    market_maker  a resting ladder that is constantly cancelled and replaced,
+                  with small taker orders at the touch against it
+    sweep         a deep book that is repeatedly swept by one large order
+
+Example:
+
+    tools/engine_benchmark.py --flow market_maker --orders 100000 \\
+        --depth 2000 --cancel-ratio 0.9 --output bench.jsonl
+"""
+
+import os
+import sys
+import json
+import random
+import resource
+import subprocess
+import time
+from optparse import OptionParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "../server"))
+
+SPEC_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "../server/sputnik/specs"))
+
+BUY = -1
+SELL = 1
+
+
+class OrderFlow:
+    """
+    Base class for synthetic order flows.
+
+    A flow is an iterator of operations, either ("place", order_kwargs) or
+    ("cancel", order_id). Flows are generated lazily so they can look at the
+    engine to pick orders which are still resting on the book. Operations
+    from setup() are run before the clock starts and are not counted.
+    """
+
+    def __init__(self, engine, seed=0, orders=10000, depth=100, cancel_ratio=0.5,
+                 dispersion=10, mid=10000, max_quantity=10):
+        self.engine = engine
+        self.random = random.Random(seed)
+        self.orders = orders
+        self.depth = depth
+        self.cancel_ratio = cancel_ratio
+        self.dispersion = dispersion
+        self.mid = mid
+        self.max_quantity = max_quantity
+        self.next_id = 0
+        self.next_timestamp = 0
+
+    def order(self, side, price, quantity=None):
+        if quantity is None:
+            quantity = self.random.randint(1, self.max_quantity)
+        self.next_id += 1
+        self.next_timestamp += 1
+        return ("place", {"id": self.next_id, "contract": 1, "username": "bench",
+                          "quantity": quantity, "price": max(1, price), "side": side,
+                          "timestamp": self.next_timestamp})
+
+    def random_side(self):
+        return BUY if self.random.random() < 0.5 else SELL
+
+    def setup(self):
+        return iter([])
+
+    def __iter__(self):
+        raise NotImplementedError
+
+
+class RandomWalkFlow(OrderFlow):
+    def __iter__(self):
+        mid = self.mid
+        for i in range(self.orders):
+            mid = max(self.dispersion + 1, mid + self.random.choice((-1, 0, 1)))
+            side = self.random_side()
+            # Most orders rest a little away from the mid, some cross it
+            offset = int(abs(self.random.gauss(0, self.dispersion)))
+            yield self.order(side, mid + side * offset - side * self.random.randint(0, 1))
+
+
+class MarketMakerFlow(OrderFlow):
+    """
+    depth quotes a side rest on the book. Each step either cancels a quote
+    and replaces it, or sends a taker order at the touch which is no bigger
+    than the order there, so that it never rests. A quote which is filled is
+    replaced straight away, so the ladder stays depth quotes a side.
+    """
+
+    def __init__(self, engine, **kwargs):
+        OrderFlow.__init__(self, engine, **kwargs)
+        # (id, side) of our quotes, and where each id is in the list
+        self.resting = []
+        self.positions = {}
+
+    def quote(self, side):
+        op = self.order(side, self.mid + side * (1 + self.random.randint(0, self.dispersion)))
+        self.positions[op[1]["id"]] = len(self.resting)
+        self.resting.append((op[1]["id"], side))
+        return op
+
+    def unquote(self, order_id):
+        index = self.positions.pop(order_id)
+        last = self.resting.pop()
+        if last[0] != order_id:
+            self.resting[index] = last
+            self.positions[last[0]] = index
+
+    def setup(self):
+        for i in range(self.depth):
+            for side in BUY, SELL:
+                yield self.quote(side)
+
+    def __iter__(self):
+        if not self.depth:
+            return
+
+        count = 0
+        while count < self.orders:
+            if self.random.random() < self.cancel_ratio:
+                order_id, side = self.resting[self.random.randrange(len(self.resting))]
+                self.unquote(order_id)
+                yield ("cancel", order_id)
+                yield self.quote(side)
+                count += 2
+            else:
+                side = self.random_side()
+                touch = self.engine.orderbook[-side].best()
+                quantity = min(self.random.randint(1, self.max_quantity), touch.quantity_left)
+                yield self.order(side, touch.price, quantity=quantity)
+                count += 1
+                if touch.id not in self.engine.ordermap:
+                    self.unquote(touch.id)
+                    yield self.quote(touch.side)
+                    count += 1
+
+
+class SweepFlow(OrderFlow):
+    def __iter__(self):
+        count = 0
+        while count < self.orders:
+            side = self.random_side()
+            total = 0
+            for level in range(self.depth):
+                op = self.order(-side, self.mid - side * level)
+                total += op[1]["quantity"]
+                yield op
+            yield self.order(side, self.mid - side * self.depth, quantity=total)
+            count += self.depth + 1
+
+
+FLOWS = {"random_walk": RandomWalkFlow,
+         "market_maker": MarketMakerFlow,
+         "sweep": SweepFlow}
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0
+    index = min(len(ordered) - 1, int(fraction * len(ordered)))
+    return ordered[index]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, "w")).strip()
+    except Exception:
+        return None
+
+
+def run(flow_name, **kwargs):
+    """
+    Run one benchmark and return the results as a dict.
+    """
+    from sputnik import engine2
+
+    engine = engine2.Engine()
+    flow = FLOWS[flow_name](engine, **kwargs)
+
+    place_order = engine.place_order
+    cancel_order = engine.cancel_order
+    Order = engine2.Order
+
+    for op, value in flow.setup():
+        place_order(Order(**value))
+
+    latencies = []
+    places = cancels = 0
+    clock = time.time
+    for op, value in flow:
+        if op == "place":
+            order = Order(**value)
+            start = clock()
+            place_order(order)
+            latencies.append(clock() - start)
+            places += 1
+        else:
+            start = clock()
+            cancel_order(value)
+            latencies.append(clock() - start)
+            cancels += 1
+
+    total = sum(latencies)
+    latencies.sort()
+    return {"flow": flow_name,
+            "params": kwargs,
+            "revision": git_revision(),
+            "timestamp": int(time.time()),
+            "operations": len(latencies),
+            "places": places,
+            "cancels": cancels,
+            "resting": len(engine.ordermap),
+            "orders_per_sec": len(latencies) / total if total else 0,
+            "latency_us": {"p50": percentile(latencies, 0.50) * 1e6,
+                           "p99": percentile(latencies, 0.99) * 1e6,
+                           "p999": percentile(latencies, 0.999) * 1e6,
+                           "max": latencies[-1] * 1e6 if latencies else 0},
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-c", "--config", dest="filename", default=None,
+                      help="config file")
+    parser.add_option("-f", "--flow", dest="flow", default="random_walk",
+                      help="order flow: %s" % ", ".join(sorted(FLOWS)))
+    parser.add_option("-n", "--orders", dest="orders", type="int", default=10000,
+                      help="number of operations to generate")
+    parser.add_option("-d", "--depth", dest="depth", type="int", default=100,
+                      help="resting orders per side (market_maker) or levels swept (sweep)")
+    parser.add_option("-r", "--cancel-ratio", dest="cancel_ratio", type="float", default=0.5,
+                      help="fraction of market_maker steps that cancel/replace")
+    parser.add_option("-p", "--dispersion", dest="dispersion", type="int", default=10,
+                      help="price dispersion in ticks")
+    parser.add_option("-s", "--seed", dest="seed", type="int", default=0,
+                      help="random seed")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="append JSON results to this file")
+    (options, args) = parser.parse_args()
+
+    if options.flow not in FLOWS:
+        parser.error("unknown flow: %s" % options.flow)
+
+    # engine2 parses the command line on import, so hide ours from it
+    sys.argv = sys.argv[:1]
+
+    from sputnik import config
+    if options.filename:
+        config.reconfigure(options.filename)
+    if not config.has_section("specs"):
+        config.add_section("specs")
+        config.set("specs", "schema_root", SPEC_ROOT)
+
+    result = run(options.flow, seed=options.seed, orders=options.orders,
+                 depth=options.depth, cancel_ratio=options.cancel_ratio,
+                 dispersion=options.dispersion)
+
+    print "%(flow)s: %(operations)d ops (%(places)d places, %(cancels)d cancels), " \
+          "%(resting)d resting" % result
+    print "  %.0f orders/sec" % result["orders_per_sec"]
+    print "  latency p50=%(p50).1fus p99=%(p99).1fus p999=%(p999).1fus max=%(max).1fus" % \
+          result["latency_us"]
+    print "  peak rss %d kB" % result["peak_rss_kb"]
+
+    if options.output:
+        with open(options.output, "a") as output:
+            output.write(json.dumps(result, sort_keys=True) + "\n")
@@ -19,7 +19,7 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
     "../server"))
 
 from sputnik import config
-from sputnik import database, models
+from sputnik import database, models, sharding
 from sqlalchemy.orm.exc import NoResultFound
 from dateutil import parser
 from datetime import timedelta, datetime
@@ -360,6 +360,29 @@ class AddressManager:
         setattr(addr, field, value)
         self.session.merge(addr)
 
+class ShardManager:
+    def __init__(self, session):
+        self.session = session
+
+    def shard_map(self):
+        shards = sharding.ShardMap(config.getint("accountant", "num_procs"))
+        shards.load(self.session)
+        return shards
+
+    def list(self):
+        shards = self.shard_map()
+        for username, accountant in sorted(shards.assignments.iteritems()):
+            print "%s\t%d (ring: %d)" % (username, accountant, shards.ring_accountant_for(username))
+
+    def pin(self, num_procs):
+        """Pin the users who would move if there were num_procs accountants
+        to the accountant they are on now."""
+        usernames = [user.username for user in self.session.query(models.User)]
+        pins = sharding.pins_for(usernames, self.shard_map(), int(num_procs))
+        for username, accountant in pins.iteritems():
+            self.session.merge(models.AccountantShard(username, accountant))
+        print "Pinned %d users" % len(pins)
+
 class DatabaseManager:
     def __init__(self, session):
         self.session = session
@@ -378,6 +401,7 @@ class LowEarthOrbit:
             "permissions": PermissionsManager(session),
             "admin": AdminManager(session),
             "fees": FeesManager(session),
+            "shards": ShardManager(session),
         }
 
     def parse(self, line):